@@ -12,6 +12,7 @@ from PySide6.QtCore import Qt
 from PySide6.QtCore import QSettings
 from PySide6.QtCore import Slot
 from PySide6.QtWidgets import QCheckBox
+from PySide6.QtWidgets import QComboBox
 from PySide6.QtWidgets import QDialog
 from PySide6.QtWidgets import QDialogButtonBox
 from PySide6.QtWidgets import QFileDialog
@@ -24,7 +25,6 @@ from PySide6.QtWidgets import QSizePolicy
 from PySide6.QtWidgets import QSpacerItem
 from Util.Globals import Globals
 from Widgets.XHSlider import XHSlider
-import torch
 
 
 class ModelDialog(QDialog):
@@ -74,6 +74,16 @@ class ModelDialog(QDialog):
         layout.addWidget(browseButton, row, 2)
         row = row + 1
 
+        label = QLabel('Draft model path', self)
+        layout.addWidget(label, row, 0)
+        self._draftModelPathWidget = QLineEdit(self)
+        self._draftModelPathWidget.setToolTip('Specify path to a small model with the same vocabulary used to propose tokens for speculative decoding')
+        layout.addWidget(self._draftModelPathWidget, row, 1)
+        browseButton = QPushButton('Browse', self)
+        browseButton.clicked.connect(self.onDraftModel)
+        layout.addWidget(browseButton, row, 2)
+        row = row + 1
+
         label = QLabel('Max CPU memory(MB)', self)
         layout.addWidget(label, row, 0)
         self._maxCpuMemoryWidget = XHSlider(self, 0, 128000, 5000, 'Specify maximum CPU memory to use')
@@ -81,6 +91,7 @@ class ModelDialog(QDialog):
         row = row + 1
 
         self._gpuWidgets = []
+        import torch
         self._gpuCount = torch.cuda.device_count()
         for i in range(self._gpuCount):
             gpuName = torch.cuda.get_device_name(i)
@@ -131,6 +142,68 @@ class ModelDialog(QDialog):
         layout.addWidget(self._use4Bit, row, 0, 1, 1)
         row = row + 1
 
+        self._cacheQuantized = QCheckBox('Cache quantized model', self)
+        self._cacheQuantized.setToolTip('Click to save the 8-bit or 4-bit quantized model on first load and load it directly afterwards')
+        layout.addWidget(self._cacheQuantized, row, 0, 1, 1)
+        row = row + 1
+
+        self._cpuOptimized = QCheckBox('CPU optimized', self)
+        self._cpuOptimized.setToolTip('Click to load the model entirely into CPU memory with CPU specific tuning, for hosts with no GPU')
+        layout.addWidget(self._cpuOptimized, row, 0, 1, 1)
+        row = row + 1
+
+        label = QLabel('CPU threads', self)
+        layout.addWidget(label, row, 0)
+        self._cpuThreads = XHSlider(self, 0, 256, 1, 'Specify number of threads used for CPU inference and by llama.cpp, 0 to use the default')
+        layout.addWidget(self._cpuThreads, row, 1, 1, 2)
+        row = row + 1
+
+        label = QLabel('CPU precision', self)
+        layout.addWidget(label, row, 0)
+        self._cpuPrecision = QComboBox(self)
+        self._cpuPrecision.addItems(['bfloat16', 'int8', 'float32'])
+        self._cpuPrecision.setToolTip('Select bfloat16 weights, dynamic int8 quantization of linear layers, or float32 weights for CPU inference')
+        layout.addWidget(self._cpuPrecision, row, 1, 1, 1)
+        row = row + 1
+
+        self._useMmap = QCheckBox('Memory map GGUF model', self)
+        self._useMmap.setToolTip('Click to memory map GGUF model files instead of reading them into memory')
+        layout.addWidget(self._useMmap, row, 0, 1, 1)
+        row = row + 1
+
+        self._useMlock = QCheckBox('Lock GGUF model in memory', self)
+        self._useMlock.setToolTip('Click to lock the GGUF model in memory so it is not paged out')
+        layout.addWidget(self._useMlock, row, 0, 1, 1)
+        row = row + 1
+
+        label = QLabel('GGUF context size', self)
+        layout.addWidget(label, row, 0)
+        self._contextSize = XHSlider(self, 512, 32768, 512, 'Specify the GGUF model context size in tokens, including the prompt and answer')
+        layout.addWidget(self._contextSize, row, 1, 1, 2)
+        row = row + 1
+
+        label = QLabel('GGUF batch size', self)
+        layout.addWidget(label, row, 0)
+        self._batchSize = XHSlider(self, 1, 4096, 64, 'Specify the number of prompt tokens evaluated in each batch')
+        layout.addWidget(self._batchSize, row, 1, 1, 2)
+        row = row + 1
+
+        label = QLabel('GGUF GPU layers', self)
+        layout.addWidget(label, row, 0)
+        self._gpuLayers = XHSlider(self, 0, 256, 1, 'Specify the number of GGUF model layers offloaded to the GPU')
+        layout.addWidget(self._gpuLayers, row, 1, 1, 2)
+        row = row + 1
+
+        self._warmUp = QCheckBox('Warm up after load', self)
+        self._warmUp.setToolTip('Click to run a short generation after loading the model so the first query is not slowed by initialization')
+        layout.addWidget(self._warmUp, row, 0, 1, 1)
+        row = row + 1
+
+        self._compileModel = QCheckBox('Compile model', self)
+        self._compileModel.setToolTip('Click to compile the model with torch.compile during warm up, where supported')
+        layout.addWidget(self._compileModel, row, 0, 1, 1)
+        row = row + 1
+
         self.trustRemoteCode = QCheckBox('Trust remote code', self)
         self.trustRemoteCode.setToolTip('Click to trust execution of remote code')
         layout.addWidget(self.trustRemoteCode, row, 0, 1, 1)
@@ -165,10 +238,14 @@ class ModelDialog(QDialog):
         layout.addItem(spacer, row, 0, 1, 3)
         layout.setRowStretch(row, 1)
 
-        # If the user is editing a profile then fill in the widgets with current profile values
+        # Set the llama.cpp defaults for a new profile. If the user is editing a profile then fill in the widgets with current profile values
+        self._useMmap.setChecked(True)
+        self._contextSize.setValue(2048)
+        self._batchSize.setValue(512)
         if (self._profile is not None):
             self._modelPathWidget.setText(self._profile['modelPath'])
             self._overflowPathWidget.setText(self._profile['overflowPath'])
+            self._draftModelPathWidget.setText(self._profile.get('draftModelPath', ''))
             self._maxCpuMemoryWidget.setValue(self._profile['maxCpuMemory'])
             gpuMemory = self._profile['gpuMemory']
             for i in range(self._gpuCount):
@@ -180,6 +257,17 @@ class ModelDialog(QDialog):
             self._use16Bit.setChecked(self._profile['use16Bit'])
             self.use8Bit.setChecked(self._profile['use8Bit'])
             self._use4Bit.setChecked(self._profile['use4Bit'])
+            self._cacheQuantized.setChecked(self._profile.get('cacheQuantized', False))
+            self._cpuOptimized.setChecked(self._profile.get('cpuOptimized', False))
+            self._cpuThreads.setValue(self._profile.get('cpuThreads', 0))
+            self._cpuPrecision.setCurrentText(self._profile.get('cpuPrecision', 'bfloat16'))
+            self._useMmap.setChecked(self._profile.get('useMmap', True))
+            self._useMlock.setChecked(self._profile.get('useMlock', False))
+            self._contextSize.setValue(self._profile.get('contextSize', 2048))
+            self._batchSize.setValue(self._profile.get('batchSize', 512))
+            self._gpuLayers.setValue(self._profile.get('gpuLayers', 0))
+            self._warmUp.setChecked(self._profile.get('warmUp', False))
+            self._compileModel.setChecked(self._profile.get('compileModel', False))
             self.trustRemoteCode.setChecked(self._profile['trustRemoteCode'])
             self._useSafeTensors.setChecked(self._profile['useSafeTensors'])
             self._wBits.setText(str(self._profile['wBits']))
@@ -202,6 +290,15 @@ class ModelDialog(QDialog):
             settings.setValue('ModelWindow.ModelPath', path)
             settings.setValue('ModelWindow.ModelDirectory', fileInfo.dir().absolutePath())
 
+    # Handle the browse button being clicked, where a directory selection dialog is displayed so the user can select a draft model directory
+    @Slot(bool)
+    def onDraftModel(self, checked):
+        settings = QSettings()
+        modelDirectory = settings.value('ModelWindow.ModelDirectory', '/')
+        path = QFileDialog.getExistingDirectory(self, 'Select Draft Model Directory', modelDirectory)
+        if path:
+            self._draftModelPathWidget.setText(path)
+
     # Handle the browse button being clicked, where a direcxtory selection dialog is displayed so the use can select a model overflow
     # directory
     @Slot(bool)
@@ -230,6 +327,10 @@ class ModelDialog(QDialog):
         if (not os.path.exists(modelPath)):
             QMessageBox.critical(self, 'Invalid Model Path', f'Model path {modelPath} does not exist')
             return
+        draftModelPath = self._draftModelPathWidget.text().strip()
+        if ((len(draftModelPath) > 0) and (not os.path.isdir(draftModelPath))):
+            QMessageBox.critical(self, 'Invalid Draft Model Path', f'Draft model path {draftModelPath} is not a directory')
+            return
         if (self._OverflowToDisk.isChecked()):
             if (not os.path.exists(overflowPath)):
                 QMessageBox.critical(self, 'Invalid Model Overflow Path', f'Model overflow path {overflowPath} does not exist')
@@ -272,6 +373,7 @@ class ModelDialog(QDialog):
         profileData = {}
         profileData['modelPath'] = modelPath
         profileData['overflowPath'] = overflowPath
+        profileData['draftModelPath'] = draftModelPath
         profileData['maxCpuMemory'] = self._maxCpuMemoryWidget.value()
         profileData['overflowToDisk'] = self._OverflowToDisk.isChecked()
         profileData['gpuCount'] = self._gpuCount
@@ -284,6 +386,17 @@ class ModelDialog(QDialog):
         profileData['use16Bit'] = self._use16Bit.isChecked()
         profileData['use8Bit'] = self.use8Bit.isChecked()
         profileData['use4Bit'] = self._use4Bit.isChecked()
+        profileData['cacheQuantized'] = self._cacheQuantized.isChecked()
+        profileData['cpuOptimized'] = self._cpuOptimized.isChecked()
+        profileData['cpuThreads'] = int(self._cpuThreads.value())
+        profileData['cpuPrecision'] = self._cpuPrecision.currentText()
+        profileData['useMmap'] = self._useMmap.isChecked()
+        profileData['useMlock'] = self._useMlock.isChecked()
+        profileData['contextSize'] = int(self._contextSize.value())
+        profileData['batchSize'] = int(self._batchSize.value())
+        profileData['gpuLayers'] = int(self._gpuLayers.value())
+        profileData['warmUp'] = self._warmUp.isChecked()
+        profileData['compileModel'] = self._compileModel.isChecked()
         profileData['trustRemoteCode'] = self.trustRemoteCode.isChecked()
         profileData['useSafeTensors'] = self._useSafeTensors.isChecked()
         profileData['wBits'] = wbits
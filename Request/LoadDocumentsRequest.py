@@ -5,83 +5,314 @@
 #
 # Copyright 2024 David Wootton
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import CSVLoader
-from langchain_community.document_loaders import Docx2txtLoader
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import UnstructuredHTMLLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores.faiss import FAISS
+import bisect
+import csv
+import io
+import os
+import uuid
 from Request.Request import Request
 import time
-import torch
+from Util.EmbeddingPool import EmbeddingPool
+from Util.Embeddings import DEFAULT_SENTENCE_TRANSFORMER
+from Util.Embeddings import createEmbeddings
+from Util.Embeddings import getMaxSeqLength
 from Util.Globals import Globals
+from Util.PdfExtractor import PdfExtractor
+from Util.Pipeline import Pipeline
+from Util.TokenAwareSplitter import TokenAwareSplitter
 
 class LoadDocumentsRequest(Request):
+    # File name extensions of the document types this request can load
+    DOCUMENT_EXTENSIONS = ('.pdf', '.doc', '.docx', '.odt', '.html', '.htm', '.ppt', '.pptx', '.odp', '.csv')
+    # Chunk metadata keys which identify where a chunk came from
+    LOCATION_KEYS = ('source', 'type', 'mtime', 'page', 'lastPage', 'row', 'lastRow')
+
     def __init__(self):
         super().__init__()
+        self._timings = {}
+        self._chunkCount = 0
+        self._embeddingFormat = 'pytorch'
+        self._embeddingWorkers = 0
+        self._parseWorkers = 0
+        self._csvRows = 0
+        self._deduplicate = False
+        self._nearDuplicateSimilarity = 1.0
+        self._duplicateCount = 0
+        self._chunkUnits = 'characters'
+        self._snapSentences = False
+        self._smallToBig = False
+        self._contextSize = 0
+
+    # Number of chunks embedded and added to the index at a time
+    BATCH_SIZE = 64
+    # Number of items waiting between each pair of ingestion stages
+    QUEUE_DEPTH = 4
+
+    def isProfilable(self):
+        return True
 
-# Process a request to convert a set of one or more input documents into a FAISS index
+    # Process a request to convert a set of one or more input documents into a FAISS index. Ingestion is a pipeline of stages running
+    # concurrently, connected by bounded queues: documents are parsed, each document's text is split into chunks, chunks are embedded in
+    # batches and each batch is added to the index as it arrives. Parsing of one document therefore overlaps embedding of the previous
+    # ones. The utilization of each stage and the depth of the queue following it are logged so the bottleneck stage can be found. Each
+    # chunk's metadata records the document it came from, the document's type and modification time, its offset in the document's text
+    # and, for PDFs, the page it starts on, so queries can be restricted to some documents. If
+    # deduplication is enabled, chunks duplicating an earlier chunk are dropped before they are embedded, and the locations of the
+    # duplicates are added to the kept chunk's metadata. In small to big mode, documents are split into small windows which do not overlap,
+    # and each window is stored as offsets into a single copy of its document's text, which is expanded to the surrounding context when
+    # the window matches a query.
     def processRequest(self):
-        documentText = ''
-        # Load all documents using appropriate document loader and extract all text in the document into a single string.
+        import torch
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        from Util.Deduplicator import Deduplicator
         Globals().logMessage('Loading documents')
         startTime = time.time()
+        # The embeddings are created here even when worker processes embed the chunks, since the index uses them to embed queries. This also
+        # creates any ONNX export before the workers start, so they do not all try to create it.
+        self._embeddings = createEmbeddings(self._sentenceTransformer, self._embeddingFormat)
+        # Split the text into chunks small enough that they can be processed in generating the vectorstore and used by the language model.
+        # Chunk size and overlap are counted in characters or in tokens of the sentence transformer's tokenizer. Token chunks are limited
+        # to the number of tokens the sentence transformer embeds, since it ignores the rest.
+        overlap = 0 if (self._smallToBig) else self._overlap
+        if (self._chunkUnits == 'tokens'):
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(self._sentenceTransformer if (len(self._sentenceTransformer) > 0)
+                                                      else DEFAULT_SENTENCE_TRANSFORMER)
+            self._textSplitter = TokenAwareSplitter(tokenizer, self._chunkSize, overlap, self._snapSentences,
+                                                    getMaxSeqLength(self._embeddings))
+        else:
+            self._textSplitter = RecursiveCharacterTextSplitter(chunk_size=self._chunkSize, chunk_overlap=overlap, add_start_index=True)
+        self._documentTexts = {}
+        self._pool = None
+        self._pdfExtractor = PdfExtractor(self._parseWorkers)
+        if (self._embeddingWorkers > 0):
+            self._pool = EmbeddingPool(self._sentenceTransformer, self._embeddingFormat, self._embeddingWorkers)
+        self._vectorStore = None
+        self._chunkCount = 0
+        self._deduplicator = Deduplicator(self._nearDuplicateSimilarity) if (self._deduplicate) else None
+        pipeline = Pipeline()
+        pipeline.addStage('load', self.parseDocuments, self.QUEUE_DEPTH)
+        pipeline.addStage('split', self.splitDocuments, self.QUEUE_DEPTH)
+        pipeline.addStage('deduplicate', self.deduplicateChunks, self.QUEUE_DEPTH)
+        pipeline.addStage('embed', self.embedChunks, self.QUEUE_DEPTH)
+        pipeline.addStage('index', self.indexChunks)
+        try:
+            report = pipeline.run()
+        finally:
+            self._pdfExtractor.close()
+            if (self._pool is not None):
+                self._pool.close()
+                self._pool = None
+        elapsedTime = time.time() - startTime
+        for stage in report.keys():
+            self._timings[stage] = report[stage]['busy']
+        self._timings['total'] = elapsedTime
+        self._timings['pipeline'] = report
+        pipeline.logReport(Globals().logMessage)
+        vectorStore = self._vectorStore
+        # clean up storage allocations no longer needed
+        self._vectorStore = None
+        self._embeddings = None
+        if (torch.cuda.is_available()):
+            torch.cuda.empty_cache()
+        if (vectorStore is None):
+            raise ValueError('No text was found in the documents')
+        if (len(self._documentTexts) > 0):
+            vectorStore.docstore.add(self._documentTexts)
+            Globals().logMessage(f'Stored {sum(len(d.page_content) for d in self._documentTexts.values())} characters of text for '
+                                 f'{len(self._documentTexts)} documents')
+            self._documentTexts = {}
+        if (self._deduplicator is not None):
+            for keptId, locations in self._deduplicator.getDuplicateLocations().items():
+                vectorStore.docstore.search(keptId).metadata['duplicates'] = locations
+            self._duplicateCount = self._deduplicator.getExactCount() + self._deduplicator.getNearCount()
+            Globals().logMessage(f'Removed {self._duplicateCount} duplicate chunks, {self._deduplicator.getExactCount()} exact and '
+                                 f'{self._deduplicator.getNearCount()} near duplicates')
+            self._deduplicator = None
+        Globals().logMessage(f'Converted {self._chunkCount} text chunks to vectorstore in {elapsedTime:.3f} seconds, '
+                             f'{self._chunkCount / max(elapsedTime, 1e-9):.1f} chunks/sec')
+        self.getSession().setDocumentStore(vectorStore)
+
+    # Drop chunks which duplicate an earlier chunk if deduplication is enabled, and assign each remaining chunk its docstore id, yielding
+    # batches of chunk ids and chunks
+    def deduplicateChunks(self, batches):
+        for batch in batches:
+            keptChunks = []
+            for chunk in batch:
+                chunkId = str(uuid.uuid4())
+                if (self._deduplicator is not None):
+                    location = {key: chunk.metadata[key] for key in self.LOCATION_KEYS if (key in chunk.metadata)}
+                    if (self._deduplicator.findDuplicate(chunkId, chunk.page_content, location) is not None):
+                        continue
+                keptChunks.append((chunkId, chunk))
+            if (len(keptChunks) > 0):
+                yield keptChunks
+
+    # Embed batches of chunks, in worker processes if embedding workers are used
+    def embedChunks(self, batches):
+        if (self._pool is not None):
+            # Only the chunk text is sent to the workers, so each batch is kept until its embeddings are returned
+            pending = []
+            for batchEmbeddings in self._pool.embedBatches(self.getBatchTexts(batches, pending)):
+                yield pending.pop(0), batchEmbeddings
+        else:
+            for batch in batches:
+                yield batch, self._embeddings.embed_documents([chunk.page_content for chunkId, chunk in batch])
+
+    # Get the text of each batch of chunks, remembering the batches in the pending list
+    def getBatchTexts(self, batches, pending):
+        for batch in batches:
+            pending.append(batch)
+            yield [chunk.page_content for chunkId, chunk in batch]
+
+    # Format a header row and a window of CSV rows as CSV text
+    def formatCsvRows(self, header, rows):
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+        return text.getvalue()
+
+    # Get the metadata kept with every chunk of a document: its path, its type, which is its file name extension, and its modification time
+    def getDocumentMetadata(self, doc):
+        metadata = {'source': doc, 'type': os.path.splitext(doc)[1].lstrip('.').lower()}
+        if (os.path.exists(doc)):
+            metadata['mtime'] = int(os.path.getmtime(doc))
+        return metadata
+
+    # Get the number of duplicate chunks which were not added to the vectorstore
+    def getDuplicateCount(self):
+        return self._duplicateCount
+
+    # Get the number of text chunks added to the vectorstore
+    def getChunkCount(self):
+        return self._chunkCount
+
+    # Get the elapsed time in seconds for each processing stage. Since the stages run concurrently, this is the time each stage was busy,
+    # and the total time is less than the sum of the stage times.
+    def getTimings(self):
+        return self._timings
+
+    # Add batches of embedded chunks to the index, creating the index from the first batch
+    def indexChunks(self, batches):
+        from langchain_community.vectorstores.faiss import FAISS
+        for batch, batchEmbeddings in batches:
+            # The text of a small to big window is not stored, since it is in its document's text
+            texts = ['' if ('textId' in chunk.metadata) else chunk.page_content for chunkId, chunk in batch]
+            textEmbeddings = zip(texts, batchEmbeddings)
+            metadatas = [chunk.metadata for chunkId, chunk in batch]
+            ids = [chunkId for chunkId, chunk in batch]
+            if (self._vectorStore is None):
+                self._vectorStore = FAISS.from_embeddings(textEmbeddings, self._embeddings, metadatas=metadatas, ids=ids)
+            else:
+                self._vectorStore.add_embeddings(textEmbeddings, metadatas=metadatas, ids=ids)
+            self._chunkCount = self._chunkCount + len(batch)
+        return
+        yield
+
+    # Load a document using the appropriate document loader and extract all text in the document into a single string. Returns the text
+    # and, for PDFs, the offset in the text where each page starts, otherwise None.
+    def loadDocument(self, doc):
+        from langchain_community.document_loaders import CSVLoader
+        from langchain_community.document_loaders import Docx2txtLoader
+        from langchain_community.document_loaders import UnstructuredHTMLLoader
+        from langchain_community.document_loaders import UnstructuredPowerPointLoader
+        documentText = ''
+        pageOffsets = None
+        if (doc.endswith('.pdf')):
+            pageOffsets = []
+            pages = self._pdfExtractor.extractText(doc)
+            for page in pages:
+                pageOffsets.append(len(documentText))
+                documentText = documentText + page + '\n'
+        elif (doc.endswith('.doc') or doc.endswith('docx') or doc.endswith('odt')):
+            loader = Docx2txtLoader(doc)
+            dataBlock = loader.load()
+            for data in dataBlock:
+                documentText = documentText + data.page_content
+        elif (doc.endswith('.html') or doc.endswith('.htm') or doc.startswith('http')):
+            loader = UnstructuredHTMLLoader(doc)
+            dataBlock = loader.load()
+            for data in dataBlock:
+                documentText = documentText + data.page_content
+        elif (doc.endswith('.ppt') or doc.endswith('.pptx') or doc.endswith('.odp')):
+            loader = UnstructuredPowerPointLoader(doc)
+            dataBlock = loader.load()
+            for data in dataBlock:
+                documentText = documentText + data.page_content
+        elif (doc.endswith('.csv')):
+            loader = CSVLoader(doc)
+            dataBlock = loader.load()
+            for data in dataBlock:
+                documentText = documentText + data.page_content
+        return documentText, pageOffsets
+
+    # Check the offset of each chunk in its document's text. The text splitter sets the offset to -1 if it does not find a chunk, which
+    # happens when whitespace is stripped from the chunk, so the offset is found again by searching from the previous chunk's offset.
+    # Chunks which are still not found are skipped, since their page and small to big window would be wrong.
+    def locateChunks(self, doc, documentText, chunks):
+        located = []
+        previousStart = 0
+        for chunk in chunks:
+            if (chunk.metadata['start_index'] < 0):
+                startIndex = documentText.find(chunk.page_content, previousStart)
+                if (startIndex < 0):
+                    startIndex = documentText.find(chunk.page_content)
+                if (startIndex < 0):
+                    Globals().logMessage(f'Skipping chunk of {doc} which was not found in the document text: {chunk.page_content[:40]!r}')
+                    continue
+                chunk.metadata['start_index'] = startIndex
+            previousStart = chunk.metadata['start_index']
+            located.append(chunk)
+        return located
+
+    # Load each document in turn, yielding the document's name, text, page offsets and, for a window of CSV rows which is used as a chunk
+    # without being split, the first and last row numbers. If CSV row windows are used, CSV files are read a window at a time, so the
+    # memory used does not depend on the size of the file.
+    def parseDocuments(self):
         for n in range(len(self._documentList)):
             doc = self._documentList[n]
-            if (doc.endswith('.pdf')):
-                loader = PyPDFLoader(doc)
-                pages = loader.load_and_split()
-                for page in pages:
-                    documentText = documentText + page.page_content
-            elif (doc.endswith('.doc') or doc.endswith('docx') or doc.endswith('odt')):
-                loader = Docx2txtLoader(doc)
-                dataBlock = loader.load()
-                for data in dataBlock:
-                    documentText = documentText + data.page_content
-            elif (doc.endswith('.html') or doc.endswith('.htm') or doc.startswith('http')):
-                loader = UnstructuredHTMLLoader(doc)
-                dataBlock = loader.load()
-                for data in dataBlock:
-                    documentText = documentText + data.page_content
-            elif (doc.endswith('.ppt') or doc.endswith('.pptx') or doc.endswith('.odp')):
-                loader = UnstructuredPowerPointLoader(doc)
-                dataBlock = loader.load()
-                for data in dataBlock:
-                    documentText = documentText + data.page_content
-            elif (doc.endswith('.csv')):
-                loader = CSVLoader(doc)
-                dataBlock = loader.load()
-                for data in dataBlock:
-                    documentText = documentText + data.page_content
+            if (doc.endswith('.csv') and (self._csvRows > 0)):
+                for windowText, firstRow, lastRow in self.readCsvWindows(doc):
+                    yield doc, windowText, None, (firstRow, lastRow)
+                continue
+            documentText, pageOffsets = self.loadDocument(doc)
+            if (len(documentText) > 0):
+                yield doc, documentText, pageOffsets, None
 
-        elapsedTime = time.time() - startTime
-        Globals().logMessage(f'Loaded documents in {elapsedTime:.3f} seconds')
-        # Split the text string into chunks small enough that they can be processed in generating the vectorstore and used by the language
-        # model.
-        textSplitter = RecursiveCharacterTextSplitter(chunk_size=self._chunkSize, chunk_overlap=self._overlap)
-        # Split the text into chunks
-        Globals().logMessage('Splitting text into chunks')
-        startTime = time.time()
-        texts = textSplitter.split_text(documentText)
-        elapsedTime = time.time() - startTime
-        Globals().logMessage(f'Split text in {elapsedTime:.3f} seconds')
-        # Convert the text chunks into a vectorstore
-        Globals().logMessage("Converting text chunks to vectorstore")
-        startTime = time.time()
-        if (len(self._sentenceTransformer) > 0):
-            embeddings = HuggingFaceEmbeddings(model_name=self._sentenceTransformer)
-        else:
-            embeddings = HuggingFaceEmbeddings()
-        vectorStore = FAISS.from_texts(texts, embeddings)
-        elapsedTime = time.time() - startTime
-        # clean up storage allocations no longert needed
-        del embeddings
-        embeddings = None
-        torch.cuda.empty_cache()
-        Globals().logMessage(f'Converted text chunks to vectorstore in {elapsedTime:.3f} seconds')
-        Globals().setDocumentStore(vectorStore)
+    # Read a CSV file incrementally, yielding the text of each window of rows, in CSV format with the header row first, along with the
+    # numbers of the first and last rows in the window, counting data rows from 0 as CSVLoader does
+    def readCsvWindows(self, doc):
+        with open(doc, newline='', encoding='utf-8', errors='replace') as csvFile:
+            reader = csv.reader(csvFile)
+            header = next(reader, None)
+            if (header is None):
+                return
+            window = []
+            firstRow = 0
+            for row in reader:
+                window.append(row)
+                if (len(window) == self._csvRows):
+                    yield self.formatCsvRows(header, window), firstRow, firstRow + len(window) - 1
+                    firstRow = firstRow + len(window)
+                    window = []
+            if (len(window) > 0):
+                yield self.formatCsvRows(header, window), firstRow, firstRow + len(window) - 1
+
+    # Set whether chunk size and overlap are counted in 'characters' or 'tokens'. Token chunks may be snapped to sentence boundaries.
+    def setChunkUnits(self, chunkUnits, snapSentences):
+        self._chunkUnits = chunkUnits
+        self._snapSentences = snapSentences
+
+    # Enable small to big mode, where each window matching a query is expanded to about contextSize characters of surrounding text
+    def setSmallToBig(self, smallToBig, contextSize):
+        self._smallToBig = smallToBig
+        self._contextSize = contextSize
+
+    # Set the number of CSV rows in each chunk. If not 0, CSV files are streamed in windows of this many rows, each of which becomes a chunk
+    # with the header row repeated, instead of all rows being loaded and split like other documents.
+    def setCsvRows(self, csvRows):
+        self._csvRows = csvRows
 
     # Get the attributes used to load the documents
     def setDocumentList(self, documents, chunkSize, overlap, sentenceTransformer):
@@ -89,3 +320,52 @@ class LoadDocumentsRequest(Request):
         self._chunkSize = chunkSize
         self._overlap = overlap
         self._sentenceTransformer = sentenceTransformer
+
+    # Enable removal of duplicate chunks. Chunks with a Jaccard similarity of at least nearDuplicateSimilarity to an earlier chunk are also
+    # removed, if it is less than 1.
+    def setDeduplication(self, deduplicate, nearDuplicateSimilarity):
+        self._deduplicate = deduplicate
+        self._nearDuplicateSimilarity = nearDuplicateSimilarity
+
+    # Set the number of worker processes used to embed chunks, 0 to embed chunks in this process
+    def setEmbeddingWorkers(self, embeddingWorkers):
+        self._embeddingWorkers = embeddingWorkers
+
+    # Set the format the sentence transformer is run in, one of Util.Embeddings.EMBEDDING_FORMATS
+    def setEmbeddingFormat(self, embeddingFormat):
+        self._embeddingFormat = embeddingFormat
+
+    # Set the number of worker processes used to extract the text of large PDFs, 0 to extract text in this process
+    def setParseWorkers(self, parseWorkers):
+        self._parseWorkers = parseWorkers
+
+    # Split the text of each document into chunks, yielding the chunks in batches. The page numbers in chunk metadata count from 0, as they do
+    # in PyPDFLoader documents. A chunk which continues onto later pages also records the last page it is on.
+    def splitDocuments(self, documents):
+        from langchain_core.documents import Document
+        batch = []
+        for doc, documentText, pageOffsets, rows in documents:
+            metadata = self.getDocumentMetadata(doc)
+            if (rows is not None):
+                chunks = [Document(page_content=documentText, metadata=dict(metadata, row=rows[0], lastRow=rows[1]))]
+            else:
+                chunks = self.locateChunks(doc, documentText, self._textSplitter.create_documents([documentText], [metadata]))
+                if (self._smallToBig):
+                    textId = str(uuid.uuid4())
+                    self._documentTexts[textId] = Document(page_content=documentText, metadata={'source': doc, 'contextSize': self._contextSize})
+                    for chunk in chunks:
+                        chunk.metadata['textId'] = textId
+                        chunk.metadata['end_index'] = chunk.metadata['start_index'] + len(chunk.page_content)
+            for chunk in chunks:
+                if (pageOffsets is not None):
+                    startIndex = chunk.metadata['start_index']
+                    chunk.metadata['page'] = max(0, bisect.bisect_right(pageOffsets, startIndex) - 1)
+                    lastPage = bisect.bisect_right(pageOffsets, startIndex + len(chunk.page_content) - 1) - 1
+                    if (lastPage > chunk.metadata['page']):
+                        chunk.metadata['lastPage'] = lastPage
+                batch.append(chunk)
+                if (len(batch) == self.BATCH_SIZE):
+                    yield batch
+                    batch = []
+        if (len(batch) > 0):
+            yield batch
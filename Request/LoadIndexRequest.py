@@ -0,0 +1,48 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import os
+from Request.Request import Request
+import time
+from Util.Embeddings import createEmbeddings
+from Util.Globals import Globals
+
+# Handle a request to load a previously saved FAISS index
+class LoadIndexRequest(Request):
+    def __init__(self):
+        super().__init__()
+        self._embeddingFormat = 'pytorch'
+
+    # Process a request to load a FAISS index. The sentence transformer must be the one used when the index was built.
+    def processRequest(self):
+        from langchain_community.vectorstores.faiss import FAISS
+        Globals().logMessage(f'Loading document index {self._indexPath}')
+        session = self.getSession()
+        session.setDocumentStore(None)
+        indexFile = os.path.join(self._indexPath, 'index.faiss')
+        indexMemory = os.path.getsize(indexFile) if (os.path.exists(indexFile)) else 0
+        sessionManager = Globals().getSessionManager()
+        with sessionManager.getLoadLock():
+            if (not sessionManager.hasMemoryFor(indexMemory)):
+                Globals().logMessage(f'Unable to load document index, the memory budget does not allow another '
+                                     f'{indexMemory / 1048576.0:.1f}MB')
+                return
+            startTime = time.time()
+            embeddings = createEmbeddings(self._sentenceTransformer, self._embeddingFormat)
+            vectorStore = FAISS.load_local(self._indexPath, embeddings)
+            session.setDocumentStore(vectorStore)
+        elapsedTime = time.time() - startTime
+        Globals().logMessage(f'Loaded document index in {elapsedTime:.3f} seconds')
+
+    # Set the format the sentence transformer is run in to embed queries, one of Util.Embeddings.EMBEDDING_FORMATS
+    def setEmbeddingFormat(self, embeddingFormat):
+        self._embeddingFormat = embeddingFormat
+
+    # Set the index directory and the sentence transformer used to embed queries
+    def setIndexParameters(self, indexPath, sentenceTransformer):
+        self._indexPath = indexPath
+        self._sentenceTransformer = sentenceTransformer
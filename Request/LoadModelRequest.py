@@ -9,38 +9,35 @@ import gc
 import glob
 import os
 import time
-import torch
-from accelerate import infer_auto_device_map
-from accelerate import init_empty_weights
-from auto_gptq import AutoGPTQForCausalLM
-from auto_gptq import BaseQuantizeConfig
-from ctransformers import AutoModelForCausalLM as GGUFAutoModelForCausalLM
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.chains.conversation.memory import ConversationBufferWindowMemory
-from langchain_community.llms import LlamaCpp
 from pathlib import Path
+import platform
 from Request.Request import Request
-from transformers import AutoConfig
-from transformers import AutoModelForCausalLM
-from transformers import AutoTokenizer
-from transformers import BitsAndBytesConfig
+from Util.DeviceMapCache import DeviceMapCache
 from Util.Globals import Globals
+from Util.MemoryEstimator import MemoryEstimator
+from Util.QuantizedModelCache import QuantizedModelCache
 
- 
-# This class is used as a callback when generating a LLM respose so output can vbe retried and displayed as it is generated rather than waiting for the
-# query to complete before displaying anything. 
-class ResultCallback(BaseCallbackHandler):
-    def on_llm_new_token(self, token, **kwargs):
-        Globals().postAnswer(token)
-
-# Handle a request to load a LLM model
+# Handle a request to load a LLM model. The libraries used to load models are imported by the loader methods rather than when this
+# module is imported, so they do not slow down application startup.
 class LoadModelRequest(Request):
+    # Document text and question used to build a typical query prompt for the warm-up generation
+    WARM_UP_CONTEXT = ('The warm-up pass runs a short generation after a model is loaded. Memory is allocated, kernels are selected and '
+                       'caches are filled, so the first query a user runs is as fast as the queries that follow it.')
+    WARM_UP_QUESTION = 'What does the warm-up pass do?'
+    WARM_UP_TOKENS = 16
+
     def __init__(self):
         super().__init__()
+        self._dryRun = False
 
 
     # Load the model when it is in GPTQ quantized format
     def gptqLoader(self):
+        import torch
+        from accelerate import infer_auto_device_map
+        from auto_gptq import AutoGPTQForCausalLM
+        from auto_gptq import BaseQuantizeConfig
+        from transformers import AutoTokenizer
         Globals().logMessage('Loading GPTQ model')
         startTime = time.time()
         model = None
@@ -101,9 +98,19 @@ class LoadModelRequest(Request):
             params['pretrained_model_name_or_path'] = self._modelPath
             quantizeConfig = BaseQuantizeConfig(bits=4, group_size=128, desc_act=False)
             params['quantize_config'] = quantizeConfig
+            # Use the device map computed by a previous load of this profile if there is one
+            deviceMapCache = DeviceMapCache()
+            deviceMapKey = deviceMapCache.getKey(self._modelPath, limits, 'gptq', str(torchDType), self._useTriton, self._useSafeTensors)
+            cachedDeviceMap = deviceMapCache.loadDeviceMap(deviceMapKey)
+            if (cachedDeviceMap is not None):
+                params['device_map'] = cachedDeviceMap[0]
+                Globals().logMessage(f'Using cached device map, saved {cachedDeviceMap[1]:.3f} seconds')
             model = AutoGPTQForCausalLM.from_quantized(**params)
-            params['device_map'] = infer_auto_device_map(model, max_memory=params['max_memory'],
-                                                         no_split_module_classes=model._no_split_modules, dtype=torchDType)
+            if (cachedDeviceMap is None):
+                mapStartTime = time.time()
+                params['device_map'] = infer_auto_device_map(model, max_memory=params['max_memory'],
+                                                             no_split_module_classes=model._no_split_modules, dtype=torchDType)
+                deviceMapCache.saveDeviceMap(deviceMapKey, params['device_map'], time.time() - mapStartTime)
             print('params:', params['device_map'])
         
         # The MPT-7B models fail to load if the device_map parameter is set to auto with an error stating the auto mode is not implemented
@@ -124,8 +131,8 @@ class LoadModelRequest(Request):
         model.eval()
 
         tokenizer = AutoTokenizer.from_pretrained(self._modelPath)
-        Globals().setModel(model)
-        Globals().setTokenizer(tokenizer)
+        self.getSession().setModel(model)
+        self.getSession().setTokenizer(tokenizer)
         elapsedTime = time.time() - startTime
         #memoryFootprint = model.get_memory_footprint()
         #bufferMemorySize = memoryFootprint - model.get_memory_footprint(return_buffers=False)
@@ -135,26 +142,117 @@ class LoadModelRequest(Request):
         #logMessage = logMessage + f' max CUDA memory {torch.cuda.max_memory_allocated() / 1000000000.0:.3f}GB'
         Globals().logMessage(logMessage)
 
-    # Load a quantized model that is in LlamaCPP format
+    # Load a non-quantized LLM model for inference on hosts without a GPU. The model is loaded entirely into CPU memory in bfloat16, or in
+    # float32 with its linear layers quantized to int8 after loading, and uses the scaled dot product attention implementation where the
+    # model supports it. bfloat16 is only used if the CPU has bfloat16 instructions, since emulating them is slower than using float32.
+    def cpuLoader(self):
+        import torch
+        from transformers import AutoModelForCausalLM
+        from transformers import AutoTokenizer
+        Globals().logMessage('Loading model for CPU inference')
+        startTime = time.time()
+        if (self._cpuThreads > 0):
+            torch.set_num_threads(self._cpuThreads)
+        Globals().logMessage(f'Using {torch.get_num_threads()} threads, CPU capability {torch.backends.cpu.get_cpu_capability()}')
+        params = {}
+        params['trust_remote_code'] = self._trustRemoteCode
+        params['low_cpu_mem_usage'] = True
+        params['attn_implementation'] = 'sdpa'
+        precision = self._cpuPrecision
+        if ((precision == 'bfloat16') and (not self.isBfloat16Supported())):
+            Globals().logMessage('CPU does not have AVX512-BF16 or AMX bfloat16 instructions, loading model in float32')
+            precision = 'float32'
+        # Dynamic int8 quantization needs float32 weights
+        if (precision == 'bfloat16'):
+            params['torch_dtype'] = torch.bfloat16
+        else:
+            params['torch_dtype'] = torch.float32
+        try:
+            model = AutoModelForCausalLM.from_pretrained(self._modelPath, **params)
+        except ValueError as err:
+            Globals().logMessage(f'Unable to use SDPA attention, using default attention: {err}')
+            params.pop('attn_implementation')
+            model = AutoModelForCausalLM.from_pretrained(self._modelPath, **params)
+        if (precision == 'int8'):
+            quantizeStartTime = time.time()
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            Globals().logMessage(f'Quantized linear layers to int8 in {time.time() - quantizeStartTime:.3f} seconds')
+        model.eval()
+
+        tokenizer = AutoTokenizer.from_pretrained(self._modelPath, trust_remote_code=self._trustRemoteCode)
+        self.getSession().setModel(model)
+        self.getSession().setTokenizer(tokenizer)
+        elapsedTime = time.time() - startTime
+        logMessage = f'Loaded model and tokenizer in {elapsedTime:.3f} seconds'
+        logMessage = logMessage + f' precision {precision} memory footprint {self.getSession().getModelFootprint(model) / 1073741824.0:.3f}GB'
+        Globals().logMessage(logMessage)
+
+    # Check whether the CPU has native bfloat16 instructions, AVX512-BF16 or AMX on x86 or BF16 on ARM. PyTorch's own checks are used where
+    # this version of PyTorch has them, otherwise the CPU flags are read from /proc/cpuinfo on Linux.
+    def isBfloat16Supported(self):
+        import torch
+        cpu = getattr(torch._C, '_cpu', None)
+        if (hasattr(cpu, '_is_avx512_bf16_supported') and cpu._is_avx512_bf16_supported()):
+            return True
+        if (hasattr(cpu, '_is_amx_tile_supported') and cpu._is_amx_tile_supported()):
+            return True
+        try:
+            with open('/proc/cpuinfo') as cpuInfo:
+                flags = set()
+                for line in cpuInfo:
+                    if (line.startswith(('flags', 'Features'))):
+                        flags.update(line.split(':', 1)[1].split())
+        except OSError:
+            return False
+        return len(flags & {'avx512_bf16', 'amx_bf16', 'bf16'}) > 0
+
+    # Load a quantized model that is in GGUF format using llama.cpp. The model file is memory mapped unless mmap is disabled, so loading
+    # is fast and the operating system pages weights in as they are used. Locking the model in memory stops those pages from being
+    # swapped out. Answer text is streamed by the query request, so no callbacks are set here.
     def llamaCppLoader(self):
+        from langchain_community.llms import LlamaCpp
         Globals().logMessage('Loading LlamaCpp model')
-        files = glob.glob(self._modelPath + '/*ggmlv3*')
+        if (os.path.isfile(self._modelPath)):
+            files = [self._modelPath]
+        else:
+            files = sorted(glob.glob(self._modelPath + '/*.gguf'))
         if (len(files) == 0):
-            logMessage = f'No model found in {self._modelPath}'
+            if (len(glob.glob(self._modelPath + '/*ggml*')) > 0):
+                Globals().logMessage(f'Unable to load model, GGML models in {self._modelPath} must be converted to GGUF format')
+            else:
+                Globals().logMessage(f'No GGUF model found in {self._modelPath}')
             return
+        # Split models have several files, where llama.cpp loads the remaining files when given the first
         loadPath = files[0]
         startTime = time.time()
-        #model = LlamaCpp(model_path=loadPath, streaming=True, max_tokens=1500, temperature=.001, n_threads=20, n_ctx=2048,
-        #                callbacks=[ResultCallback()])
-        model = LlamaCpp(model_path=loadPath, streaming=True, callbacks=[ResultCallback()])
+        params = {}
+        params['model_path'] = loadPath
+        params['streaming'] = True
+        params['use_mmap'] = self._useMmap
+        params['use_mlock'] = self._useMlock
+        params['n_ctx'] = self._contextSize
+        params['n_batch'] = self._batchSize
+        params['n_gpu_layers'] = self._gpuLayers
+        if (self._cpuThreads > 0):
+            params['n_threads'] = self._cpuThreads
+        model = LlamaCpp(**params)
         elapsedTime = time.time() - startTime
-        logMessage = f'Loaded model and tokenizer in {elapsedTime:.3f} seconds'
+        logMessage = f'Loaded model {os.path.basename(loadPath)} in {elapsedTime:.3f} seconds, context {self._contextSize} tokens, '
+        logMessage = logMessage + f'batch {self._batchSize} tokens, {self._gpuLayers} GPU layers, {model.client.n_threads} threads'
+        logMessage = logMessage + f', mmap {self._useMmap}, mlock {self._useMlock}'
         Globals().logMessage(logMessage)
-        Globals().setModel(model)
-        Globals().setTokenizer(None)
+        self.getSession().setModel(model)
+        self.getSession().setTokenizer(None)
 
     # Load a non-quantized LLM model
     def standardLoader(self):
+        import torch
+        from accelerate import infer_auto_device_map
+        from accelerate import init_empty_weights
+        from transformers import AutoConfig
+        from transformers import AutoModelForCausalLM
+        from transformers import AutoTokenizer
+        from transformers import BitsAndBytesConfig
         startTime = time.time()
         model = None
         tokenizer = None
@@ -165,19 +263,6 @@ class LoadModelRequest(Request):
         else:
             torchDType = torch.float32
         params['torch_dtype'] = torchDType
-        config = AutoConfig.from_pretrained(self._modelPath, **params)
-        # Some models, for example MPT models include an attn_config map in their configuration. If present, try to set attn_impl to
-        # 'triton'
-        if (self._useTriton):
-            try:
-                config.attn_config['attn_impl'] = 'triton'
-            except AttributeError:
-                pass
-        with init_empty_weights():
-            model = AutoModelForCausalLM.from_config(config, **params)
-        model.tie_weights()
-        elapsedTime = time.time() - startTime
-        Globals().logMessage(f'Initialized model in {elapsedTime:.3f} seconds')
 
         # Set memory limits for CPU and/or GPU
         limits = {}
@@ -188,6 +273,39 @@ class LoadModelRequest(Request):
             limits['cpu'] = f'{self._maxCPUMemory}MiB'
         params['max_memory'] = limits
 
+        # When the device map is not automatic, the map is computed from a model with empty weights. Computed maps are cached so later
+        # loads of this profile can skip building the empty model.
+        deviceMap = None
+        if (not self._autoDevice):
+            deviceMapCache = DeviceMapCache()
+            deviceMapKey = deviceMapCache.getKey(self._modelPath, limits, 'standard', str(torchDType), self._useTriton, self._trustRemoteCode)
+            cachedDeviceMap = deviceMapCache.loadDeviceMap(deviceMapKey)
+            if (cachedDeviceMap is not None):
+                deviceMap = cachedDeviceMap[0]
+                elapsedTime = time.time() - startTime
+                Globals().logMessage(f'Using cached device map in {elapsedTime:.3f} seconds, '
+                                     f'saved {cachedDeviceMap[1] - elapsedTime:.3f} seconds')
+            else:
+                config = AutoConfig.from_pretrained(self._modelPath, trust_remote_code=self._trustRemoteCode, torch_dtype=torchDType)
+                # Some models, for example MPT models include an attn_config map in their configuration. If present, try to set attn_impl to
+                # 'triton'
+                if (self._useTriton):
+                    try:
+                        config.attn_config['attn_impl'] = 'triton'
+                    except AttributeError:
+                        pass
+                with init_empty_weights():
+                    model = AutoModelForCausalLM.from_config(config, trust_remote_code=self._trustRemoteCode, torch_dtype=torchDType)
+                model.tie_weights()
+                elapsedTime = time.time() - startTime
+                Globals().logMessage(f'Initialized model in {elapsedTime:.3f} seconds')
+                # Set memory limits for determining model map
+                deviceMap = infer_auto_device_map(model, max_memory=params['max_memory'], no_split_module_classes=model._no_split_modules,
+                                                  dtype=torchDType)
+                del model
+                model = None
+                deviceMapCache.saveDeviceMap(deviceMapKey, deviceMap, time.time() - startTime)
+
         # Load the model and the tokenizer
         Globals().logMessage('Loading model and tokenizer')
         startTime = time.time()
@@ -200,9 +318,7 @@ class LoadModelRequest(Request):
             Globals().logMessage('Using auto device map')
             params['device_map'] = 'auto'
         else:
-            # Set memory limits for determining model map
-            params['device_map'] = infer_auto_device_map(model, max_memory=params['max_memory'],
-                                   no_split_module_classes=model._no_split_modules, dtype=torchDType)
+            params['device_map'] = deviceMap
             print('device map:', params['device_map'])
 
         # Set parameters needed to load model
@@ -214,9 +330,32 @@ class LoadModelRequest(Request):
             params['quantization_config'] = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type='nf4', bnb_4bit_use_double_quant=True, 
                                                                bnb_4bit_compute_dtype=torch.bfloat16)
 
+        # If a quantized copy of this model was cached by an earlier load, load it instead of quantizing the full precision weights again.
+        # The quantization settings are saved in the cached model's configuration.
+        loadPath = self._modelPath
+        quantizedCache = None
+        if ((self._use8Bit or self._use4Bit) and self._cacheQuantized):
+            quantizedCache = QuantizedModelCache()
+            quantizeSettings = params['quantization_config'].to_dict()
+            quantizeSettings['torchDType'] = str(torchDType)
+            quantizeSettings['trustRemoteCode'] = self._trustRemoteCode
+            if (quantizedCache.isValid(self._modelPath, quantizeSettings)):
+                loadPath = quantizedCache.getModelDirectory(self._modelPath, quantizeSettings)
+                params.pop('quantization_config')
+                Globals().logMessage(f'Loading cached quantized model from {loadPath}')
+
         # The MPT-7B models fail to load if the device_map parameter is set to auto with an error stating the auto mode is not implemented
         # yet. This can be fixed by making the code change described in https://huggingface.co/mosaicml/mpt-7b/discussions/23
-        model = AutoModelForCausalLM.from_pretrained(self._modelPath, **params)
+        model = AutoModelForCausalLM.from_pretrained(loadPath, **params)
+
+        # Save the newly quantized model so later loads can skip quantization
+        if ((quantizedCache is not None) and (loadPath == self._modelPath)):
+            saveStartTime = time.time()
+            try:
+                cachePath = quantizedCache.saveModel(model, self._modelPath, quantizeSettings)
+                Globals().logMessage(f'Saved quantized model to {cachePath} in {time.time() - saveStartTime:.3f} seconds')
+            except Exception as err:
+                Globals().logMessage(f'Unable to save quantized model: {err}')
 
         # Log the mapping of model modules to devices
         devices = {}
@@ -233,26 +372,147 @@ class LoadModelRequest(Request):
         model.eval()
 
         tokenizer = AutoTokenizer.from_pretrained(self._modelPath, trust_remote_code=self._trustRemoteCode)
-        Globals().setModel(model)
-        Globals().setTokenizer(tokenizer)
+        self.getSession().setModel(model)
+        self.getSession().setTokenizer(tokenizer)
         elapsedTime = time.time() - startTime
         memoryFootprint = model.get_memory_footprint()
         bufferMemorySize = memoryFootprint - model.get_memory_footprint(return_buffers=False)
         logMessage = f'Loaded model and tokenizer in {elapsedTime:.3f} seconds'
         logMessage = logMessage + f' memory footprint  {memoryFootprint / 1073741824.0:.3f}GB'
         logMessage = logMessage + f' buffers {bufferMemorySize / 1073741824.0:.3f}GB'
-        logMessage = logMessage + f' max CUDA memory {torch.cuda.max_memory_allocated() / 1073741824.0:.3f}GB'
+        if (torch.cuda.is_available()):
+            logMessage = logMessage + f' max CUDA memory {torch.cuda.max_memory_allocated() / 1073741824.0:.3f}GB'
         Globals().logMessage(logMessage)
 
-    def ggufLoader(self):
-        modelParms = {}
-        modelParms['model_type'] = 'llama'
-        #modelParms['model_file'] = self._modelPath
-        model = GGUFAutoModelForCausalLM.from_pretrained(self._modelPath, **modelParms)
-        Globals().logMessage('GGUF model loaded')
+    # Predict the memory the model needs on each device and where its layers will be placed, without loading any weights
+    def dryRun(self):
+        Globals().logMessage(f'Estimating memory for {self._modelPath}')
+        startTime = time.time()
+        estimator = MemoryEstimator(self._profile)
+        try:
+            estimate = estimator.estimate()
+        except (OSError, ValueError, KeyError) as err:
+            Globals().logMessage(f'Unable to estimate model memory: {err}')
+            return
+        for line in estimator.getReport(estimate):
+            Globals().logMessage(line)
+        elapsedTime = time.time() - startTime
+        Globals().logMessage(f'Completed memory estimate in {elapsedTime:.3f} seconds')
+
+    # Load the small draft model used for speculative decoding. The draft model proposes tokens which the main model verifies in a single
+    # forward pass, so it must use the same vocabulary as the main model. It is placed on the device the main model receives its inputs on.
+    def draftLoader(self, model, tokenizer):
+        import torch
+        from transformers import AutoModelForCausalLM
+        from transformers import AutoTokenizer
+        Globals().logMessage(f'Loading draft model {self._draftModelPath}')
+        startTime = time.time()
+        draftTokenizer = AutoTokenizer.from_pretrained(self._draftModelPath, trust_remote_code=self._trustRemoteCode)
+        if (not draftTokenizer.get_vocab() == tokenizer.get_vocab()):
+            Globals().logMessage('Unable to use draft model, its vocabulary is different from the model vocabulary')
+            return
+        params = {}
+        params['trust_remote_code'] = self._trustRemoteCode
+        params['low_cpu_mem_usage'] = True
+        params['torch_dtype'] = model.dtype
+        draftModel = AutoModelForCausalLM.from_pretrained(self._draftModelPath, **params)
+        draftModel.to(model.device)
+        if (self._cpuOptimized and (self._cpuPrecision == 'int8')):
+            draftModel = torch.ao.quantization.quantize_dynamic(draftModel, {torch.nn.Linear}, dtype=torch.qint8)
+        draftModel.eval()
+        self.getSession().setDraftModel(draftModel)
+        elapsedTime = time.time() - startTime
+        Globals().logMessage(f'Loaded draft model in {elapsedTime:.3f} seconds, memory footprint '
+                             f'{draftModel.get_memory_footprint() / 1073741824.0:.3f}GB')
+
+    # Estimate the memory in bytes needed by the model from the size of its weight files. Returns None if the model path does not exist.
+    def estimateModelMemory(self):
+        if (os.path.isfile(self._modelPath)):
+            return os.path.getsize(self._modelPath)
+        if (not os.path.isdir(self._modelPath)):
+            return None
+        memory = 0
+        for f in os.listdir(self._modelPath):
+            if (f.endswith(('.safetensors', '.bin', '.pt', '.gguf'))):
+                memory = memory + os.path.getsize(os.path.join(self._modelPath, f))
+        # Weights quantized while loading take about a half or a quarter of the memory of the 16-bit weights normally distributed
+        if (self._use8Bit):
+            memory = memory // 2
+        elif (self._use4Bit):
+            memory = memory // 4
+        if (os.path.isdir(self._draftModelPath)):
+            for f in os.listdir(self._draftModelPath):
+                if (f.endswith(('.safetensors', '.bin'))):
+                    memory = memory + os.path.getsize(os.path.join(self._draftModelPath, f))
+        return memory
+
+    # Run a short generation with a typical query prompt so lazy memory allocation, kernel selection and tokenizer caches are done before
+    # the first query. If compilation is enabled, the model's forward function is compiled first so graph capture and kernel autotuning
+    # are also done here. The generation is then repeated with the warmed up model to estimate how much the first query was sped up.
+    def warmUp(self, modelLoader):
+        import torch
+        from langchain.chains.question_answering.stuff_prompt import PROMPT as STUFF_PROMPT
+        session = self.getSession()
+        model = session.getModel()
+        uncompiledForward = None
+        prompt = STUFF_PROMPT.format(context=self.WARM_UP_CONTEXT, question=self.WARM_UP_QUESTION)
+        if (modelLoader == self.llamaCppLoader):
+            def generate():
+                model.client.reset()
+                model.client(prompt, max_tokens=self.WARM_UP_TOKENS, temperature=0.0)
+        else:
+            tokenizer = session.getTokenizer()
+            inputs = tokenizer(prompt, return_tensors='pt').to(model.device)
+            params = {}
+            params['max_new_tokens'] = self.WARM_UP_TOKENS
+            params['do_sample'] = False
+            params['pad_token_id'] = tokenizer.eos_token_id
+            if (session.getDraftModel() is not None):
+                params['assistant_model'] = session.getDraftModel()
+            def generate():
+                with torch.no_grad():
+                    model.generate(**inputs, **params)
+            # Compilation is only supported for models loaded by transformers and is not supported on Windows by this version of PyTorch
+            if (self._compileModel):
+                if ((modelLoader in (self.standardLoader, self.cpuLoader)) and (not platform.system() == 'Windows')):
+                    uncompiledForward = model.forward
+                    model.forward = torch.compile(uncompiledForward, dynamic=True)
+                else:
+                    Globals().logMessage('Model compilation is not supported for this model')
+        Globals().logMessage('Warming up model')
+        startTime = time.time()
+        # A failed warm-up leaves the model usable, uncompiled if compilation was tried
+        try:
+            try:
+                generate()
+            except Exception as err:
+                if (uncompiledForward is None):
+                    raise
+                # Fall back to the uncompiled model if compilation fails
+                Globals().logMessage(f'Unable to compile model, using uncompiled model: {err}')
+                model.forward = uncompiledForward
+                uncompiledForward = None
+                startTime = time.time()
+                generate()
+            warmUpTime = time.time() - startTime
+            startTime = time.time()
+            generate()
+            warmTime = time.time() - startTime
+        except Exception as err:
+            if (uncompiledForward is not None):
+                model.forward = uncompiledForward
+            Globals().logMessage(f'Warm-up failed: {err}')
+            return
+        Globals().logMessage(f'Warm-up completed in {warmUpTime:.3f} seconds, warm generation took {warmTime:.3f} seconds, saving about '
+                             f'{max(0.0, warmUpTime - warmTime):.3f} seconds on the first query')
+
+    # Set whether the request only estimates the memory needed by the model instead of loading it
+    def setDryRun(self, dryRun):
+        self._dryRun = dryRun
 
     # Set the model loading parameters for this request                                                 
     def setModelParameters(self, profile):
+        self._profile = profile
         self._modelPath = profile['modelPath']
         self._overflowPath = profile['overflowPath']
         self._autoDevice = profile['autoDevice']
@@ -268,44 +528,108 @@ class LoadModelRequest(Request):
         self._useTriton = profile['useTriton']
         self._wbits = profile['wBits']
         self._groupSize = profile['groupSize']
+        self._cacheQuantized = profile.get('cacheQuantized', False)
+        self._cpuOptimized = profile.get('cpuOptimized', False)
+        self._cpuThreads = profile.get('cpuThreads', 0)
+        self._cpuPrecision = profile.get('cpuPrecision', 'bfloat16')
+        self._useMmap = profile.get('useMmap', True)
+        self._useMlock = profile.get('useMlock', False)
+        self._contextSize = profile.get('contextSize', 2048)
+        self._batchSize = profile.get('batchSize', 512)
+        self._gpuLayers = profile.get('gpuLayers', 0)
+        self._draftModelPath = profile.get('draftModelPath', '')
+        self._warmUp = profile.get('warmUp', False)
+        self._compileModel = profile.get('compileModel', False)
 
 
-    # Process a request to load a LLM model
-    def processRequest(self):
-        # Look at https://github.com/pinecone-io/examples/blob/master/generation/llm-field-guide/mpt-7b/mpt-7b-huggingface-langchain.ipynb
-        # for setting up stopping criteria for text generation
-        
-        Globals().logMessage('Initializing model')
-        # Recover storage fromn previously loaded model and tokenizer
-        model = Globals().getModel()
-        if (not model == None):
-            del model
-        Globals().setModel(None)
-        gc.collect()
-        torch.cuda.empty_cache()
-        tokenizer = Globals().getTokenizer()
-        if (not tokenizer == None):
-            del tokenizer
-        Globals().setTokenizer(None)
+    # Switch the session to the resident model loaded with this request's profile, or load the model, evicting resident models as needed
+    # to stay within the memory budget, and add it to the model cache
+    def loadModel(self, session, sessionManager):
+        import torch
+        modelCache = sessionManager.getModelCache()
+        startTime = time.time()
+        residentModel = modelCache.findModel(self._profile)
+        if (residentModel is not None):
+            session.setModel(residentModel[0])
+            session.setTokenizer(residentModel[1])
+            session.setDraftModel(residentModel[2])
+            elapsedTime = time.time() - startTime
+            Globals().logMessage(f'Switched to resident model in {elapsedTime:.3f} seconds')
+            return
+
+        # Evict least recently used models until this model fits in the memory budget shared by all sessions
+        modelMemory = self.estimateModelMemory()
+        if (modelMemory is None):
+            Globals().logMessage(f'Unable to load model, {self._modelPath} is not a model file or directory')
+            return
+        evictedCount = sessionManager.makeRoomForModel(modelMemory)
+        if (evictedCount is None):
+            Globals().logMessage(f'Unable to load model, it needs about {modelMemory / 1073741824.0:.3f}GB and '
+                                 f'{sessionManager.getMemoryUsage() / 1073741824.0:.3f}GB of the '
+                                 f'{sessionManager.getMemoryBudget() / 1073741824.0:.3f}GB memory budget is used by models and indexes in use')
+            return
+        if (evictedCount > 0):
+            Globals().logMessage(f'Evicted {evictedCount} least recently used models')
+        # Recover storage from evicted models
         gc.collect()
-        torch.cuda.empty_cache()
+        if (torch.cuda.is_available()):
+            torch.cuda.empty_cache()
 
         # Load model based on model type
-        if ('GPTQ' in self._modelPath):
+        if (self._cpuOptimized and os.path.exists(os.path.join(self._modelPath, 'config.json'))):
+            modelLoader = self.cpuLoader
+        elif ('GPTQ' in self._modelPath):
             modelLoader = self.gptqLoader
         elif ('gptq' in self._modelPath):
             modelLoader = self.gptqLoader
-        elif ('ggmlv3' in self._modelPath):
+        elif ('ggml' in self._modelPath):
             modelLoader = self.llamaCppLoader
         elif ('gguf' in self._modelPath):
-            modelLoader = self.ggufLoader
+            modelLoader = self.llamaCppLoader
         elif ('GGUF' in self._modelPath):
-            modelLoader = self.ggufLoader
+            modelLoader = self.llamaCppLoader
         elif (os.path.exists(os.path.join(self._modelPath, 'config.json'))):
             modelLoader = self.standardLoader
         else:
             Globals().logMessage(f'Unable to load model, unknown model type:, {self._modelPath}')
             return
         modelLoader()
-        return
-    
+        # Speculative decoding is done by HuggingFace generation, so a draft model is only used with models in HuggingFace format
+        if ((len(self._draftModelPath) > 0) and (session.getModel() is not None)):
+            if (modelLoader in (self.standardLoader, self.cpuLoader)):
+                self.draftLoader(session.getModel(), session.getTokenizer())
+            else:
+                Globals().logMessage('Draft model ignored, speculative decoding is only supported for models in HuggingFace format')
+        if (self._warmUp and (session.getModel() is not None)):
+            self.warmUp(modelLoader)
+        if (session.getModel() is not None):
+            residentModel = modelCache.addModel(self._profile, session.getModel(), session.getTokenizer(), session.getModelMemoryUsage(),
+                                                session.getDraftModel())
+            if (residentModel[0] is not session.getModel()):
+                Globals().logMessage('Model with the same profile is already resident, using the resident model')
+                session.setModel(residentModel[0])
+                session.setTokenizer(residentModel[1])
+                session.setDraftModel(residentModel[2])
+
+    def isProfilable(self):
+        return True
+
+    # Process a request to load a LLM model
+    def processRequest(self):
+        # Look at https://github.com/pinecone-io/examples/blob/master/generation/llm-field-guide/mpt-7b/mpt-7b-huggingface-langchain.ipynb
+        # for setting up stopping criteria for text generation
+        if (self._dryRun):
+            self.dryRun()
+            return
+        Globals().logMessage('Initializing model')
+        # Release this session's reference to its current model. The model stays resident in the model cache until it is evicted, so
+        # switching back to it does not reload it.
+        session = self.getSession()
+        session.setModel(None)
+        session.setDraftModel(None)
+        session.setTokenizer(None)
+        # Model loads in all sessions are serialized, from finding a resident model through adding the loaded model to the model cache,
+        # so loads in different sessions can not together exceed the memory budget or load the same model profile twice
+        sessionManager = Globals().getSessionManager()
+        with sessionManager.getLoadLock():
+            self.loadModel(session, sessionManager)
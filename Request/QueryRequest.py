@@ -6,43 +6,189 @@
 # Copyright 2024 David Wootton
 
 import gc
-from langchain.chains import RetrievalQA
-from langchain.chains.question_answering import load_qa_chain
-from langchain.prompts import PromptTemplate
-from langchain.schema import LLMResult
-from langchain_community.llms import HuggingFacePipeline
-from langchain_community.llms import LlamaCpp
-from langchain_community.vectorstores import FAISS
 from Request.Request import Request
 from threading import Thread
-from transformers import pipeline
-from transformers import StoppingCriteria
-from transformers import StoppingCriteriaList
-from transformers import TextIteratorStreamer
+from Request.LoadDocumentsRequest import LoadDocumentsRequest
 from Util.Globals import Globals
 import queue
 import time
-import torch
+import uuid
 
-# This class is used to request a model stop generating output tokens
-class QueryStop(StoppingCriteria):
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        if (Globals().getQueryStop()):
+# This class is used to request a model stop generating output tokens when its query is stopped. Stopping criteria only need to be
+# callable, so this does not subclass transformers StoppingCriteria, which would import transformers with this module.
+class QueryStop():
+    def __init__(self, request):
+        self._request = request
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if (self._request.isStopped()):
             return True
         return False
 
-# Handle a request to query a set of documents
+# This class counts a model's forward passes, used to measure how many of the tokens proposed by a draft model are accepted
+class ForwardCounter():
+    def __init__(self):
+        self._count = 0
+
+    def __call__(self, module, args):
+        self._count = self._count + 1
+
+    def getCount(self):
+        return self._count
+
+# Handle a request to query a set of documents. Each query has a request id, and while it runs it is registered with its session so it can be
+# stopped by request id, or with the other queries in the session.
 class QueryRequest(Request):
+    # Text the model generates when it starts to ask and answer its own questions
+    LLAMA_STOP_SEQUENCES = ['\nQuestion:', '\nHelpful Answer:']
+    # An answer ending in the same text of at least REPEAT_MIN_LENGTH characters repeated REPEAT_COUNT times within the last REPEAT_WINDOW
+    # characters is cut short
+    REPEAT_MIN_LENGTH = 16
+    REPEAT_COUNT = 3
+    REPEAT_WINDOW = 1024
+
     def __init__(self):
         super().__init__()
+        self._answerHandler = None
+        self._answer = []
+        self._matchIds = []
+        self._matchSources = []
+        self._filters = None
+        self._requestId = uuid.uuid4().hex
+        self._stopped = False
+        self._timings = {}
+        self._decodeRate = None
+        self._acceptanceRate = None
+
+    # Build the question answering prompt from the document matches. Matches are dropped, least similar first, until the prompt leaves
+    # room in the model's context for the answer, and the ids of the chunks actually used are kept. Returns the prompt and its length in
+    # tokens.
+    def buildLlamaCppPrompt(self, model, results):
+        from langchain.chains.question_answering.stuff_prompt import PROMPT as STUFF_PROMPT
+        contextSize = model.client.n_ctx()
+        answerTokens = min(self._maxNewTokens, contextSize // 2)
+        while (True):
+            context = '\n\n'.join([document.page_content for document in results])
+            prompt = STUFF_PROMPT.format(context=context, question=self._query)
+            promptTokens = len(model.client.tokenize(prompt.encode('utf-8')))
+            if ((promptTokens + answerTokens <= contextSize) or (len(results) <= 1)):
+                break
+            results = results[:-1]
+        self._matchIds = self._matchIds[:len(results)]
+        self._matchSources = self._matchSources[:len(results)]
+        if (promptTokens + answerTokens > contextSize):
+            # A single match is too long for the context, so keep the start of its text that fits
+            tokens = model.client.tokenize(context.encode('utf-8'), add_bos=False)
+            excess = promptTokens + answerTokens - contextSize
+            context = model.client.detokenize(tokens[:max(0, len(tokens) - excess)]).decode('utf-8', errors='ignore')
+            prompt = STUFF_PROMPT.format(context=context, question=self._query)
+            promptTokens = len(model.client.tokenize(prompt.encode('utf-8')))
+            Globals().logMessage(f'Document match truncated by {excess} tokens to fit in the {contextSize} token context')
+        if (len(results) < self._numMatches):
+            Globals().logMessage(f'Using {len(results)} document matches to fit in the {contextSize} token context')
+        return prompt, promptTokens
+
+    # Expand a small to big window matching the query to its surrounding context in its document's text, about the context size set when
+    # the index was built, without cutting words at either end. Other matches are returned unchanged.
+    def expandMatch(self, store, document):
+        from langchain_core.documents import Document
+        textId = document.metadata.get('textId')
+        if (textId is None):
+            return document
+        documentText = store.docstore.search(textId)
+        text = documentText.page_content
+        start = document.metadata['start_index']
+        end = document.metadata['end_index']
+        margin = max(0, documentText.metadata['contextSize'] - (end - start)) // 2
+        contextStart = max(0, start - margin)
+        contextEnd = min(len(text), end + margin)
+        if (contextStart > 0):
+            space = text.find(' ', contextStart, start)
+            if (space >= 0):
+                contextStart = space + 1
+        if (contextEnd < len(text)):
+            space = text.rfind(' ', end, contextEnd)
+            if (space >= 0):
+                contextEnd = space
+        return Document(page_content=text[contextStart:contextEnd], metadata=document.metadata)
+
+    # Get the answer text, the docstore ids and sources of the chunks used to answer the query and the elapsed time in seconds for each query
+    # stage. Each source is the document name and, for PDFs and CSV row windows, the page or row the chunk starts on, counting from 0, and
+    # the locations of any duplicates of the chunk removed when the index was built.
+    def getResult(self):
+        result = {}
+        result['answer'] = ''.join(self._answer)
+        result['chunkIds'] = self._matchIds
+        result['sources'] = self._matchSources
+        result['timings'] = self._timings
+        if (self._decodeRate is not None):
+            result['decodeTokensPerSecond'] = self._decodeRate
+        if (self._acceptanceRate is not None):
+            result['draftAcceptanceRate'] = self._acceptanceRate
+        return result
+
+    def getRequestId(self):
+        return self._requestId
+
+    # Check whether the end of the answer is the same text repeated several times, which means the model is stuck in a loop and further
+    # tokens are wasted. Only the end of the answer is checked, and only repeat lengths where the last REPEAT_MIN_LENGTH characters occur
+    # again, so the check takes about the same time however long the answer is. Text made of a single character, such as a line of dashes
+    # in a table, is not a loop.
+    def isRepeating(self, text):
+        window = text[-self.REPEAT_WINDOW:]
+        key = window[-self.REPEAT_MIN_LENGTH:]
+        position = window.rfind(key, 0, len(window) - 1)
+        while (position >= 0):
+            period = len(window) - self.REPEAT_MIN_LENGTH - position
+            if (period * self.REPEAT_COUNT > len(window)):
+                break
+            tail = window[-period:]
+            if ((period >= self.REPEAT_MIN_LENGTH) and (len(set(''.join(tail.split()))) >= 2) and
+                (all(window[-(n + 1) * period:-n * period] == tail for n in range(1, self.REPEAT_COUNT)))):
+                return True
+            position = window.rfind(key, 0, position + self.REPEAT_MIN_LENGTH - 1)
+        return False
+
+    def isStopped(self):
+        return self._stopped
+
+    # Log the prompt evaluation and generation rates measured by llama.cpp for the last query
+    def logLlamaCppTimings(self, model):
+        import llama_cpp
+        timings = llama_cpp.llama_get_timings(model.client._ctx.ctx)
+        self._timings['promptEval'] = timings.t_p_eval_ms / 1000.0
+        self._timings['eval'] = timings.t_eval_ms / 1000.0
+        promptRate = timings.n_p_eval * 1000.0 / timings.t_p_eval_ms if (timings.t_p_eval_ms > 0) else 0.0
+        if (timings.t_eval_ms > 0):
+            self._decodeRate = timings.n_eval * 1000.0 / timings.t_eval_ms
+        Globals().logMessage(f'Prompt evaluation {timings.n_p_eval} tokens in {self._timings["promptEval"]:.3f} seconds, '
+                             f'{promptRate:.2f} tokens/sec, generation {timings.n_eval} tokens in {self._timings["eval"]:.3f} seconds, '
+                             f'{self._decodeRate if (self._decodeRate is not None) else 0.0:.2f} tokens/sec')
+
+    # Send answer text to the answer handler, or to the output window if no handler is set
+    def postAnswer(self, text):
+        self._answer.append(text)
+        if (self._answerHandler is None):
+            Globals().postAnswer(text)
+        else:
+            self._answerHandler(text)
+
+    def isProfilable(self):
+        return True
 
     # Process a request to query documents
     def processRequest(self):
-        self._documentStore = Globals().getDocumentStore()
+        from langchain_community.llms import LlamaCpp
+        from transformers import TextIteratorStreamer
+        self._documentStore = self.getSession().getDocumentStore()
         if (self._documentStore is None):
             Globals().logMessage('No documents loaded')
             return
-        tokenizer = Globals().getTokenizer()
+        if (self.isStopped()):
+            Globals().logMessage('Query stopped before it started')
+            return
+        queryStartTime = time.time()
+        tokenizer = self.getSession().getTokenizer()
         streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, timeout=10.0)
         # Set up request parameters
         params = {}
@@ -63,30 +209,53 @@ class QueryRequest(Request):
         params['streamer'] = streamer
 
         # Display the query in the output window
-        Globals().postAnswer(f'\n{self._query}\n')
+        if (self._answerHandler is None):
+            Globals().postAnswer(f'\n{self._query}\n')
 
         # Set up the pipeline
-        model = Globals().getModel()
-        if (isinstance(model, LlamaCpp)):
-            self.runLlamaCppQuery()
-        else:
-            self.runHuggingFaceQuery(params)
+        model = self.getSession().getModel()
+        self.getSession().addQuery(self)
+        try:
+            if (isinstance(model, LlamaCpp)):
+                self.runLlamaCppQuery()
+            else:
+                self.runHuggingFaceQuery(params)
+        finally:
+            self.getSession().removeQuery(self)
+        self._timings['total'] = time.time() - queryStartTime
 
     # Issue a query to a model in HuggingFace format
     def runHuggingFaceQuery(self, params):
-        
-        queryStop = StoppingCriteriaList([QueryStop()])
-        Globals().setStopQuery(False)
+        import torch
+        from langchain.chains.question_answering import load_qa_chain
+        from langchain_community.llms import HuggingFacePipeline
+        from transformers import pipeline
+        from transformers import StoppingCriteriaList
+        session = self.getSession()
+        queryStop = StoppingCriteriaList([QueryStop(self)])
+        # If the model has a draft model, use speculative decoding, where the draft model proposes tokens which the model verifies. The
+        # forward passes of both models are counted to measure how many proposed tokens are accepted.
+        model = session.getModel()
+        draftModel = session.getDraftModel()
+        hooks = []
+        if ((draftModel is not None) and (self._beamCount > 1)):
+            Globals().logMessage('Draft model not used, speculative decoding does not support beam search')
+        elif (draftModel is not None):
+            params['assistant_model'] = draftModel
+            modelCounter = ForwardCounter()
+            draftCounter = ForwardCounter()
+            hooks.append(model.register_forward_pre_hook(modelCounter))
+            hooks.append(draftModel.register_forward_pre_hook(draftCounter))
         # Create the pipeline to process the request
-        pipe = pipeline('text-generation', model=Globals().getModel(), tokenizer=Globals().getTokenizer(), stopping_criteria=queryStop,
-                        **params)
+        pipe = pipeline('text-generation', model=model, tokenizer=session.getTokenizer(), stopping_criteria=queryStop, **params)
         hfPipeline = HuggingFacePipeline(pipeline=pipe)
         chain = load_qa_chain(hfPipeline, chain_type='stuff')
         Globals().logMessage('Starting similarity search')
         # Run a similarity search agains the FAISS vector store to find document fragments to use to query the model
         startTime = time.time()
-        results = self._documentStore.similarity_search(self._query, k=self._numMatches)
+        results = self.similaritySearch()
         elapsedTime = time.time() - startTime
+        self._timings['search'] = elapsedTime
         Globals().logMessage(f'Completed similarity search in {elapsedTime:.3f} seconds')
 
         Globals().logMessage('Starting query')
@@ -94,20 +263,44 @@ class QueryRequest(Request):
         chainArgs = dict(input_documents=results, question=self._query)
 
         gc.collect()
-        torch.cuda.empty_cache()
+        if (torch.cuda.is_available()):
+            torch.cuda.empty_cache()
         thread = Thread(target=chain.run, kwargs=chainArgs)
         thread.start()
+        firstTokenTime = None
         try:
             for newText in params['streamer']:
-                Globals().postAnswer(newText)
+                if (firstTokenTime is None):
+                    firstTokenTime = time.time()
+                self.postAnswer(newText)
                 #if ((not newText == None) and (tokenizer.eos_token in newText)):
                 #    break
         except queue.Empty:
             pass
         thread.join()
-        elapsedTime = time.time() - startTime
-        Globals().postAnswer('\n\n')
-        Globals().logMessage(f'Completed query in {elapsedTime:.3f} seconds')
+        endTime = time.time()
+        elapsedTime = endTime - startTime
+        self._timings['generate'] = elapsedTime
+        if (self._answerHandler is None):
+            Globals().postAnswer('\n\n')
+        logMessage = f'Completed query in {elapsedTime:.3f} seconds'
+        # Report the decode rate, excluding the prompt processing time before the first token, so model configurations can be compared
+        if (firstTokenTime is not None):
+            self._timings['firstToken'] = firstTokenTime - startTime
+            tokenCount = len(session.getTokenizer().encode(''.join(self._answer), add_special_tokens=False))
+            if ((tokenCount > 1) and (endTime > firstTokenTime)):
+                self._decodeRate = (tokenCount - 1) / (endTime - firstTokenTime)
+                logMessage = logMessage + f', first token in {self._timings["firstToken"]:.3f} seconds, {self._decodeRate:.2f} tokens/sec'
+            # Each verifying forward pass of the model produces one token of its own plus the draft tokens it accepted
+            if ((len(hooks) > 0) and (draftCounter.getCount() > 0)):
+                acceptedCount = max(0, tokenCount - modelCounter.getCount())
+                self._acceptanceRate = min(1.0, acceptedCount / draftCounter.getCount())
+                logMessage = logMessage + (f', draft acceptance rate {self._acceptanceRate:.2f} ({acceptedCount} of {draftCounter.getCount()} '
+                                           f'tokens) with {modelCounter.getCount()} model passes, effective '
+                                           f'{tokenCount / elapsedTime:.2f} tokens/sec')
+        for hook in hooks:
+            hook.remove()
+        Globals().logMessage(logMessage)
         del chain
         chain = None
         del hfPipeline
@@ -115,35 +308,72 @@ class QueryRequest(Request):
         del pipe
         pipe = None
         gc.collect()
-        torch.cuda.empty_cache()
+        if (torch.cuda.is_available()):
+            torch.cuda.empty_cache()
 
-    # Run a document query against a LlamaCPP format model
+    # Run a document query against a LlamaCPP format model. The prompt is built from the document matches the same way as the question
+    # answering chain used for HuggingFace models, then tokens are streamed directly from llama.cpp so the query can be stopped between
+    # tokens and generation can be cut short when the model starts a new question or repeats itself.
     def runLlamaCppQuery(self):
-        model = Globals().getModel()
+        import llama_cpp
+        session = self.getSession()
+        model = session.getModel()
+        Globals().logMessage('Starting similarity search')
+        startTime = time.time()
+        results = self.similaritySearch()
+        elapsedTime = time.time() - startTime
+        self._timings['search'] = elapsedTime
+        Globals().logMessage(f'Completed similarity search in {elapsedTime:.3f} seconds')
+
+        prompt, promptTokens = self.buildLlamaCppPrompt(model, results)
         params = {}
-        params['max_tokens'] = self._maxNewTokens
+        params['max_tokens'] = min(self._maxNewTokens, model.client.n_ctx() - promptTokens)
         params['repeat_penalty'] = self._repetitionPenalty
-        params['temperature'] = self._temperature
         params['top_k'] = self._topK
-        params['top_p'] = self._topP 
-        params['verbose'] = True
-        params['n_ctx'] = self._maxNewTokens
-        queryStop = StoppingCriteriaList([QueryStop()])
-        Globals().setStopQuery(False)
-        startTime = time.time()
+        params['top_p'] = self._topP
+        params['typical_p'] = self._typicalP
+        # llama.cpp samples greedily when the temperature is zero
+        params['temperature'] = self._temperature if (self._doSample) else 0.0
+        params['stop'] = self.LLAMA_STOP_SEQUENCES
+        params['stopping_criteria'] = llama_cpp.StoppingCriteriaList([lambda inputIds, logits: self.isStopped()])
+        params['stream'] = True
+
         Globals().logMessage('Starting query')
-        chain = RetrievalQA.from_chain_type(llm=Globals().getModel(), chain_type='stuff', 
-                                            retriever=Globals().getDocumentStore().as_retriever(search_kwargs={'k': self._numMatches},
-                                                                                                kwargs=params))
-        result = chain.run(query=self._query)
-        del chain
-        chain = None
-        gc.collect()
-        torch.cuda.empty_cache()
+        startTime = time.time()
+        llama_cpp.llama_reset_timings(model.client._ctx.ctx)
+        firstTokenTime = None
+        answer = ''
+        stopReason = None
+        for chunk in model.client(prompt, **params):
+            if (firstTokenTime is None):
+                firstTokenTime = time.time()
+            text = chunk['choices'][0]['text']
+            self.postAnswer(text)
+            answer = answer + text
+            if (self.isStopped()):
+                stopReason = 'stopped'
+                break
+            if (self.isRepeating(answer)):
+                stopReason = 'repeating'
+                break
+            if (chunk['choices'][0]['finish_reason'] is not None):
+                stopReason = chunk['choices'][0]['finish_reason']
+        if (self._answerHandler is None):
+            Globals().postAnswer('\n\n')
+        elapsedTime = time.time() - startTime
+        self._timings['generate'] = elapsedTime
+        if (firstTokenTime is not None):
+            self._timings['firstToken'] = firstTokenTime - startTime
+        Globals().logMessage(f'Completed query in {elapsedTime:.3f} seconds, prompt {promptTokens} tokens, finished because {stopReason}')
+        self.logLlamaCppTimings(model)
 
-        endTime = time.time()
-        elapsedTime = endTime - startTime
-        Globals().logMessage(f'Completed query in {elapsedTime:.3f} seconds')
+    # Set a function to be called with each piece of answer text instead of sending answer text to the output window
+    def setAnswerHandler(self, handler):
+        self._answerHandler = handler
+
+    # Restrict the query to chunks whose metadata matches the filters, as described in MetadataIndex.getBitmap
+    def setFilters(self, filters):
+        self._filters = filters
 
     # Set up query parameters
     def setQueryParameters(self, query, profile, maxNewTokens, numMatches):
@@ -163,3 +393,44 @@ class QueryRequest(Request):
         self._earlyStopping = profile['earlyStop']
         self._doSample = profile['doSample']
         self._numMatches = numMatches
+
+    # Set the request id used to stop the query, replacing the generated id
+    def setRequestId(self, requestId):
+        self._requestId = requestId
+
+    # Run a similarity search against the FAISS vector store, recording the docstore ids of the matching document chunks. This is the
+    # search done by FAISS.similarity_search, which does not return the chunk ids. If the query has filters, a bitmap of the chunks matching
+    # the filters is passed to the search as an ID selector, so only those chunks are searched and the number of matches is not reduced by
+    # discarding results afterwards.
+    def similaritySearch(self):
+        import faiss
+        import numpy
+        store = self._documentStore
+        results = []
+        self._matchIds = []
+        self._matchSources = []
+        params = None
+        if (self._filters):
+            bitmap, selectedCount = self.getSession().getMetadataIndex().getBitmap(self._filters)
+            Globals().logMessage(f'{selectedCount} of {store.index.ntotal} document chunks match the filters')
+            if (selectedCount == 0):
+                return results
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+        vector = numpy.array([store._embed_query(self._query)], dtype=numpy.float32)
+        if (store._normalize_L2):
+            faiss.normalize_L2(vector)
+        scores, indices = store.index.search(vector, self._numMatches, params=params)
+        for i in indices[0]:
+            if (i == -1):
+                continue
+            docId = store.index_to_docstore_id[i]
+            document = self.expandMatch(store, store.docstore.search(docId))
+            self._matchIds.append(docId)
+            keys = LoadDocumentsRequest.LOCATION_KEYS + ('duplicates',)
+            self._matchSources.append({key: document.metadata[key] for key in keys if (key in document.metadata)})
+            results.append(document)
+        return results
+
+    # Stop the query. A running query stops at its next token and a query which has not started yet is not run.
+    def stop(self):
+        self._stopped = True
@@ -5,11 +5,27 @@
 #
 # Copyright 2024 David Wootton
 
-# Generic base class for background requests
+from Util.Globals import Globals
+
+# Generic base class for background requests. Each request operates on a session, which is the default session unless another session is
+# set with setSession.
 class Request():
     
     def __init__(self):
-        pass
+        self._session = None
+
+    def getSession(self):
+        if (self._session is None):
+            self._session = Globals().getDefaultSession()
+        return self._session
     
+    # Indicate whether the worker thread may run this request under the profiler. Only requests which load documents or models or run
+    # queries are profiled.
+    def isProfilable(self):
+        return False
+
     def processRequest(self):
         print("Subclass is missing processRequest Function")
+
+    def setSession(self, session):
+        self._session = session
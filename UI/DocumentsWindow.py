@@ -5,13 +5,13 @@
 #
 # Copyright 2024 David Wootton
 
+import os
 import pathlib
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 from PySide6.QtCore import QFileInfo
 from PySide6.QtCore import QSettings
 from PySide6.QtCore import Qt
 from PySide6.QtCore import Slot
+from PySide6.QtWidgets import QComboBox
 from PySide6.QtWidgets import QFileDialog
 from PySide6.QtWidgets import QFrame
 from PySide6.QtWidgets import QGridLayout
@@ -24,7 +24,10 @@ from PySide6.QtWidgets import QSpacerItem
 from PySide6.QtWidgets import QTableWidget
 from PySide6.QtWidgets import QTableWidgetItem
 from Request.LoadDocumentsRequest import LoadDocumentsRequest
+from Request.LoadIndexRequest import LoadIndexRequest
+from Util.Embeddings import EMBEDDING_FORMATS
 from Util.Globals import  Globals
+from Widgets.XCheckBox import XCheckBox
 from Widgets.XLineEdit import XLineEdit
 from Widgets.XHSlider import XHSlider
 from pathlib import Path
@@ -91,6 +94,31 @@ class DocumentsWindow(QFrame):
         layout.addWidget(self._overlapSlider, row, 1, 1, 2)
         row = row + 1
 
+        label = QLabel('Chunk units', self)
+        layout.addWidget(label, row, 0)
+        self._chunkUnitsWidget = QComboBox(self)
+        self._chunkUnitsWidget.addItems(['Characters', 'Tokens'])
+        self._chunkUnitsWidget.setToolTip('Select whether chunk size and overlap are counted in characters or sentence transformer tokens')
+        self._chunkUnitsWidget.setCurrentIndex(int(QSettings().value('DocumentsWindow.ChunkUnits', 0)))
+        self._chunkUnitsWidget.currentIndexChanged.connect(lambda index: QSettings().setValue('DocumentsWindow.ChunkUnits', index))
+        layout.addWidget(self._chunkUnitsWidget, row, 1)
+        self._snapSentencesWidget = XCheckBox('Snap to sentences', self, 'Document.snapSentences')
+        self._snapSentencesWidget.setToolTip('End token chunks at a sentence boundary where possible')
+        layout.addWidget(self._snapSentencesWidget, row, 2)
+        row = row + 1
+
+        self._smallToBigWidget = XCheckBox('Small to big', self, 'Document.smallToBig')
+        self._smallToBigWidget.setToolTip('Index small chunks without overlap and expand matching chunks to the context size when querying')
+        layout.addWidget(self._smallToBigWidget, row, 1)
+        row = row + 1
+
+        label = QLabel('Context size', self)
+        layout.addWidget(label, row, 0)
+        self._contextSizeSlider = XHSlider(self, 100, 8000, 100, 'Specify characters of context a matching small to big chunk is expanded to',
+                                           'Document.contextSize')
+        layout.addWidget(self._contextSizeSlider, row, 1, 1, 2)
+        row = row + 1
+
         label = QLabel('Sentence transformer', self)
         layout.addWidget(label, row, 0)
         self._sentenceTransformerWidget = XLineEdit(self, 'Document.sentenceTransformer')
@@ -102,6 +130,53 @@ class DocumentsWindow(QFrame):
         transformerBrowseButton.clicked.connect(self.onTransformerBrowseButtonClicked)
         row = row + 1
 
+        label = QLabel('Embedding format', self)
+        layout.addWidget(label, row, 0)
+        self._embeddingFormatWidget = QComboBox(self)
+        self._embeddingFormatWidget.addItems(['PyTorch', 'ONNX', 'ONNX int8'])
+        self._embeddingFormatWidget.setToolTip('Select how the sentence transformer is run, ONNX formats are faster on a CPU')
+        self._embeddingFormatWidget.setCurrentIndex(int(QSettings().value('DocumentsWindow.EmbeddingFormat', 0)))
+        self._embeddingFormatWidget.currentIndexChanged.connect(lambda index: QSettings().setValue('DocumentsWindow.EmbeddingFormat', index))
+        layout.addWidget(self._embeddingFormatWidget, row, 1)
+        row = row + 1
+
+        label = QLabel('Embedding workers', self)
+        layout.addWidget(label, row, 0)
+        self._embeddingWorkersSlider = XHSlider(self, 0, os.cpu_count(), 1,
+                                                'Specify number of processes embedding chunks on the CPU, 0 to embed chunks in the program',
+                                                'Document.embeddingWorkers')
+        layout.addWidget(self._embeddingWorkersSlider, row, 1, 1, 2)
+        row = row + 1
+
+        label = QLabel('PDF workers', self)
+        layout.addWidget(label, row, 0)
+        self._parseWorkersSlider = XHSlider(self, 0, os.cpu_count(), 1,
+                                            'Specify number of processes extracting pages of large PDFs, 0 to extract pages in the program',
+                                            'Document.parseWorkers')
+        layout.addWidget(self._parseWorkersSlider, row, 1, 1, 2)
+        row = row + 1
+
+        label = QLabel('CSV rows per chunk', self)
+        layout.addWidget(label, row, 0)
+        self._csvRowsSlider = XHSlider(self, 0, 500, 10,
+                                       'Specify number of CSV rows in each chunk to stream CSV files, 0 to split them like other documents',
+                                       'Document.csvRows')
+        layout.addWidget(self._csvRowsSlider, row, 1, 1, 2)
+        row = row + 1
+
+        self._deduplicateWidget = XCheckBox('Remove duplicate chunks', self, 'Document.deduplicate')
+        self._deduplicateWidget.setToolTip('Embed and store identical or near identical chunks only once')
+        layout.addWidget(self._deduplicateWidget, row, 1)
+        row = row + 1
+
+        label = QLabel('Near duplicate similarity(%)', self)
+        layout.addWidget(label, row, 0)
+        self._nearDuplicateSlider = XHSlider(self, 50, 100, 5,
+                                             'Specify how similar chunks must be to be near duplicates, 100 to only remove exact duplicates',
+                                             'Document.nearDuplicateSimilarity')
+        layout.addWidget(self._nearDuplicateSlider, row, 1, 1, 2)
+        row = row + 1
+
         loadButton = QPushButton('Load Documents', self)
         loadButton.setToolTip('Load the documents')
         loadButton.clicked.connect(self.onLoadButtonClicked)
@@ -119,16 +194,15 @@ class DocumentsWindow(QFrame):
         documentPath = settings.value('DocumentsWindow.DocumentIndexPath', '/')
         selectedDirectory = QFileDialog.getExistingDirectory(self, 'Select the document index', documentPath)
         if (not selectedDirectory == ''):
-            transformerPath = settings.value('DocumentsWindow.SentenceTransformer', '')
-            if (not transformerPath == ''):
-                embeddings = HuggingFaceEmbeddings(model_name=transformerPath)
-            else:
-                embeddings = HuggingFaceEmbeddings()
             indexPath = Path(selectedDirectory)
             settings.setValue('DocumentsWindow.DocumentIndexPath', str(indexPath.parent))
             self._indexName.setText(indexPath.name)
-            vectorStore = FAISS.load_local(selectedDirectory, embeddings)
-            Globals().setDocumentStore(vectorStore)
+            # The index is loaded by the worker thread using the sentence transformer currently selected in this window
+            request = LoadIndexRequest()
+            request.setIndexParameters(selectedDirectory, self._sentenceTransformerWidget.text().strip())
+            request.setEmbeddingFormat(EMBEDDING_FORMATS[self._embeddingFormatWidget.currentIndex()])
+            workerThread = Globals.getWorkerThread(Globals())
+            workerThread.enqueue(request)
 
     # Handle request to add a selected document to the list of documents to load
     @Slot(bool)
@@ -192,6 +266,13 @@ class DocumentsWindow(QFrame):
         request = LoadDocumentsRequest()
         request.setDocumentList(documents, self._chunkSizeSlider.value(), self._overlapSlider.value(),
                                 self._sentenceTransformerWidget.text().strip())
+        request.setEmbeddingFormat(EMBEDDING_FORMATS[self._embeddingFormatWidget.currentIndex()])
+        request.setChunkUnits(['characters', 'tokens'][self._chunkUnitsWidget.currentIndex()], self._snapSentencesWidget.isChecked())
+        request.setSmallToBig(self._smallToBigWidget.isChecked(), self._contextSizeSlider.value())
+        request.setEmbeddingWorkers(self._embeddingWorkersSlider.value())
+        request.setParseWorkers(self._parseWorkersSlider.value())
+        request.setCsvRows(self._csvRowsSlider.value())
+        request.setDeduplication(self._deduplicateWidget.isChecked(), self._nearDuplicateSlider.value() / 100.0)
         workerThread = Globals.getWorkerThread(Globals())
         workerThread.enqueue(request)
         self._indexName.setText('')
@@ -209,7 +290,7 @@ class DocumentsWindow(QFrame):
     # Handle a request to save the FAISS index to disk
     @Slot(bool)
     def saveDocumentIndex(self, checked):
-        index =  Globals().getDocumentStore()
+        index =  Globals().getDefaultSession().getDocumentStore()
         if (index == None):
             QMessageBox.critical(self, 'Error', 'No document index loaded')
             return
@@ -30,7 +30,7 @@ class LogWindow(QFrame):
         self._textCursor = QTextCursor(self._document)
         self._newLine = ''
         layout.addWidget(self._documentWindow, 0, 0)
-        Globals()._logEvent.logMessage.connect(self.logMessage)
+        Globals().getLogEvent().logMessage.connect(self.logMessage)
 
     # Add a message to the log window
     @Slot(str)
@@ -5,6 +5,7 @@
 #
 # Copyright 2024 David Wootton
 
+import os
 from PySide6.QtCore import QCoreApplication
 from PySide6.QtCore import Qt
 from PySide6.QtCore import QSettings
@@ -14,7 +15,9 @@ from PySide6.QtGui import QFont
 from PySide6.QtWidgets import QApplication
 from PySide6.QtWidgets import QColorDialog
 from PySide6.QtWidgets import QDockWidget
+from PySide6.QtWidgets import QFileDialog
 from PySide6.QtWidgets import QFontDialog
+from PySide6.QtWidgets import QInputDialog
 from PySide6.QtWidgets import QMainWindow
 from PySide6.QtWidgets import QMenu
 from UI.DocumentsWindow import DocumentsWindow
@@ -22,6 +25,7 @@ from UI.LogWindow import LogWindow
 from UI.ModelWindow import ModelWindow
 from UI.OutputWindow import OutputWindow
 from UI.PromptWindow import PromptWindow
+from Util.Globals import Globals
 
 class MainWindow(QMainWindow):
     _MAIN_WINDOW_STATE = 'MainWindowState'
@@ -91,6 +95,8 @@ class MainWindow(QMainWindow):
         settingsFont.triggered.connect(self.doFont)
         settingsTextColor = settingsMenu.addAction('Text Color')
         settingsTextColor.triggered.connect(self.doTextColor)
+        settingsProfile = settingsMenu.addAction('Profile Requests')
+        settingsProfile.triggered.connect(self.doProfileRequests)
         self.menuBar().addMenu(settingsMenu)
 
         self.show()
@@ -160,6 +166,23 @@ class MainWindow(QMainWindow):
             settings = QSettings()
             settings.setValue('ApplicationFont', fontSetting)
 
+    # Handle request to profile the next set of background requests
+    @Slot(bool)
+    def doProfileRequests(self, checked):
+        settings = QSettings()
+        requestCount, ok = QInputDialog.getInt(self, 'Profile Requests', 'Number of requests to profile', 1, 0, 100)
+        if (not ok):
+            return
+        profileDirectory = settings.value('ProfileDirectory', os.path.join(os.path.expanduser('~'), 'DocAssistantProfiles'))
+        if (requestCount > 0):
+            selectedDirectory = QFileDialog.getExistingDirectory(self, 'Select the profile output directory', profileDirectory)
+            if (selectedDirectory == ''):
+                return
+            profileDirectory = selectedDirectory
+            settings.setValue('ProfileDirectory', profileDirectory)
+        Globals().getWorkerThread().setProfiling(requestCount, profileDirectory)
+        Globals().logMessage(f'Profiling the next {requestCount} requests, output directory {profileDirectory}')
+
     # Handle request to change the text color
     @Slot(bool)
     def doTextColor(self, checked):
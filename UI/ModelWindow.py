@@ -6,7 +6,7 @@
 # Copyright 2024 David Wootton
 
 import gc
-import torch
+from PySide6.QtCore import QSettings
 from PySide6.QtCore import Slot
 from PySide6.QtWidgets import QFrame
 from PySide6.QtWidgets import QComboBox
@@ -22,6 +22,9 @@ from Request.LoadModelRequest import LoadModelRequest
 from Dialogs.ModelDialog import ModelDialog
 from Request.LoadModelRequest import LoadModelRequest
 from Util.Globals import Globals
+from Util.ModelCache import ModelCache
+from Util.Prefetcher import Prefetcher
+from Widgets.XHSlider import XHSlider
 from Worker.WorkerThread import WorkerThread
 
 # Window class containing widgets to manage loading LLM models
@@ -73,9 +76,35 @@ class ModelWindow(QFrame):
         unloadButton = QPushButton('Unload', loadUnloadBox)
         unloadButton.setToolTip('Click to unload current model')
         buttonLayout.addWidget(unloadButton)
+        dryRunButton = QPushButton('Dry Run', loadUnloadBox)
+        dryRunButton.setToolTip('Click to estimate the memory and layer placement of the model profile without loading it')
+        buttonLayout.addWidget(dryRunButton)
         layout.addWidget(loadUnloadBox, row, 1)
         row += 1
 
+        layout.addWidget(QLabel('Resident models', self), row, 0)
+        self._residentModelsWidget = XHSlider(self, 1, 8, 1, 'Specify number of loaded models kept in memory for fast switching',
+                                              'ModelWindow.ResidentModels')
+        if (QSettings().value('ModelWindow.ResidentModels.Value') is None):
+            self._residentModelsWidget.setValue(ModelCache.DEFAULT_MAX_MODELS)
+        # Apply the saved setting now, so models loaded before the Load button is used are kept resident as set
+        Globals().getSessionManager().getModelCache().setMaxModels(self._residentModelsWidget.value())
+        layout.addWidget(self._residentModelsWidget, row, 1)
+        row += 1
+
+        layout.addWidget(QLabel('Memory budget(MB)', self), row, 0)
+        self._memoryBudgetWidget = XHSlider(self, 0, 512000, 5000, 'Specify memory for loaded models and indexes, 0 for no limit')
+        self._memoryBudgetWidget.setValue(Globals().getProfiles().get('memoryBudget', 0))
+        layout.addWidget(self._memoryBudgetWidget, row, 1)
+        row += 1
+
+        layout.addWidget(QLabel('Prefetch limit(MB)', self), row, 0)
+        self._prefetchLimitWidget = XHSlider(self, 0, 512000, 5000,
+                                             'Specify how much of a selected model to read into memory in the background, 0 to not prefetch',
+                                             'ModelWindow.PrefetchLimit')
+        layout.addWidget(self._prefetchLimitWidget, row, 1)
+        row += 1
+
         space = QSpacerItem(1, 1, QSizePolicy.Expanding, QSizePolicy.Expanding)
         layout.addItem(space, row, 1, 2)
         layout.setRowStretch(1, 0)
@@ -85,6 +114,7 @@ class ModelWindow(QFrame):
         layout.setColumnStretch(1, 1)
         layout.setColumnStretch(2, 0)
 
+        self._prefetcher = Prefetcher()
         try:
             self._modelProfileCombo.setCurrentText(Globals().getProfiles()['selectedModel'])
         except KeyError:
@@ -96,6 +126,7 @@ class ModelWindow(QFrame):
         editButton.clicked.connect(self.editModel)
         loadButton.clicked.connect(self.loadModel)
         unloadButton.clicked.connect(self.unloadModel)
+        dryRunButton.clicked.connect(self.dryRunModel)
         self._modelProfileCombo.currentTextChanged.connect(self.modelSelected)
 
     # Handle a request to add a model profile
@@ -126,6 +157,19 @@ class ModelWindow(QFrame):
         self._modelProfileCombo.removeItem(self._modelProfileCombo.findText(selection))
         Globals().getProfiles()['modelProfiles'].pop(selection)     
 
+    # Handle a request to estimate the memory needed by a model without loading it
+    @Slot(bool)
+    def dryRunModel(self, checked):
+        selection = self._modelProfileCombo.currentText()
+        if (selection == ''):
+            QMessageBox.critical(self, 'Error', 'No model profile selected')
+            return
+        request = LoadModelRequest()
+        request.setModelParameters(Globals().getProfiles()['modelProfiles'][selection])
+        request.setDryRun(True)
+        workerThread = Globals.getWorkerThread(Globals())
+        workerThread.enqueue(request)
+
     # Handle a request to load a model
     @Slot(bool)
     def loadModel(self, checked):
@@ -134,6 +178,10 @@ class ModelWindow(QFrame):
             QMessageBox.critical(self, 'Error', 'No model profile selected')
             return
         profile = Globals().getProfiles()['modelProfiles'][selection]
+        # Apply the model cache limits before loading so least recently used models are evicted as needed
+        Globals().getProfiles()['memoryBudget'] = self._memoryBudgetWidget.value()
+        Globals().getSessionManager().setMemoryBudget(self._memoryBudgetWidget.value() * 1048576)
+        Globals().getSessionManager().getModelCache().setMaxModels(self._residentModelsWidget.value())
         request = LoadModelRequest()
         request.setModelParameters(profile)                           
         workerThread = Globals.getWorkerThread(Globals())
@@ -143,19 +191,34 @@ class ModelWindow(QFrame):
     @Slot(str)
     def modelSelected(self, selection):
         Globals().getProfiles()['selectedModel'] = selection
+        # Start reading the selected model's weights into the page cache so loading it is faster. This cancels any running prefetch.
+        profile = Globals().getProfiles()['modelProfiles'].get(selection)
+        if (profile is None):
+            self._prefetcher.cancel()
+            return
+        modelPaths = [profile['modelPath']]
+        if (len(profile.get('draftModelPath', '')) > 0):
+            modelPaths.append(profile['draftModelPath'])
+        self._prefetcher.prefetch(modelPaths, self._prefetchLimitWidget.value() * 1048576)
 
-    # Handle a request to unload a model
+    # Handle a request to unload a model, removing it from the resident models so its memory is released
     @Slot(bool)
     def unloadModel(self, checked):
-        model = Globals().getModel()
+        import torch
+        session = Globals().getDefaultSession()
+        model = session.getModel()
         if (not model == None):
+            Globals().getSessionManager().getModelCache().removeModel(model)
             del model
-        Globals().setModel(None)
+        session.setModel(None)
+        session.setDraftModel(None)
         gc.collect()
-        torch.cuda.empty_cache()
-        tokenizer = Globals().getTokenizer()
+        if (torch.cuda.is_available()):
+            torch.cuda.empty_cache()
+        tokenizer = session.getTokenizer()
         if (not tokenizer == None):
             del tokenizer
-        Globals().setTokenizer(None)
+        session.setTokenizer(None)
         gc.collect()
-        torch.cuda.empty_cache()
+        if (torch.cuda.is_available()):
+            torch.cuda.empty_cache()
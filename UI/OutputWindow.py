@@ -31,7 +31,7 @@ class OutputWindow(QFrame):
         self.outputText.setDocument(self.outputDocument)
         self.textCursor = QTextCursor(self.outputDocument)
         layout.addWidget(self.outputText, 0, 0)
-        Globals()._resultEvent.resultMessage.connect(self.appendOutput)
+        Globals().getResultEvent().resultMessage.connect(self.appendOutput)
 
     # Append text to the output window
     @Slot(str)
@@ -13,6 +13,7 @@ from PySide6.QtWidgets import QFrame
 from PySide6.QtWidgets import QGridLayout
 from PySide6.QtWidgets import QHBoxLayout
 from PySide6.QtWidgets import QLabel
+from PySide6.QtWidgets import QLineEdit
 from PySide6.QtWidgets import QMessageBox
 from PySide6.QtWidgets import QPushButton
 from PySide6.QtWidgets import QSpacerItem
@@ -20,6 +21,7 @@ from PySide6.QtWidgets import QTextEdit
 from PySide6.QtWidgets import QWidget
 from Request.QueryRequest import QueryRequest
 from Util.Globals import Globals
+from Util.MetadataIndex import parseFilters
 from Widgets.XHSlider import XHSlider
 
 # Class to handle user prompts to query documents
@@ -82,6 +84,13 @@ class PromptWindow(QFrame):
         layout.addWidget(self._matchesWidget, row, 1, 1, 2)
         row = row + 1
 
+        label = QLabel('Document filter', self)
+        layout.addWidget(label, row, 0)
+        self._filterWidget = QLineEdit(self)
+        self._filterWidget.setToolTip('Only search matching documents, for example: type=pdf source="My Manual.pdf|notes.docx" page>=10')
+        layout.addWidget(self._filterWidget, row, 1, 1, 2)
+        row = row + 1
+
         submitButton = QPushButton('Submit', self)
         submitButton.setToolTip('Click to submit query')
         layout.addWidget(submitButton, row, 1, 1, 1)
@@ -136,16 +145,23 @@ class PromptWindow(QFrame):
         dialog.exec()
 
 
+    # Slot to stop the query running in the GUI's session
     @Slot(bool)
     def doQueryStop(self, checked):
-        Globals().setStopQuery(True)
+        Globals().getDefaultSession().stopQueries()
 
     # Submit query request
     @Slot(bool)
     def doSubmit(self, checked):
+        try:
+            filters = parseFilters(self._filterWidget.text())
+        except ValueError as err:
+            QMessageBox.critical(self, 'Error', f'Invalid document filter: {err}')
+            return
         request = QueryRequest()
         request.setQueryParameters(self._input.toPlainText(), Globals().getProfiles()['queryProfiles'][self._profileCombo.currentText()],
                                    self._maxNewTokensWidget.value(), self._matchesWidget.value())
+        request.setFilters(filters)
                                    
         workerThread = Globals.getWorkerThread(Globals())
         workerThread.enqueue(request)
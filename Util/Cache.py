@@ -0,0 +1,43 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import hashlib
+import json
+import os
+
+# Get the directory used to cache data of the specified kind, creating it if needed
+def getCacheDirectory(kind):
+    cacheRoot = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    directory = os.path.join(cacheRoot, 'DocAssistant', kind)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+# Get a hash of a set of values that can be converted to JSON, for use as a cache key
+def hashValues(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# Get a hash of a file's contents
+def hashFile(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as inputFile:
+        for block in iter(lambda: inputFile.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Get the name, size and modification time of each file in a model directory, or of a single model file. Cached data derived from a model
+# is invalid once this signature changes.
+def getModelFilesSignature(modelPath):
+    if (os.path.isfile(modelPath)):
+        files = [modelPath]
+    else:
+        files = [os.path.join(modelPath, f) for f in sorted(os.listdir(modelPath))]
+    signature = []
+    for f in files:
+        if (os.path.isfile(f)):
+            status = os.stat(f)
+            signature.append([os.path.basename(f), status.st_size, int(status.st_mtime)])
+    return signature
@@ -0,0 +1,90 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import hashlib
+import re
+import numpy
+
+# Find chunks which duplicate an earlier chunk, so each distinct chunk is only embedded and stored once. Chunks whose text is the same
+# apart from case and whitespace are exact duplicates. Near duplicates, such as the same paragraph in two revisions of a manual, are
+# found with MinHash signatures of each chunk's word shingles and locality sensitive hashing of signature bands, which finds candidate
+# chunks without comparing each chunk with every earlier chunk. A candidate is a near duplicate if the Jaccard similarity of the shingles,
+# estimated from the signatures, is at least the similarity threshold.
+class Deduplicator():
+    # Number of words in each shingle
+    SHINGLE_WORDS = 5
+    # Number of hash functions in a MinHash signature, and the number of bands the signature is split into for LSH. With 16 bands of 8
+    # rows, chunks with a Jaccard similarity of 0.85 are candidates with probability over 0.99.
+    NUM_PERMUTATIONS = 128
+    BANDS = 16
+    # Prime larger than any 32-bit shingle hash, used for the universal hash functions
+    _PRIME = 4294967311
+
+    def __init__(self, similarity):
+        self._similarity = similarity
+        self._exactHashes = {}
+        self._bandBuckets = {}
+        self._signatures = {}
+        self._duplicateLocations = {}
+        self._exactCount = 0
+        self._nearCount = 0
+        random = numpy.random.RandomState(1)
+        self._a = random.randint(1, 2 ** 31, size=self.NUM_PERMUTATIONS, dtype=numpy.uint64)
+        self._b = random.randint(0, 2 ** 32, size=self.NUM_PERMUTATIONS, dtype=numpy.uint64)
+
+    # Add the location of a duplicate chunk to the chunk it duplicates
+    def addDuplicate(self, keptId, location):
+        self._duplicateLocations.setdefault(keptId, []).append(location)
+
+    # Check whether a chunk duplicates an earlier chunk. If it does, its location is recorded with the earlier chunk and the earlier
+    # chunk's id is returned, otherwise the chunk is remembered and None is returned. Near duplicates are only found if the similarity
+    # threshold is less than 1.
+    def findDuplicate(self, chunkId, text, location):
+        words = re.sub(r'\s+', ' ', text).strip().lower().split(' ')
+        exactHash = hashlib.sha1(' '.join(words).encode('utf-8')).digest()
+        keptId = self._exactHashes.get(exactHash)
+        if (keptId is not None):
+            self._exactCount = self._exactCount + 1
+            self.addDuplicate(keptId, location)
+            return keptId
+        if (self._similarity >= 1.0):
+            self._exactHashes[exactHash] = chunkId
+            return None
+        signature = self.getSignature(words)
+        bandKeys = [(n, signature[n::self.BANDS].tobytes()) for n in range(self.BANDS)]
+        for bandKey in bandKeys:
+            for candidateId in self._bandBuckets.get(bandKey, []):
+                if (numpy.mean(self._signatures[candidateId] == signature) >= self._similarity):
+                    # Later exact copies of this chunk are duplicates of the kept chunk, since this chunk is not indexed
+                    self._exactHashes[exactHash] = candidateId
+                    self._nearCount = self._nearCount + 1
+                    self.addDuplicate(candidateId, location)
+                    return candidateId
+        self._exactHashes[exactHash] = chunkId
+        self._signatures[chunkId] = signature
+        for bandKey in bandKeys:
+            self._bandBuckets.setdefault(bandKey, []).append(chunkId)
+        return None
+
+    # Get the locations of the duplicates of each kept chunk, by kept chunk id
+    def getDuplicateLocations(self):
+        return self._duplicateLocations
+
+    def getExactCount(self):
+        return self._exactCount
+
+    def getNearCount(self):
+        return self._nearCount
+
+    # Get the MinHash signature of a chunk's word shingles
+    def getSignature(self, words):
+        shingleCount = max(1, len(words) - self.SHINGLE_WORDS + 1)
+        shingles = {' '.join(words[n:n + self.SHINGLE_WORDS]) for n in range(shingleCount)}
+        hashes = numpy.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little') for s in shingles],
+                             dtype=numpy.uint64)
+        permuted = (numpy.outer(hashes, self._a) + self._b) % self._PRIME
+        return permuted.min(axis=0).astype(numpy.uint32)
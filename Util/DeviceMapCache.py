@@ -0,0 +1,44 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import json
+import os
+from Util.Cache import getCacheDirectory
+from Util.Cache import hashFile
+from Util.Cache import hashValues
+
+# Device maps computed by infer_auto_device_map, saved on disk so later loads of the same model profile can skip computing them. Maps are
+# keyed by the model path, a hash of the model's config.json, the memory limits and any other settings that affect the map.
+class DeviceMapCache():
+    def __init__(self):
+        self._directory = getCacheDirectory('devicemaps')
+
+    # Get the cache key for a model with the specified memory limits and other settings affecting the device map
+    def getKey(self, modelPath, limits, *settings):
+        configPath = os.path.join(modelPath, 'config.json')
+        configHash = hashFile(configPath) if (os.path.exists(configPath)) else ''
+        return hashValues(os.path.abspath(modelPath), configHash, {str(k): v for k, v in limits.items()}, settings)
+
+    # Load a cached device map, returning a (device map, seconds taken to compute the map) tuple or None if the map is not cached
+    def loadDeviceMap(self, key):
+        path = os.path.join(self._directory, f'{key}.json')
+        try:
+            with open(path) as mapFile:
+                data = json.load(mapFile)
+            return (data['deviceMap'], data['seconds'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    # Save a device map along with the time taken to compute it
+    def saveDeviceMap(self, key, deviceMap, seconds):
+        data = {}
+        data['deviceMap'] = deviceMap
+        data['seconds'] = seconds
+        path = os.path.join(self._directory, f'{key}.json')
+        with open(path + '.tmp', 'w') as mapFile:
+            json.dump(data, mapFile, indent=4)
+        os.replace(path + '.tmp', path)
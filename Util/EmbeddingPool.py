@@ -0,0 +1,93 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import collections
+import multiprocessing
+import os
+from Util.Globals import Globals
+
+# The embeddings object used by an embedding worker process, or the error raised while initializing the worker
+_workerEmbeddings = None
+_workerError = None
+
+# Initialize an embedding worker process. The worker takes the next worker number from the pool's shared counter, picks its set of cores
+# by that number, binds itself to those cores and limits the threads used by PyTorch and ONNX Runtime to the number of cores before
+# loading the sentence transformer. Workers only use the CPU. The first workers in the pool each get a different set. A worker started to
+# replace one which exited gets the next number and so may share cores with another worker. If initialization fails, the error is raised
+# by every batch the worker is given, since a pool replaces a worker whose initializer raises an exception with a new worker which fails
+# the same way.
+def initializeWorker(sentenceTransformer, embeddingFormat, coreSets, workerCounter):
+    global _workerEmbeddings
+    global _workerError
+    try:
+        with workerCounter.get_lock():
+            workerNumber = workerCounter.value
+            workerCounter.value = workerNumber + 1
+        cores = coreSets[workerNumber % len(coreSets)]
+        if (hasattr(os, 'sched_setaffinity')):
+            os.sched_setaffinity(0, cores)
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        os.environ['OMP_NUM_THREADS'] = str(len(cores))
+        os.environ['MKL_NUM_THREADS'] = str(len(cores))
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+        import torch
+        torch.set_num_threads(len(cores))
+        from Util.Embeddings import createEmbeddings
+        _workerEmbeddings = createEmbeddings(sentenceTransformer, embeddingFormat, len(cores))
+    except Exception as err:
+        _workerError = f'{type(err).__name__}: {err}'
+
+# Embed a batch of texts in an embedding worker process
+def embedBatch(texts):
+    import numpy
+    if (_workerError is not None):
+        raise RuntimeError(f'Embedding worker failed to start, {_workerError}')
+    return numpy.array(_workerEmbeddings.embed_documents(texts), dtype=numpy.float32)
+
+# Pool of embedding worker processes used to embed document chunks on all CPU cores. Each worker is bound to its own subset of the cores
+# available to this process and runs its own copy of the sentence transformer, which scales much better than one process using all the
+# cores, since the small batches used to embed chunks do not have enough work to keep many threads busy. Workers are started with the spawn
+# method so they do not inherit the state of the threads and any GPU context in this process.
+class EmbeddingPool():
+    def __init__(self, sentenceTransformer, embeddingFormat, workerCount):
+        context = multiprocessing.get_context('spawn')
+        coreSets = self.getCoreSets(workerCount)
+        workerCounter = context.Value('i', 0)
+        Globals().logMessage(f'Starting {len(coreSets)} embedding workers with {[len(cores) for cores in coreSets]} cores')
+        initArgs = (sentenceTransformer, embeddingFormat, coreSets, workerCounter)
+        self._pool = context.Pool(len(coreSets), initializer=initializeWorker, initargs=initArgs)
+        self._window = 2 * len(coreSets)
+
+    # Stop the worker processes
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    # Embed batches of texts, spreading the batches across the workers. Batches may be produced while earlier batches are being embedded.
+    # Yields the embeddings of each batch as a numpy array, in the same order as the batches, as soon as that batch and all preceding
+    # batches are embedded. Batches are read from the iterator in the calling thread and at most two batches per worker are outstanding,
+    # so batches are not read faster than they can be embedded.
+    def embedBatches(self, batches):
+        pending = collections.deque()
+        for texts in batches:
+            while ((len(pending) > 0) and ((len(pending) >= self._window) or pending[0].ready())):
+                yield pending.popleft().get()
+            pending.append(self._pool.apply_async(embedBatch, (texts,)))
+        while (len(pending) > 0):
+            yield pending.popleft().get()
+
+    # Split the cores available to this process into one contiguous set per worker. There are never more workers than cores.
+    def getCoreSets(self, workerCount):
+        if (hasattr(os, 'sched_getaffinity')):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count()))
+        workerCount = max(1, min(workerCount, len(cores)))
+        coreSets = []
+        for n in range(workerCount):
+            coreSets.append(cores[n * len(cores) // workerCount:(n + 1) * len(cores) // workerCount])
+        return coreSets
@@ -0,0 +1,36 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+from Util.Globals import Globals
+
+# Formats a sentence transformer can be run in to compute embeddings: the PyTorch model, or an ONNX export of the model run by ONNX
+# Runtime, optionally with int8 quantized weights, which is faster on a CPU
+EMBEDDING_FORMATS = ('pytorch', 'onnx', 'onnx-int8')
+# The sentence transformer used by HuggingFaceEmbeddings when none is specified
+DEFAULT_SENTENCE_TRANSFORMER = 'sentence-transformers/all-mpnet-base-v2'
+
+# Create the embeddings object used to embed document chunks and queries with a sentence transformer in the specified format. If the
+# ONNX export cannot be created or its embeddings are not close enough to the PyTorch model's embeddings, the PyTorch model is used. The
+# number of threads used by ONNX Runtime may be limited, otherwise one thread per core is used.
+def createEmbeddings(sentenceTransformer, embeddingFormat='pytorch', threads=0):
+    if (len(sentenceTransformer) == 0):
+        sentenceTransformer = DEFAULT_SENTENCE_TRANSFORMER
+    if (embeddingFormat in ('onnx', 'onnx-int8')):
+        try:
+            from Util.OnnxEmbeddings import OnnxEmbeddings
+            return OnnxEmbeddings(sentenceTransformer, embeddingFormat == 'onnx-int8', threads)
+        except (ImportError, OSError, ValueError, RuntimeError) as err:
+            Globals().logMessage(f'Unable to use {embeddingFormat} embeddings, using PyTorch embeddings: {err}')
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=sentenceTransformer)
+
+# Get the maximum number of tokens the sentence transformer used by an embeddings object embeds, or None if it is not known. Longer texts
+# are truncated to this length.
+def getMaxSeqLength(embeddings):
+    if (hasattr(embeddings, 'getMaxSeqLength')):
+        return embeddings.getMaxSeqLength()
+    return getattr(getattr(embeddings, 'client', None), 'max_seq_length', None)
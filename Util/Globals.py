@@ -5,71 +5,62 @@
 #
 # Copyright 2024 David Wootton
 
-from PySide6.QtCore import QObject
-from PySide6.QtCore import Signal
-
-class ResultSignal(QObject):
-    resultMessage = Signal(str)
-
-class LogSignal(QObject):
-    logMessage = Signal(str)
+import sys
+from Util.SessionManager import SessionManager
 
+# Application wide state. Models, document stores and query stop flags are kept in sessions managed by the session manager. When running
+# under the GUI, log messages and answers are sent to the GUI through the signals set by setLogEvent and setResultEvent. When no signals
+# are set, as in the command line tools, log messages are written to stderr and answers to stdout.
 class Globals():
 
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(Globals, cls).__new__(cls)
-            cls._logEvent = LogSignal()
-            cls._resultEvent = ResultSignal()
-            cls._model = None
-            cls._tokenizer = None
-            cls._documentStore = None
+            cls._logEvent = None
+            cls._resultEvent = None
+            cls._sessionManager = SessionManager()
         return cls.instance
 
-    def getDocumentEmbeddings(self):
-        return self._embeddingsFromDocuments
-    
-    def getDocumentStore(self):
-        return self._documentStore
-    
-    def getModel(self):
-        return self._model
-    
+    # Get the session used by the GUI and the command line tools
+    def getDefaultSession(self):
+        return self._sessionManager.getDefaultSession()
+
+    def getLogEvent(self):
+        return self._logEvent
+
     def getProfiles(self):
         return self._profiles
     
-    def getQueryStop(self):
-        return self._stopQuery 
-    
-    def getTokenizer(self):
-        return self._tokenizer
-    
+    def getResultEvent(self):
+        return self._resultEvent
+
+    def getSessionManager(self):
+        return self._sessionManager
+
     def getWorkerThread(self):
         return self._workerThread;
 
     def logMessage(self, message):
-        self._logEvent.logMessage.emit(message)
+        if (self._logEvent is None):
+            print(message, file=sys.stderr, flush=True)
+        else:
+            self._logEvent.logMessage.emit(message)
 
     def postAnswer(self, answer):
-        self._resultEvent.resultMessage.emit(answer)
-
-    def setDocumentEmbeddings(self, embeddings):
-        self.embeddingsFromDocuments = embeddings
-        
-    def setDocumentStore(self, store):
-        self._documentStore = store
+        if (self._resultEvent is None):
+            sys.stdout.write(answer)
+            sys.stdout.flush()
+        else:
+            self._resultEvent.resultMessage.emit(answer)
 
-    def setModel(self, model):
-        self._model = model
+    def setLogEvent(self, event):
+        self._logEvent = event
 
     def setProfiles(self, profiles):
         self._profiles = profiles
 
-    def setStopQuery(self, flag):
-        self._stopQuery = flag
+    def setResultEvent(self, event):
+        self._resultEvent = event
 
-    def setTokenizer(self, tokenizer):
-        self._tokenizer = tokenizer
-        
     def setWorkerThread(self, thread):
         self._workerThread = thread
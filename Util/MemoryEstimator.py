@@ -0,0 +1,202 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import json
+import os
+import re
+import struct
+
+# Predict the memory a model profile needs on each device without loading any weights. Tensor names, types and shapes are read from the
+# headers of safetensors files, or the tensor sizes are derived from the model configuration when the weights are in another format.
+# Tensors are grouped into the modules the model is split on, their sizes are adjusted for the profile's data type and 8-bit or 4-bit
+# quantization, then the modules are placed in order on the GPUs, the CPU and disk within the profile's memory limits, the same way as
+# accelerate's infer_auto_device_map places them.
+class MemoryEstimator():
+    _DTYPE_SIZES = {'F64': 8, 'F32': 4, 'F16': 2, 'BF16': 2, 'I64': 8, 'I32': 4, 'I16': 2, 'I8': 1, 'U8': 1, 'BOOL': 1, 'F8_E4M3': 1,
+                    'F8_E5M2': 1}
+    _FLOAT_DTYPES = ('F64', 'F32', 'F16', 'BF16')
+    _LAYER_PATTERN = re.compile(r'^(.*?\.\d+)\.')
+
+    def __init__(self, profile):
+        self._profile = profile
+        self._modelPath = profile['modelPath']
+
+    # Place the model's modules on devices, returning a dictionary with the bytes needed on each device, the memory limit of each device,
+    # the device each module is placed on in model order, and whether the model needs disk offload or does not fit at all. Profiles which
+    # do not use GPUs are placed in CPU memory.
+    def estimate(self):
+        modules = self.getModuleSizes()
+        limits = {}
+        if (self.usesGPU()):
+            for n in range(len(self._profile['gpuMemory'])):
+                limits[str(n)] = int(self._profile['gpuMemory'][str(n)]) * 1048576
+        if (self._profile['useCPU'] or (not self.usesGPU())):
+            limits['cpu'] = int(self._profile['maxCpuMemory']) * 1048576
+        estimate = {}
+        estimate['limits'] = limits
+        estimate['devices'] = {}
+        estimate['placement'] = []
+        estimate['totalBytes'] = sum(modules.values())
+        devices = list(limits.keys())
+        deviceIndex = 0
+        for module, size in modules.items():
+            while ((deviceIndex < len(devices)) and
+                   (estimate['devices'].get(devices[deviceIndex], 0) + size > limits[devices[deviceIndex]])):
+                deviceIndex = deviceIndex + 1
+            device = devices[deviceIndex] if (deviceIndex < len(devices)) else 'disk'
+            estimate['devices'][device] = estimate['devices'].get(device, 0) + size
+            estimate['placement'].append((module, device))
+        estimate['offloadsToDisk'] = 'disk' in estimate['devices']
+        estimate['fits'] = (not estimate['offloadsToDisk']) or self._profile['overflowToDisk']
+        return estimate
+
+    # Get the size in bytes of each module the model is split on, in model order, as loaded with the profile's settings
+    def getModuleSizes(self):
+        if (self.isLlamaCpp()):
+            return self.getLlamaCppSizes()
+        tensors = self.readSafeTensors()
+        if (len(tensors) == 0):
+            tensors = self.getConfigTensors()
+        modules = {}
+        for name, dtype, shape in tensors:
+            module = self.getModuleName(name)
+            modules[module] = modules.get(module, 0) + self.getTensorBytes(name, dtype, shape)
+        return modules
+
+    # Get the name of the module a tensor is placed with. Tensors inside a numbered layer are placed with that layer, other tensors are
+    # placed with the module containing them.
+    def getModuleName(self, tensorName):
+        match = self._LAYER_PATTERN.match(tensorName)
+        if (match is not None):
+            return match.group(1)
+        return tensorName.rpartition('.')[0]
+
+    # Get a sort key putting tensors in model order, with embeddings first, then numbered layers in numeric order, then other modules such
+    # as the final normalization and lastly the output head
+    def getModelOrder(self, tensorName):
+        match = self._LAYER_PATTERN.match(tensorName)
+        if (match is not None):
+            return (1, int(match.group(1).rpartition('.')[2]), tensorName)
+        if (('embed' in tensorName) or ('wte' in tensorName) or ('wpe' in tensorName)):
+            return (0, 0, tensorName)
+        if (tensorName.startswith('lm_head')):
+            return (3, 0, tensorName)
+        return (2, 0, tensorName)
+
+    # Get the size in bytes a tensor takes when loaded. Weights already quantized by GPTQ keep their stored size, other floating point
+    # tensors are converted to the profile's data type and the weights of linear layers are quantized by bitsandbytes for 8-bit and 4-bit
+    # profiles.
+    def getTensorBytes(self, name, dtype, shape):
+        elements = 1
+        for dimension in shape:
+            elements = elements * dimension
+        if (not dtype in self._FLOAT_DTYPES):
+            return elements * self._DTYPE_SIZES.get(dtype, 4)
+        isLinearWeight = ((not self.isGPTQ()) and (len(shape) == 2) and name.endswith('.weight') and (self._LAYER_PATTERN.match(name) is not None) and
+                          ('embed' not in name))
+        if (isLinearWeight and self._profile['use8Bit']):
+            return elements
+        if (isLinearWeight and self._profile['use4Bit']):
+            # Packed 4-bit values plus the double quantized block scales
+            return elements // 2 + elements // 256
+        return elements * (2 if (self._profile['use16Bit'] or self.isGPTQ()) else 4)
+
+    # Derive approximate tensor shapes from the model configuration when weights are not in safetensors format
+    def getConfigTensors(self):
+        with open(os.path.join(self._modelPath, 'config.json')) as configFile:
+            config = json.load(configFile)
+        hiddenSize = config.get('hidden_size', config.get('n_embd', config.get('d_model', 0)))
+        layerCount = config.get('num_hidden_layers', config.get('n_layer', config.get('n_layers', 0)))
+        vocabSize = config.get('vocab_size', 0)
+        headCount = config.get('num_attention_heads', config.get('n_head', 1))
+        keyValueSize = hiddenSize * config.get('num_key_value_heads', headCount) // headCount
+        intermediateSize = config.get('intermediate_size', 0)
+        tensors = []
+        tensors.append(('model.embed_tokens.weight', 'F16', (vocabSize, hiddenSize)))
+        for n in range(layerCount):
+            prefix = f'model.layers.{n}'
+            tensors.append((f'{prefix}.self_attn.q_proj.weight', 'F16', (hiddenSize, hiddenSize)))
+            tensors.append((f'{prefix}.self_attn.k_proj.weight', 'F16', (keyValueSize, hiddenSize)))
+            tensors.append((f'{prefix}.self_attn.v_proj.weight', 'F16', (keyValueSize, hiddenSize)))
+            tensors.append((f'{prefix}.self_attn.o_proj.weight', 'F16', (hiddenSize, hiddenSize)))
+            if (intermediateSize > 0):
+                tensors.append((f'{prefix}.mlp.gate_proj.weight', 'F16', (intermediateSize, hiddenSize)))
+                tensors.append((f'{prefix}.mlp.up_proj.weight', 'F16', (intermediateSize, hiddenSize)))
+                tensors.append((f'{prefix}.mlp.down_proj.weight', 'F16', (hiddenSize, intermediateSize)))
+            else:
+                tensors.append((f'{prefix}.mlp.up_proj.weight', 'F16', (4 * hiddenSize, hiddenSize)))
+                tensors.append((f'{prefix}.mlp.down_proj.weight', 'F16', (hiddenSize, 4 * hiddenSize)))
+        if (not config.get('tie_word_embeddings', False)):
+            tensors.append(('lm_head.weight', 'F16', (vocabSize, hiddenSize)))
+        return tensors
+
+    # Get the sizes of a llama.cpp model, which is memory mapped as a whole with its layers already quantized
+    def getLlamaCppSizes(self):
+        if (os.path.isfile(self._modelPath)):
+            files = [self._modelPath]
+        else:
+            files = [os.path.join(self._modelPath, f) for f in os.listdir(self._modelPath) if (f.endswith('.gguf'))]
+        return {os.path.basename(f): os.path.getsize(f) for f in sorted(files)}
+
+    # Get the lines of a human readable report of an estimate
+    def getReport(self, estimate):
+        report = []
+        report.append(f'Estimated model memory {estimate["totalBytes"] / 1073741824.0:.3f}GB')
+        for device, size in estimate['devices'].items():
+            deviceName = f'GPU {device}' if (device.isdigit()) else device
+            if (device in estimate['limits']):
+                report.append(f'{deviceName}: {size / 1073741824.0:.3f}GB of {estimate["limits"][device] / 1073741824.0:.3f}GB limit')
+            else:
+                report.append(f'{deviceName}: {size / 1073741824.0:.3f}GB')
+        # Summarize the placement as runs of consecutive modules placed on the same device
+        runs = []
+        for module, device in estimate['placement']:
+            if ((len(runs) > 0) and (runs[-1][2] == device)):
+                runs[-1][1] = module
+            else:
+                runs.append([module, module, device])
+        for first, last, device in runs:
+            modules = first if (first == last) else f'{first} to {last}'
+            report.append(f'Placement: {modules} on {f"GPU {device}" if (device.isdigit()) else device}')
+        if (estimate['offloadsToDisk'] and estimate['fits']):
+            report.append('Warning: the model will be offloaded to disk, which is slow and needs enough free space in the overflow '
+                          'directory to avoid a SIGBUS error')
+        elif (not estimate['fits']):
+            report.append('Error: the model does not fit in the memory limits and overflow to disk is not enabled, so loading will fail')
+        return report
+
+    def isGPTQ(self):
+        return 'gptq' in self._modelPath.lower()
+
+    def isLlamaCpp(self):
+        return os.path.isfile(self._modelPath) or ('gguf' in self._modelPath.lower()) or ('ggml' in self._modelPath.lower())
+
+    # Check whether the profile places any of the model on GPUs. CPU optimized profiles load the whole model into CPU memory and llama.cpp
+    # models only use GPUs when layers are offloaded to them. Other models are placed within the GPU memory limits, as LoadModelRequest
+    # places them using max_memory.
+    def usesGPU(self):
+        if (self.isLlamaCpp()):
+            return self._profile.get('gpuLayers', 0) > 0
+        return not (self._profile.get('cpuOptimized', False) and os.path.exists(os.path.join(self._modelPath, 'config.json')))
+
+    # Read the tensor names, types and shapes from the headers of the model's safetensors files. Each file starts with an 8 byte little
+    # endian header length followed by a JSON header describing each tensor, so no tensor data is read.
+    def readSafeTensors(self):
+        tensors = []
+        for f in sorted(os.listdir(self._modelPath)):
+            if (not f.endswith('.safetensors')):
+                continue
+            with open(os.path.join(self._modelPath, f), 'rb') as tensorFile:
+                headerLength = struct.unpack('<Q', tensorFile.read(8))[0]
+                header = json.loads(tensorFile.read(headerLength))
+            for name, tensor in header.items():
+                if (name == '__metadata__'):
+                    continue
+                tensors.append((name, tensor['dtype'], tuple(tensor['shape'])))
+        # Place tensors in model order rather than the name order used in the files
+        tensors.sort(key=lambda t: self.getModelOrder(t[0]))
+        return tensors
@@ -0,0 +1,122 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import os
+import shlex
+
+# Chunk metadata keys queries can be filtered on, and those which can be filtered by a range of values
+FILTER_KEYS = ('source', 'type', 'page', 'mtime')
+RANGE_KEYS = ('page', 'mtime')
+
+# Parse a filter string into the filters passed to QueryRequest.setFilters. The string is a list of terms separated by spaces, where each
+# term is key=value, with alternative values separated by |, or key>=number or key<=number. Values containing spaces must be quoted.
+# Raises ValueError if the string is not valid.
+def parseFilters(text):
+    filters = {}
+    for term in shlex.split(text):
+        for operator in ('>=', '<=', '='):
+            if (operator in term):
+                key, value = term.split(operator, 1)
+                break
+        else:
+            raise ValueError(f'Filter term {term} is not key=value, key>=number or key<=number')
+        if (key not in FILTER_KEYS):
+            raise ValueError(f'Unknown filter key {key}, filter keys are {", ".join(FILTER_KEYS)}')
+        if (operator == '='):
+            values = [int(v) if (key in RANGE_KEYS) else v for v in value.split('|')]
+            filters[key] = values
+        elif (key in RANGE_KEYS):
+            if (not isinstance(filters.get(key), dict)):
+                filters[key] = {}
+            filters[key]['min' if (operator == '>=') else 'max'] = float(value)
+        else:
+            raise ValueError(f'Filter key {key} can not be filtered by a range')
+    validateFilters(filters)
+    return filters
+
+# Check filters passed to QueryRequest.setFilters, which may also come from a client of the server, raising ValueError if they are not
+# valid. None means the query is not filtered.
+def validateFilters(filters):
+    if (filters is None):
+        return
+    if (not isinstance(filters, dict)):
+        raise ValueError('Filters must map filter keys to values')
+    for key, condition in filters.items():
+        if (key not in FILTER_KEYS):
+            raise ValueError(f'Unknown filter key {key}, filter keys are {", ".join(FILTER_KEYS)}')
+        if (isinstance(condition, dict)):
+            if (key not in RANGE_KEYS):
+                raise ValueError(f'Filter key {key} can not be filtered by a range')
+            if ((len(condition) == 0) or (not set(condition.keys()) <= {'min', 'max'})):
+                raise ValueError(f'Range for filter key {key} must have a min and/or max value')
+            values = list(condition.values())
+        else:
+            values = condition if (isinstance(condition, list)) else [condition]
+            if (len(values) == 0):
+                raise ValueError(f'Filter key {key} has no values')
+        for value in values:
+            if (key in RANGE_KEYS):
+                if ((isinstance(value, bool)) or (not isinstance(value, (int, float)))):
+                    raise ValueError(f'Filter key {key} value {value} is not a number')
+            elif (not isinstance(value, str)):
+                raise ValueError(f'Filter key {key} value {value} is not a string')
+
+# Index of the metadata of each chunk in a FAISS vector store, used to find the chunks matching a query's filters. The positions in the
+# FAISS index of the chunks having each value of each filter key are found once, when the index is first filtered, so selecting the
+# chunks for a query only combines precomputed position arrays. A chunk whose duplicates were removed when the index was built also
+# matches the source, document type, pages and modification time of its duplicates. Documents may be filtered by their full path or file
+# name. A chunk spanning several pages matches each of its pages, from page through lastPage, and a page range which overlaps them.
+class MetadataIndex():
+    def __init__(self, store):
+        import numpy
+        self._count = store.index.ntotal
+        positions = {key: {} for key in FILTER_KEYS}
+        # The lowest and highest value of each range key for each chunk, which are only different for the pages of a chunk
+        self._numbers = {key: numpy.full(self._count, numpy.nan) for key in RANGE_KEYS}
+        self._lastNumbers = {key: numpy.full(self._count, numpy.nan) for key in RANGE_KEYS}
+        for n in range(self._count):
+            metadata = store.docstore.search(store.index_to_docstore_id[n]).metadata
+            for key in RANGE_KEYS:
+                if (key in metadata):
+                    self._numbers[key][n] = metadata[key]
+                    self._lastNumbers[key][n] = metadata.get('lastPage', metadata[key]) if (key == 'page') else metadata[key]
+            for location in [metadata] + metadata.get('duplicates', []):
+                for key in FILTER_KEYS:
+                    if ((key == 'page') and ('page' in location)):
+                        for page in range(location['page'], location.get('lastPage', location['page']) + 1):
+                            positions[key].setdefault(page, set()).add(n)
+                    elif (key in location):
+                        positions[key].setdefault(location[key], set()).add(n)
+                if ('source' in location):
+                    positions['source'].setdefault(os.path.basename(location['source']), set()).add(n)
+        self._positions = {}
+        for key in FILTER_KEYS:
+            self._positions[key] = {value: numpy.array(sorted(members), dtype=numpy.int64) for value, members in positions[key].items()}
+
+    # Get a bitmap with a bit set for each chunk matching all the filters, in the format used by faiss.IDSelectorBitmap, and the number of
+    # matching chunks. Each filter is a key and either a value, a list of values any of which match, or a dict with min and/or max values.
+    # Raises ValueError if the filters are not valid.
+    def getBitmap(self, filters):
+        import numpy
+        validateFilters(filters)
+        selected = numpy.ones(self._count, dtype=bool)
+        for key, condition in filters.items():
+            if (isinstance(condition, dict)):
+                with numpy.errstate(invalid='ignore'):
+                    mask = ~numpy.isnan(self._numbers[key])
+                    if ('min' in condition):
+                        mask &= self._lastNumbers[key] >= condition['min']
+                    if ('max' in condition):
+                        mask &= self._numbers[key] <= condition['max']
+            else:
+                mask = numpy.zeros(self._count, dtype=bool)
+                for value in (condition if (isinstance(condition, list)) else [condition]):
+                    members = self._positions[key].get(value)
+                    if (members is not None):
+                        mask[members] = True
+            selected &= mask
+        return numpy.packbits(selected, bitorder='little'), int(selected.sum())
@@ -0,0 +1,100 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+from collections import OrderedDict
+import json
+import threading
+
+# Loaded models kept resident so switching back to a recently used model profile does not reload it from disk. Entries are kept in least
+# recently used order and are evicted, oldest first, when the number of resident models or the memory budget would be exceeded. Models
+# currently used by a session are never evicted.
+class ModelCache():
+    # Number of models kept resident unless set otherwise, so switching between two model profiles does not reload either of them
+    DEFAULT_MAX_MODELS = 2
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxModels = self.DEFAULT_MAX_MODELS
+
+    # Add a newly loaded model, and the draft model used for speculative decoding if there is one, to the cache, returning a (model,
+    # tokenizer, draft model) tuple for the resident model. If a model loaded with the same profile is already resident, it is kept, since
+    # sessions may be using it, and is returned instead, so the caller can use it and release the model it loaded.
+    def addModel(self, profile, model, tokenizer, memory, draftModel=None):
+        key = self.getKey(profile)
+        with self._lock:
+            if (key in self._entries):
+                self._entries.move_to_end(key)
+                entry = self._entries[key]
+                return (entry['model'], entry['tokenizer'], entry['draftModel'])
+            entry = {}
+            entry['model'] = model
+            entry['tokenizer'] = tokenizer
+            entry['draftModel'] = draftModel
+            entry['memory'] = memory
+            self._entries[key] = entry
+            return (model, tokenizer, draftModel)
+
+    # Evict least recently used models not in the inUse list until fits(count, memory) is True for the remaining models, returning the
+    # evicted (model, tokenizer) tuples so the caller can release them. Returns None if enough models cannot be evicted.
+    def evictModels(self, inUse, fits):
+        with self._lock:
+            evictable = [k for k, v in self._entries.items() if (not any(v['model'] is model for model in inUse))]
+            count = len(self._entries)
+            memory = sum(entry['memory'] for entry in self._entries.values())
+            victims = []
+            while (not fits(count, memory)):
+                if (len(victims) == len(evictable)):
+                    return None
+                entry = self._entries[evictable[len(victims)]]
+                count = count - 1
+                memory = memory - entry['memory']
+                victims.append(evictable[len(victims)])
+            evicted = []
+            for key in victims:
+                entry = self._entries.pop(key)
+                evicted.append((entry['model'], entry['tokenizer']))
+            return evicted
+
+    # Find the resident model loaded with a model profile, returning a (model, tokenizer, draft model) tuple or None if the model is not
+    # resident
+    def findModel(self, profile):
+        key = self.getKey(profile)
+        with self._lock:
+            if (key not in self._entries):
+                return None
+            self._entries.move_to_end(key)
+            entry = self._entries[key]
+            return (entry['model'], entry['tokenizer'], entry['draftModel'])
+
+    # Get the cache key for a model profile. Any change to the profile's settings makes a different key.
+    def getKey(self, profile):
+        return json.dumps(profile, sort_keys=True)
+
+    def getMaxModels(self):
+        return self._maxModels
+
+    # Get the memory in bytes used by all resident models
+    def getMemoryUsage(self):
+        with self._lock:
+            return sum(entry['memory'] for entry in self._entries.values())
+
+    def getModelCount(self):
+        return len(self._entries)
+
+    # Remove a model from the cache, returning True if it was resident
+    def removeModel(self, model):
+        with self._lock:
+            for key, entry in self._entries.items():
+                if (entry['model'] is model):
+                    del self._entries[key]
+                    return True
+            return False
+
+    # Set the maximum number of models kept resident
+    def setMaxModels(self, maxModels):
+        self._maxModels = max(1, maxModels)
@@ -0,0 +1,203 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import inspect
+import json
+import os
+import time
+import numpy
+import onnxruntime
+from langchain_core.embeddings import Embeddings
+from transformers import AutoTokenizer
+from Util.Cache import getCacheDirectory
+from Util.Cache import getModelFilesSignature
+from Util.Cache import hashValues
+from Util.Globals import Globals
+
+# Embeddings computed by an ONNX export of a sentence transformer run by ONNX Runtime, which is much faster than the PyTorch model on a
+# CPU. The transformer is exported once, and optionally quantized to int8, into an onnx directory next to the sentence transformer, or
+# into the cache directory if the sentence transformer is not a writable local directory. Pooling and normalization are done the same way
+# as the sentence transformer does them. If the sentence transformer changes, the files of the previous export are removed before it is
+# exported again, so none of them are reused. Each export is checked against the PyTorch model when it is created, and is only used if the
+# cosine similarity of its embeddings to the PyTorch model's embeddings is within tolerance for a set of sample texts.
+class OnnxEmbeddings(Embeddings):
+    _MANIFEST = 'DocAssistantOnnx.json'
+    _BATCH_SIZE = 32
+    # Minimum cosine similarity between the export's and the PyTorch model's embeddings
+    COSINE_TOLERANCE = {'fp32': 0.999, 'int8': 0.98}
+    SAMPLE_TEXTS = ['The quick brown fox jumps over the lazy dog.',
+                    'Install the prerequisite packages before starting the program.',
+                    'Quarterly revenue increased by twelve percent compared to the same quarter last year, driven by strong demand '
+                    'for storage products and services in the European market.',
+                    'How do I reset my password?',
+                    'Table 3: Memory usage in GB for each model configuration, measured after the first query.',
+                    'Der Vertrag kann mit einer Frist von drei Monaten gekündigt werden.']
+
+    def __init__(self, sentenceTransformer, quantize, threads=0):
+        self._sentenceTransformer = sentenceTransformer
+        self._threads = threads
+        self._variant = 'int8' if (quantize) else 'fp32'
+        self._directory = self.getExportDirectory()
+        manifest = self.readManifest()
+        if (manifest is None):
+            self.removeExport()
+        if ((manifest is None) or (not self._variant in manifest['cosine'])):
+            manifest = self.export(manifest)
+        if (manifest['cosine'][self._variant] < self.COSINE_TOLERANCE[self._variant]):
+            raise ValueError(f'{self._variant} export embeddings have cosine similarity {manifest["cosine"][self._variant]:.5f} to the '
+                             f'original embeddings, which is less than the tolerance {self.COSINE_TOLERANCE[self._variant]}')
+        self._manifest = manifest
+        self._tokenizer = AutoTokenizer.from_pretrained(self._directory)
+        self._session = self.createSession(self.getModelFile(self._variant))
+        Globals().logMessage(f'Using {self._variant} ONNX embeddings from {self._directory}')
+
+    # Create an ONNX Runtime session to run an exported model on the CPU, using the specified number of threads or one per core if 0
+    def createSession(self, modelFile):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self._threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return onnxruntime.InferenceSession(modelFile, options, providers=['CPUExecutionProvider'])
+
+    # Embed a list of texts, returning one embedding per text
+    def embed_documents(self, texts):
+        return self.embedTexts(texts, self._session).tolist()
+
+    def embed_query(self, text):
+        return self.embedTexts([text], self._session)[0].tolist()
+
+    # Compute the embeddings for a list of texts as a numpy array. Texts are embedded in batches of similar length to minimize padding.
+    def embedTexts(self, texts, session):
+        inputNames = [i.name for i in session.get_inputs()]
+        order = sorted(range(len(texts)), key=lambda n: len(texts[n]))
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self._BATCH_SIZE):
+            batch = order[start:start + self._BATCH_SIZE]
+            inputs = self._tokenizer([texts[n] for n in batch], padding=True, truncation=True, max_length=self._manifest['maxSeqLength'],
+                                     return_tensors='np')
+            feed = {name: inputs[name].astype(numpy.int64) for name in inputNames}
+            tokenEmbeddings = session.run(None, feed)[0]
+            pooled = self.pool(tokenEmbeddings, inputs['attention_mask'])
+            for n in range(len(batch)):
+                embeddings[batch[n]] = pooled[n]
+        return numpy.array(embeddings, dtype=numpy.float32)
+
+    # Export the sentence transformer to ONNX, quantizing it if needed, and check its embeddings against the PyTorch model
+    def export(self, manifest):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        Globals().logMessage(f'Exporting {self._sentenceTransformer} to ONNX in {self._directory}')
+        startTime = time.time()
+        model = SentenceTransformer(self._sentenceTransformer, device='cpu')
+        transformer = model[0]
+        tokenizer = transformer.tokenizer
+        if (manifest is None):
+            pooling = model[1]
+            manifest = {}
+            manifest['sentenceTransformer'] = self._sentenceTransformer
+            manifest['signature'] = self.getSignature()
+            if (pooling.pooling_mode_cls_token):
+                manifest['pooling'] = 'cls'
+            elif (pooling.pooling_mode_max_tokens):
+                manifest['pooling'] = 'max'
+            else:
+                manifest['pooling'] = 'mean'
+            manifest['normalize'] = any(type(module).__name__ == 'Normalize' for module in model)
+            manifest['maxSeqLength'] = model.max_seq_length
+            manifest['cosine'] = {}
+            manifest['files'] = []
+        self._manifest = manifest
+        os.makedirs(self._directory, exist_ok=True)
+        if (not os.path.exists(self.getModelFile('fp32'))):
+            sample = tokenizer(self.SAMPLE_TEXTS[:2], padding=True, truncation=True, return_tensors='pt')
+            # The export passes the inputs to forward in the order of its parameters, which may differ from the order the tokenizer
+            # returns them in, such as input_ids, token_type_ids, attention_mask for BERT tokenizers, so the inputs are named in that order
+            inputNames = [name for name in inspect.signature(transformer.auto_model.forward).parameters if (name in sample)]
+            dynamicAxes = {name: {0: 'batch', 1: 'sequence'} for name in inputNames}
+            dynamicAxes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+            inputs = {name: sample[name] for name in inputNames}
+            with torch.no_grad():
+                torch.onnx.export(transformer.auto_model.eval(), (inputs,), self.getModelFile('fp32'), input_names=inputNames,
+                                  output_names=['last_hidden_state'], dynamic_axes=dynamicAxes, opset_version=14, do_constant_folding=True)
+            manifest.setdefault('files', []).append(os.path.basename(self.getModelFile('fp32')))
+            manifest['files'].extend(os.path.basename(f) for f in tokenizer.save_pretrained(self._directory))
+        if ((self._variant == 'int8') and (not os.path.exists(self.getModelFile('int8')))):
+            from onnxruntime.quantization import QuantType
+            from onnxruntime.quantization import quantize_dynamic
+            quantize_dynamic(self.getModelFile('fp32'), self.getModelFile('int8'), weight_type=QuantType.QInt8)
+            manifest.setdefault('files', []).append(os.path.basename(self.getModelFile('int8')))
+        Globals().logMessage(f'Exported {self._variant} ONNX model in {time.time() - startTime:.3f} seconds')
+
+        # Compare the export's embeddings of the sample texts with the PyTorch model's embeddings
+        self._tokenizer = tokenizer
+        expected = model.encode(self.SAMPLE_TEXTS, convert_to_numpy=True)
+        actual = self.embedTexts(self.SAMPLE_TEXTS, self.createSession(self.getModelFile(self._variant)))
+        cosine = numpy.sum(expected * actual, axis=1) / (numpy.linalg.norm(expected, axis=1) * numpy.linalg.norm(actual, axis=1))
+        manifest['cosine'][self._variant] = float(numpy.min(cosine))
+        Globals().logMessage(f'{self._variant} ONNX embeddings have minimum cosine similarity {manifest["cosine"][self._variant]:.5f} to '
+                             f'the original embeddings, tolerance is {self.COSINE_TOLERANCE[self._variant]}')
+        with open(os.path.join(self._directory, self._MANIFEST), 'w') as manifestFile:
+            json.dump(manifest, manifestFile, indent=4)
+        return manifest
+
+    # Get the directory containing the export, next to the sentence transformer if it is a writable local directory
+    def getExportDirectory(self):
+        if (os.path.isdir(self._sentenceTransformer) and os.access(self._sentenceTransformer, os.W_OK)):
+            return os.path.join(self._sentenceTransformer, 'onnx')
+        return os.path.join(getCacheDirectory('onnx'), hashValues(self._sentenceTransformer))
+
+    def getMaxSeqLength(self):
+        return self._manifest['maxSeqLength']
+
+    def getModelFile(self, variant):
+        return os.path.join(self._directory, 'model.onnx' if (variant == 'fp32') else 'model-int8.onnx')
+
+    # Get the signature of the sentence transformer's files, or just its name if it is downloaded from HuggingFace
+    def getSignature(self):
+        if (os.path.isdir(self._sentenceTransformer)):
+            return getModelFilesSignature(self._sentenceTransformer)
+        return self._sentenceTransformer
+
+    # Pool token embeddings into one embedding per text, ignoring padding tokens
+    def pool(self, tokenEmbeddings, attentionMask):
+        mask = attentionMask[:, :, numpy.newaxis].astype(numpy.float32)
+        if (self._manifest['pooling'] == 'cls'):
+            pooled = tokenEmbeddings[:, 0]
+        elif (self._manifest['pooling'] == 'max'):
+            pooled = numpy.max(numpy.where(mask > 0, tokenEmbeddings, -1e9), axis=1)
+        else:
+            pooled = numpy.sum(tokenEmbeddings * mask, axis=1) / numpy.clip(numpy.sum(mask, axis=1), 1e-9, None)
+        if (self._manifest['normalize']):
+            pooled = pooled / numpy.clip(numpy.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    # Read the export's manifest, returning None if there is no export or the sentence transformer has changed since it was exported
+    def readManifest(self):
+        try:
+            with open(os.path.join(self._directory, self._MANIFEST)) as manifestFile:
+                manifest = json.load(manifestFile)
+        except (OSError, ValueError):
+            return None
+        if (not manifest.get('signature') == self.getSignature()):
+            return None
+        for variant in list(manifest['cosine'].keys()):
+            if (not os.path.exists(self.getModelFile(variant))):
+                manifest['cosine'].pop(variant)
+        return manifest
+
+    # Remove the files of a previous export, those listed in its manifest and any model files, so a new export does not reuse them
+    def removeExport(self):
+        files = [self._MANIFEST, os.path.basename(self.getModelFile('fp32')), os.path.basename(self.getModelFile('int8'))]
+        try:
+            with open(os.path.join(self._directory, self._MANIFEST)) as manifestFile:
+                files.extend(json.load(manifestFile).get('files', []))
+        except (OSError, ValueError):
+            pass
+        for f in set(files):
+            path = os.path.join(self._directory, os.path.basename(f))
+            if (os.path.isfile(path)):
+                Globals().logMessage(f'Removing {path} from previous ONNX export')
+                os.remove(path)
@@ -0,0 +1,51 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import multiprocessing
+from Util.Globals import Globals
+
+# Extract the text of a range of pages of a PDF in a worker process
+def extractPages(path, start, end):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return [reader.pages[n].extract_text() for n in range(start, end)]
+
+# Extract the text of each page of a PDF the same way PyPDFLoader does. Large PDFs are split into page ranges which are extracted in
+# parallel by a pool of worker processes, since extracting the text of a single PDF with thousands of pages takes minutes. The worker
+# processes are started when the first large PDF is extracted and are kept until close is called.
+class PdfExtractor():
+    # Number of pages extracted by a worker at a time
+    PAGES_PER_RANGE = 50
+    # PDFs with fewer pages than this are extracted in this process
+    MIN_PARALLEL_PAGES = 200
+
+    def __init__(self, workerCount):
+        self._workerCount = workerCount
+        self._pool = None
+
+    # Stop the worker processes
+    def close(self):
+        if (self._pool is not None):
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    # Get the text of each page of a PDF, in page order
+    def extractText(self, path):
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        pageCount = len(reader.pages)
+        if ((self._workerCount < 2) or (pageCount < self.MIN_PARALLEL_PAGES)):
+            return [page.extract_text() for page in reader.pages]
+        if (self._pool is None):
+            self._pool = multiprocessing.get_context('spawn').Pool(self._workerCount)
+        ranges = [(path, start, min(start + self.PAGES_PER_RANGE, pageCount)) for start in range(0, pageCount, self.PAGES_PER_RANGE)]
+        Globals().logMessage(f'Extracting {pageCount} pages of {path} in {len(ranges)} page ranges using {self._workerCount} workers')
+        pages = []
+        for rangePages in self._pool.starmap(extractPages, ranges):
+            pages.extend(rangePages)
+        return pages
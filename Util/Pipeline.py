@@ -0,0 +1,162 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import queue
+import threading
+import time
+
+# Marks the end of the items passed from one stage to the next
+_END = object()
+
+# One stage of a pipeline, with the bounded queue its output items are passed to the next stage through, and statistics used to report
+# how busy the stage was and how full its output queue was
+class PipelineStage():
+    def __init__(self, name, function, queueDepth):
+        self._name = name
+        self._function = function
+        self._queue = queue.Queue(maxsize=queueDepth)
+        self._elapsed = 0.0
+        self._inputWait = 0.0
+        self._outputWait = 0.0
+        self._items = 0
+        self._depthTotal = 0
+        self._depthMax = 0
+
+    def getFunction(self):
+        return self._function
+
+    def getName(self):
+        return self._name
+
+    def getQueue(self):
+        return self._queue
+
+    # Get the time the stage spent processing items and its output queue statistics
+    def getReport(self):
+        report = {}
+        report['busy'] = max(0.0, self._elapsed - self._inputWait - self._outputWait)
+        report['utilization'] = report['busy'] / self._elapsed if (self._elapsed > 0) else 0.0
+        report['inputWait'] = self._inputWait
+        report['outputWait'] = self._outputWait
+        report['items'] = self._items
+        report['averageQueueDepth'] = self._depthTotal / self._items if (self._items > 0) else 0.0
+        report['maxQueueDepth'] = self._depthMax
+        report['queueSize'] = self._queue.maxsize
+        return report
+
+    def addInputWait(self, seconds):
+        self._inputWait = self._inputWait + seconds
+
+    def addOutputWait(self, seconds):
+        self._outputWait = self._outputWait + seconds
+
+    # Record the depth of the output queue when an item is added to it
+    def addQueueDepth(self, depth):
+        self._items = self._items + 1
+        self._depthTotal = self._depthTotal + depth
+        self._depthMax = max(self._depthMax, depth)
+
+    def setElapsed(self, seconds):
+        self._elapsed = seconds
+
+# Run a sequence of stages concurrently, each in its own thread except the last, which runs in the calling thread. Each stage's function is
+# a generator which is passed an iterator over the items yielded by the previous stage, except the first stage's function, which is
+# called with no arguments. Items must not be None. Stages are connected by bounded queues, so a fast stage waits for a slow one instead
+# of buffering everything. The time each stage spends waiting for input and for space in its output queue is recorded so the bottleneck
+# stage can be found. If a stage raises an exception, all stages are stopped and the exception is raised by run.
+class Pipeline():
+    # Interval in seconds at which stages waiting on a queue check whether the pipeline has been stopped
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        self._stages = []
+        self._stop = threading.Event()
+        self._error = None
+
+    # Add a stage to the end of the pipeline, with an output queue holding up to queueDepth items
+    def addStage(self, name, function, queueDepth=4):
+        self._stages.append(PipelineStage(name, function, queueDepth))
+
+    # Get the items from the output queue of the stage preceding a stage, recording how long the stage waited for them
+    def getItems(self, stage, previousStage):
+        while (True):
+            startTime = time.perf_counter()
+            item = None
+            while ((item is None) and (not self._stop.is_set())):
+                try:
+                    item = previousStage.getQueue().get(timeout=self._POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            stage.addInputWait(time.perf_counter() - startTime)
+            if ((item is None) or (item is _END)):
+                return
+            yield item
+
+    # Get the report of each stage's statistics
+    def getReport(self):
+        return {stage.getName(): stage.getReport() for stage in self._stages}
+
+    # Log the utilization of each stage and the depth of its output queue
+    def logReport(self, logMessage):
+        for stage in self._stages:
+            report = stage.getReport()
+            message = f'Pipeline stage {stage.getName()}: busy {report["busy"]:.3f} seconds, utilization {report["utilization"] * 100:.0f}%'
+            if (not stage is self._stages[-1]):
+                message = message + (f', output queue depth average {report["averageQueueDepth"]:.1f} maximum {report["maxQueueDepth"]} '
+                                     f'of {report["queueSize"]}')
+            logMessage(message)
+
+    # Add an item to a stage's output queue, returning False if the pipeline was stopped before there was space for it
+    def putItem(self, stage, item):
+        startTime = time.perf_counter()
+        if (not item is _END):
+            stage.addQueueDepth(stage.getQueue().qsize())
+        while (not self._stop.is_set()):
+            try:
+                stage.getQueue().put(item, timeout=self._POLL_INTERVAL)
+                stage.addOutputWait(time.perf_counter() - startTime)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Run all the stages until the last stage completes, then return the report of each stage's statistics
+    def run(self):
+        threads = []
+        for n in range(len(self._stages) - 1):
+            thread = threading.Thread(target=self.runStage, args=(n,), name=f'Pipeline-{self._stages[n].getName()}', daemon=True)
+            thread.start()
+            threads.append(thread)
+        self.runStage(len(self._stages) - 1)
+        self._stop.set()
+        for thread in threads:
+            thread.join()
+        if (self._error is not None):
+            raise self._error
+        return self.getReport()
+
+    # Run one stage, passing its output to the next stage's queue
+    def runStage(self, n):
+        stage = self._stages[n]
+        startTime = time.perf_counter()
+        try:
+            if (n == 0):
+                items = stage.getFunction()()
+            else:
+                items = stage.getFunction()(self.getItems(stage, self._stages[n - 1]))
+            # Items yielded by the last stage are discarded
+            for item in items:
+                if ((stage is not self._stages[-1]) and (not self.putItem(stage, item))):
+                    break
+            if (stage is not self._stages[-1]):
+                self.putItem(stage, _END)
+        except Exception as err:
+            if (self._error is None):
+                self._error = err
+            self._stop.set()
+        finally:
+            stage.setElapsed(time.perf_counter() - startTime)
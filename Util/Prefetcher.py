@@ -0,0 +1,101 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import ctypes
+import os
+import platform
+import threading
+import time
+from Util.Globals import Globals
+
+# Read model weight files into the operating system page cache in a background thread, so a model load that follows reads its weights
+# from memory instead of from slow or network attached storage. The prefetch thread uses the idle I/O priority class on Linux so it does
+# not slow down other disk I/O, reads no more than a limit number of bytes, and is cancelled when a different model is selected.
+class Prefetcher():
+    _CHUNK_SIZE = 8 * 1048576
+    _WEIGHT_EXTENSIONS = ('.safetensors', '.bin', '.pt', '.gguf')
+    # ioprio_set system call numbers, where the I/O priority class is in the top bits of the priority value
+    _IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i686': 289}
+    _IOPRIO_WHO_PROCESS = 1
+    _IOPRIO_CLASS_IDLE = 3
+    _IOPRIO_CLASS_SHIFT = 13
+
+    def __init__(self):
+        self._thread = None
+        self._cancelEvent = threading.Event()
+
+    # Stop the running prefetch, if any. This is called from the GUI thread, so it does not wait for the prefetch thread, which may be
+    # blocked reading slow storage. The thread has its own cancel event, so it stops after its current read even if another prefetch starts.
+    def cancel(self):
+        if (self._thread is not None):
+            self._cancelEvent.set()
+            self._thread = None
+
+    # Get the weight files for a set of model paths, where a path is a model directory or a single model file
+    def getWeightFiles(self, modelPaths):
+        files = []
+        for path in modelPaths:
+            if (os.path.isfile(path)):
+                files.append(path)
+            elif (os.path.isdir(path)):
+                for f in sorted(os.listdir(path)):
+                    if (f.endswith(self._WEIGHT_EXTENSIONS)):
+                        files.append(os.path.join(path, f))
+        return files
+
+    # Start reading the weight files of the model paths into the page cache, reading at most limitBytes, after cancelling any running
+    # prefetch
+    def prefetch(self, modelPaths, limitBytes):
+        self.cancel()
+        files = self.getWeightFiles(modelPaths)
+        if ((len(files) == 0) or (limitBytes <= 0)):
+            return
+        self._cancelEvent = threading.Event()
+        self._thread = threading.Thread(target=self.readFiles, args=(files, limitBytes, self._cancelEvent), name='Prefetcher', daemon=True)
+        self._thread.start()
+
+    # Read files in chunks until they are all read, the limit is reached or the prefetch is cancelled
+    def readFiles(self, files, limitBytes, cancelEvent):
+        self.setIdlePriority()
+        startTime = time.time()
+        readBytes = 0
+        buffer = bytearray(self._CHUNK_SIZE)
+        for path in files:
+            try:
+                with open(path, 'rb', buffering=0) as weightFile:
+                    while ((readBytes < limitBytes) and (not cancelEvent.is_set())):
+                        count = weightFile.readinto(buffer)
+                        if (count == 0):
+                            break
+                        readBytes = readBytes + count
+            except OSError as err:
+                Globals().logMessage(f'Unable to prefetch {path}: {err}')
+            if ((readBytes >= limitBytes) or cancelEvent.is_set()):
+                break
+        elapsedTime = time.time() - startTime
+        if (cancelEvent.is_set()):
+            status = 'cancelled'
+        elif (readBytes >= limitBytes):
+            status = 'stopped at limit'
+        else:
+            status = 'completed'
+        rate = readBytes / 1048576.0 / elapsedTime if (elapsedTime > 0) else 0.0
+        Globals().logMessage(f'Prefetch {status}, read {readBytes / 1073741824.0:.3f}GB in {elapsedTime:.3f} seconds, {rate:.1f}MB/sec')
+
+    # Set the calling thread's I/O priority class to idle so its reads are only done when the disk is otherwise idle. This is only
+    # supported on Linux and only affects I/O schedulers which support priorities.
+    def setIdlePriority(self):
+        syscallNumber = self._IOPRIO_SET.get(platform.machine())
+        if ((not platform.system() == 'Linux') or (syscallNumber is None)):
+            return
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            # A process id of 0 applies the priority to the calling thread
+            if (libc.syscall(syscallNumber, self._IOPRIO_WHO_PROCESS, 0, self._IOPRIO_CLASS_IDLE << self._IOPRIO_CLASS_SHIFT) < 0):
+                Globals().logMessage(f'Unable to set prefetch I/O priority: {os.strerror(ctypes.get_errno())}')
+        except OSError as err:
+            Globals().logMessage(f'Unable to set prefetch I/O priority: {err}')
@@ -0,0 +1,114 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import os
+import sys
+import threading
+
+# Sampling profiler used to profile background requests. The stacks of all threads other than the profiler thread and any excluded
+# threads are sampled at a fixed interval, so work done in helper threads, for example the text generation thread started by a query,
+# is included in the profile. Samples of threads which are idle, waiting for a lock, a queue, an event or I/O, are dropped, so pipeline
+# stages waiting for work and other idle threads do not hide where time is spent. Samples are kept as folded stacks, which is the input
+# format used by flamegraph.pl and speedscope.
+class SamplingProfiler():
+    # Functions, by file name and function name, which a thread is waiting in when the function is the innermost Python frame of its stack
+    IDLE_FUNCTIONS = {('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('queue.py', 'get'),
+                      ('selectors.py', 'select'), ('connection.py', '_recv'), ('connection.py', '_poll'), ('socket.py', 'accept'),
+                      ('socket.py', 'readinto')}
+
+    def __init__(self, interval=0.005, excludeThreads=None):
+        self._interval = interval
+        self._excludeThreads = set()
+        if (excludeThreads is not None):
+            self._excludeThreads.update(excludeThreads)
+        self._stacks = {}
+        self._sampleCount = 0
+        self._idleCount = 0
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    # Get the number of thread stacks dropped because the thread was idle
+    def getIdleCount(self):
+        return self._idleCount
+
+    # Get the number of times the threads were sampled
+    def getSampleCount(self):
+        return self._sampleCount
+
+    # Get the number of samples in which each thread was busy, by thread name
+    def getThreadSamples(self):
+        threadSamples = {}
+        for stack, samples in self._stacks.items():
+            threadName = stack.split(';')[0]
+            threadSamples[threadName] = threadSamples.get(threadName, 0) + samples
+        return threadSamples
+
+    # Get the total number of busy thread samples, the sum of the samples of every thread
+    def getBusySampleCount(self):
+        return sum(self._stacks.values())
+
+    # Start sampling thread stacks
+    def start(self):
+        self._stacks = {}
+        self._sampleCount = 0
+        self._idleCount = 0
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self.sampleStacks, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    # Stop sampling thread stacks
+    def stop(self):
+        self._stopEvent.set()
+        if (self._thread is not None):
+            self._thread.join()
+            self._thread = None
+
+    # Record the current stack of each thread until the profiler is stopped
+    def sampleStacks(self):
+        excluded = set(self._excludeThreads)
+        excluded.add(threading.get_ident())
+        while (not self._stopEvent.wait(self._interval)):
+            threadNames = {}
+            for thread in threading.enumerate():
+                threadNames[thread.ident] = thread.name
+            for threadId, frame in sys._current_frames().items():
+                if (threadId in excluded):
+                    continue
+                if ((os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in self.IDLE_FUNCTIONS):
+                    self._idleCount = self._idleCount + 1
+                    continue
+                stack = []
+                while (frame is not None):
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(threadNames.get(threadId, f'Thread-{threadId}'))
+                stack.reverse()
+                key = ';'.join(stack)
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self._sampleCount = self._sampleCount + 1
+
+    # Get the functions with the most samples as a list of (function, self samples, total samples) tuples, ordered by self samples
+    def getTopFunctions(self, count=10):
+        selfSamples = {}
+        totalSamples = {}
+        for stack, samples in self._stacks.items():
+            frames = stack.split(';')[1:]
+            if (len(frames) == 0):
+                continue
+            selfSamples[frames[-1]] = selfSamples.get(frames[-1], 0) + samples
+            # Count recursive functions once per stack so total samples never exceed the number of samples taken
+            for function in set(frames):
+                totalSamples[function] = totalSamples.get(function, 0) + samples
+        functions = sorted(selfSamples.keys(), key=lambda f: (selfSamples[f], totalSamples[f]), reverse=True)
+        return [(f, selfSamples[f], totalSamples[f]) for f in functions[:count]]
+
+    # Write the samples as folded stacks, one stack per line followed by the sample count
+    def writeFoldedStacks(self, path):
+        with open(path, 'w') as outputFile:
+            for stack, samples in sorted(self._stacks.items()):
+                outputFile.write(f'{stack} {samples}\n')
@@ -0,0 +1,53 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import json
+import os
+import shutil
+from Util.Cache import getCacheDirectory
+from Util.Cache import getModelFilesSignature
+from Util.Cache import hashValues
+
+# Models quantized by bitsandbytes while loading, saved on disk so later loads read the quantized weights directly instead of loading the
+# full precision weights and quantizing them again. Each cached model has a manifest recording the signature of the original model's files
+# and the quantization settings, and is only used while both still match.
+class QuantizedModelCache():
+    _MANIFEST = 'DocAssistantManifest.json'
+
+    def __init__(self):
+        self._directory = getCacheDirectory('quantized')
+
+    # Get the directory holding the cached copy of a model quantized with the specified settings
+    def getModelDirectory(self, modelPath, settings):
+        return os.path.join(self._directory, hashValues(os.path.abspath(modelPath), settings))
+
+    # Check whether there is a cached quantized copy of the model matching the model's current files and the quantization settings
+    def isValid(self, modelPath, settings):
+        manifestPath = os.path.join(self.getModelDirectory(modelPath, settings), self._MANIFEST)
+        try:
+            with open(manifestPath) as manifestFile:
+                manifest = json.load(manifestFile)
+        except (OSError, ValueError):
+            return False
+        return (manifest.get('signature') == getModelFilesSignature(modelPath)) and (manifest.get('settings') == json.loads(json.dumps(settings)))
+
+    # Save a quantized model. The model is written to a temporary directory first so an interrupted save never leaves a cache entry that
+    # looks valid.
+    def saveModel(self, model, modelPath, settings):
+        modelDirectory = self.getModelDirectory(modelPath, settings)
+        temporaryDirectory = modelDirectory + '.tmp'
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+        model.save_pretrained(temporaryDirectory, safe_serialization=True)
+        manifest = {}
+        manifest['modelPath'] = os.path.abspath(modelPath)
+        manifest['signature'] = getModelFilesSignature(modelPath)
+        manifest['settings'] = settings
+        with open(os.path.join(temporaryDirectory, self._MANIFEST), 'w') as manifestFile:
+            json.dump(manifest, manifestFile, indent=4)
+        shutil.rmtree(modelDirectory, ignore_errors=True)
+        os.replace(temporaryDirectory, modelDirectory)
+        return modelDirectory
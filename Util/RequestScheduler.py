@@ -0,0 +1,145 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import queue
+import sys
+import threading
+import traceback
+
+# Lock allowing any number of shared holders or a single exclusive holder. Waiting exclusive holders are given priority so a model load
+# is not starved by a steady stream of queries.
+class SharedExclusiveLock():
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sharedCount = 0
+        self._exclusive = False
+        self._exclusiveWaiting = 0
+
+    def acquireExclusive(self):
+        with self._condition:
+            self._exclusiveWaiting = self._exclusiveWaiting + 1
+            while (self._exclusive or (self._sharedCount > 0)):
+                self._condition.wait()
+            self._exclusiveWaiting = self._exclusiveWaiting - 1
+            self._exclusive = True
+
+    def acquireShared(self):
+        with self._condition:
+            while (self._exclusive or (self._exclusiveWaiting > 0)):
+                self._condition.wait()
+            self._sharedCount = self._sharedCount + 1
+
+    def releaseExclusive(self):
+        with self._condition:
+            self._exclusive = False
+            self._condition.notify_all()
+
+    def releaseShared(self):
+        with self._condition:
+            self._sharedCount = self._sharedCount - 1
+            self._condition.notify_all()
+
+# A request waiting in or processed by the scheduler
+class ScheduledRequest():
+    def __init__(self, request, exclusive, completionHandler, lockName):
+        self._request = request
+        self._exclusive = exclusive
+        self._lockName = lockName
+        self._completionHandler = completionHandler
+        self._error = None
+        self._done = threading.Event()
+
+    # Get the exception raised by the request, or None if it completed normally
+    def getError(self):
+        return self._error
+
+    def getLockName(self):
+        return self._lockName
+
+    def getRequest(self):
+        return self._request
+
+    def isExclusive(self):
+        return self._exclusive
+
+    # Run the request and notify anyone waiting for it to complete
+    def run(self):
+        try:
+            self._request.processRequest()
+        except Exception as err:
+            self._error = err
+            print(f"Scheduled request handling encountered an exception with type {type(err)}, traceback is")
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            self._done.set()
+            if (self._completionHandler is not None):
+                self._completionHandler()
+
+    # Wait for the request to complete, returning False if the timeout expires first
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+# Run requests on a fixed set of worker threads. The number of worker threads limits how many requests run concurrently and the
+# queue depth limits how many requests may wait, so submit raises queue.Full when the server is overloaded instead of accepting work it
+# cannot start soon. Exclusive requests, such as loading a model, wait for running requests with the same lock name to finish and block
+# new ones while they run. Requests with different lock names, for example requests for different sessions, do not block each other.
+class RequestScheduler():
+    def __init__(self, workerCount, queueDepth):
+        self._queue = queue.Queue(maxsize=queueDepth)
+        self._locks = {}
+        self._runningCount = 0
+        self._countLock = threading.Lock()
+        self._workers = []
+        for n in range(workerCount):
+            worker = threading.Thread(target=self.processRequests, name=f'RequestWorker-{n}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    # Get the lock used for requests with the specified lock name
+    def getLock(self, lockName):
+        with self._countLock:
+            if (lockName not in self._locks):
+                self._locks[lockName] = SharedExclusiveLock()
+            return self._locks[lockName]
+
+    # Get the number of requests waiting to run
+    def getQueuedCount(self):
+        return self._queue.qsize()
+
+    # Get the number of requests currently running
+    def getRunningCount(self):
+        return self._runningCount
+
+    def getWorkerCount(self):
+        return len(self._workers)
+
+    # Run queued requests until the process exits
+    def processRequests(self):
+        while (True):
+            scheduledRequest = self._queue.get()
+            lock = self.getLock(scheduledRequest.getLockName())
+            if (scheduledRequest.isExclusive()):
+                lock.acquireExclusive()
+            else:
+                lock.acquireShared()
+            with self._countLock:
+                self._runningCount = self._runningCount + 1
+            try:
+                scheduledRequest.run()
+            finally:
+                with self._countLock:
+                    self._runningCount = self._runningCount - 1
+                if (scheduledRequest.isExclusive()):
+                    lock.releaseExclusive()
+                else:
+                    lock.releaseShared()
+
+    # Queue a request to be run, raising queue.Full if too many requests are already waiting
+    def submit(self, request, exclusive=False, completionHandler=None, lockName=None):
+        scheduledRequest = ScheduledRequest(request, exclusive, completionHandler, lockName)
+        self._queue.put_nowait(scheduledRequest)
+        return scheduledRequest
@@ -0,0 +1,125 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import os
+import threading
+import time
+
+# State for one user of the application: a document store, a model, draft model and tokenizer and the queries running in the session, by
+# request id, so they can be stopped. Requests carry the session they operate on, so several sessions can hold different indexes and models
+# at the same time. Each query has its own stop flag, so stopping one query does not affect other queries, in this session or another.
+class Session():
+    def __init__(self, name):
+        self._name = name
+        self._documentStore = None
+        self._metadataIndex = None
+        self._model = None
+        self._draftModel = None
+        self._tokenizer = None
+        self._queries = {}
+        self._queryLock = threading.Lock()
+        self._lastUsed = time.time()
+
+    def getDocumentStore(self):
+        return self._documentStore
+
+    def getDraftModel(self):
+        return self._draftModel
+
+    def getLastUsed(self):
+        return self._lastUsed
+
+    # Add a query to the queries which can be stopped in this session
+    def addQuery(self, request):
+        with self._queryLock:
+            self._queries[request.getRequestId()] = request
+
+    # Get an estimate of the memory in bytes used by the document store in this session
+    def getDocumentStoreMemoryUsage(self):
+        if (self._documentStore is None):
+            return 0
+        index = self._documentStore.index
+        return index.ntotal * index.d * 4
+
+    # Get an estimate of the memory in bytes used by the model and the document store in this session
+    def getMemoryUsage(self):
+        return self.getModelMemoryUsage() + self.getDocumentStoreMemoryUsage()
+
+    # Get the index of the document store's chunk metadata used to filter queries, building it when it is first used
+    def getMetadataIndex(self):
+        from Util.MetadataIndex import MetadataIndex
+        if ((self._metadataIndex is None) and (self._documentStore is not None)):
+            self._metadataIndex = MetadataIndex(self._documentStore)
+        return self._metadataIndex
+
+    def getModel(self):
+        return self._model
+
+    # Get an estimate of the memory in bytes used by the model, and its draft model if there is one, in this session
+    def getModelMemoryUsage(self):
+        if (self._model is None):
+            return 0
+        if (hasattr(self._model, 'get_memory_footprint')):
+            if (self._draftModel is not None):
+                return self.getModelFootprint(self._model) + self.getModelFootprint(self._draftModel)
+            return self.getModelFootprint(self._model)
+        if (hasattr(self._model, 'model_path') and os.path.isfile(self._model.model_path)):
+            return os.path.getsize(self._model.model_path)
+        return 0
+
+    # Get the memory in bytes used by a transformers model. Linear layers quantized to int8 by quantize_dynamic keep their weights and
+    # biases in packed parameters, which are neither parameters nor buffers, so get_memory_footprint does not count them.
+    def getModelFootprint(self, model):
+        footprint = model.get_memory_footprint()
+        for module in model.modules():
+            packedParams = getattr(module, '_packed_params', None)
+            if (hasattr(packedParams, '_weight_bias')):
+                weight, bias = packedParams._weight_bias()
+                footprint = footprint + weight.numel() * weight.element_size()
+                if (bias is not None):
+                    footprint = footprint + bias.numel() * bias.element_size()
+        return footprint
+
+    def getName(self):
+        return self._name
+
+    def getTokenizer(self):
+        return self._tokenizer
+
+    def removeQuery(self, request):
+        with self._queryLock:
+            self._queries.pop(request.getRequestId(), None)
+
+    def setDocumentStore(self, store):
+        self._documentStore = store
+        self._metadataIndex = None
+        self.touch()
+
+    def setDraftModel(self, model):
+        self._draftModel = model
+
+    def setModel(self, model):
+        self._model = model
+        self.touch()
+
+    def setTokenizer(self, tokenizer):
+        self._tokenizer = tokenizer
+
+    # Stop the query with a request id, or all the queries in this session if the request id is None. Returns the number of queries stopped.
+    def stopQueries(self, requestId=None):
+        with self._queryLock:
+            if (requestId is None):
+                requests = list(self._queries.values())
+            else:
+                requests = [self._queries[requestId]] if (requestId in self._queries) else []
+        for request in requests:
+            request.stop()
+        return len(requests)
+
+    # Record that the session was just used
+    def touch(self):
+        self._lastUsed = time.time()
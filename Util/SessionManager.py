@@ -0,0 +1,85 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import threading
+from Util.ModelCache import ModelCache
+from Util.Session import Session
+
+# Keep track of the sessions in the application, the models kept resident for them and the memory budget they share. The GUI uses the
+# default session, while the HTTP server creates a session for each session name used by its clients.
+class SessionManager():
+    DEFAULT_SESSION = 'default'
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._loadLock = threading.Lock()
+        self._memoryBudget = 0
+        self._modelCache = ModelCache()
+
+    def getDefaultSession(self):
+        return self.getSession(self.DEFAULT_SESSION)
+
+    # Get the memory budget in bytes shared by all sessions, 0 if memory use is not limited
+    def getMemoryBudget(self):
+        return self._memoryBudget
+
+    # Get the lock held while a model or document index is loaded, from checking the memory budget until the memory it uses is counted, so
+    # loads in different sessions can not together exceed the memory budget
+    def getLoadLock(self):
+        return self._loadLock
+
+    # Get an estimate of the memory in bytes used by all resident models and the document stores of all sessions
+    def getMemoryUsage(self):
+        return self._modelCache.getMemoryUsage() + sum(session.getDocumentStoreMemoryUsage() for session in self.getSessions())
+
+    def getModelCache(self):
+        return self._modelCache
+
+    # Get the named session, creating it if it does not exist
+    def getSession(self, name):
+        with self._lock:
+            if (name not in self._sessions):
+                self._sessions[name] = Session(name)
+            return self._sessions[name]
+
+    def getSessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    # Get the models currently used by any session
+    def getModelsInUse(self):
+        return [session.getModel() for session in self.getSessions() if (session.getModel() is not None)]
+
+    # Check whether an additional memoryBytes can be used without exceeding the memory budget
+    def hasMemoryFor(self, memoryBytes):
+        if (self._memoryBudget <= 0):
+            return True
+        return (self.getMemoryUsage() + memoryBytes) <= self._memoryBudget
+
+    # Evict resident models not used by any session until another model using memoryBytes can be loaded within the memory budget and
+    # the maximum number of resident models. Returns the number of models evicted, or None if enough models cannot be evicted. The caller
+    # should run the garbage collector afterwards to release the evicted models' memory.
+    def makeRoomForModel(self, memoryBytes):
+        storeMemory = sum(session.getDocumentStoreMemoryUsage() for session in self.getSessions())
+        def fits(count, memory):
+            if (count >= self._modelCache.getMaxModels()):
+                return False
+            return (self._memoryBudget <= 0) or ((storeMemory + memory + memoryBytes) <= self._memoryBudget)
+        evicted = self._modelCache.evictModels(self.getModelsInUse(), fits)
+        if (evicted is None):
+            return None
+        return len(evicted)
+
+    # Remove a session so the memory used by its model and document store can be recovered
+    def removeSession(self, name):
+        with self._lock:
+            return self._sessions.pop(name, None)
+
+    # Set the memory budget in bytes shared by all sessions, 0 to not limit memory use
+    def setMemoryBudget(self, memoryBudget):
+        self._memoryBudget = memoryBudget
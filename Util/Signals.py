@@ -0,0 +1,17 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+from PySide6.QtCore import QObject
+from PySide6.QtCore import Signal
+
+# Signals used to pass answers and log messages from the worker thread to the GUI. These are kept out of Globals so the request classes can
+# be used by the command line tools without loading Qt.
+class ResultSignal(QObject):
+    resultMessage = Signal(str)
+
+class LogSignal(QObject):
+    logMessage = Signal(str)
@@ -0,0 +1,78 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import bisect
+import re
+from Util.Globals import Globals
+
+# Split text into chunks of a target number of tokens of the embedding model's tokenizer, so every chunk fits the sentence transformer and
+# chunks are of even size. Each text is tokenized once by the fast tokenizer, which also gives each token's character offsets, and chunk
+# boundaries are found in a single pass over the tokens rather than by recursively retrying separators. If sentence snapping is enabled,
+# a chunk ends at the last sentence boundary in its second half, if there is one, so chunks do not end in the middle of a sentence. Chunk
+# overlap is also counted in tokens. The chunk size is limited to the number of tokens the sentence transformer embeds, less its special
+# tokens, so no part of a chunk is truncated when it is embedded. Chunks are created the same way as by
+# RecursiveCharacterTextSplitter.create_documents, with the offset of each chunk in the text in its start_index metadata.
+class TokenAwareSplitter():
+    # End of a sentence, followed by white space, or a blank line, where the sentence ends at the start of the white space
+    _SENTENCE_END = re.compile(r'[.!?]["\')\]]*(?=\s)|\s*\n\s*\n')
+    # Tokenizers with no maximum length report a very large value as their maximum length
+    _NO_MAX_LENGTH = 1000000
+
+    # Create a splitter using a tokenizer, with the maximum number of tokens embedded by the sentence transformer if known, otherwise the
+    # tokenizer's maximum length is used. Raises ValueError if the tokenizer is not a fast tokenizer, since only fast tokenizers give the
+    # character offsets of tokens.
+    def __init__(self, tokenizer, chunkTokens, overlapTokens, snapSentences, maxSeqLength=None):
+        if (not getattr(tokenizer, 'is_fast', False)):
+            raise ValueError(f'Chunk size can not be counted in tokens with the {type(tokenizer).__name__} tokenizer, which does not give '
+                             f'token offsets, count chunk size in characters instead')
+        self._tokenizer = tokenizer
+        maxTokens = tokenizer.model_max_length if (maxSeqLength is None) else min(maxSeqLength, tokenizer.model_max_length)
+        if (maxTokens < self._NO_MAX_LENGTH):
+            maxTokens = maxTokens - tokenizer.num_special_tokens_to_add()
+            if (chunkTokens > maxTokens):
+                Globals().logMessage(f'Chunk size reduced from {chunkTokens} to {maxTokens} tokens, the most the sentence transformer embeds')
+                chunkTokens = maxTokens
+        self._chunkTokens = max(1, chunkTokens)
+        self._overlapTokens = min(max(0, overlapTokens), self._chunkTokens // 2)
+        self._snapSentences = snapSentences
+
+    # Create a document for each chunk of each text, copying the text's metadata and adding the chunk's offset in the text
+    def create_documents(self, texts, metadatas=None):
+        from langchain_core.documents import Document
+        documents = []
+        for n in range(len(texts)):
+            metadata = metadatas[n] if (metadatas is not None) else {}
+            for startIndex, chunk in self.splitText(texts[n]):
+                chunkMetadata = dict(metadata)
+                chunkMetadata['start_index'] = startIndex
+                documents.append(Document(page_content=chunk, metadata=chunkMetadata))
+        return documents
+
+    # Get the indexes of the tokens which end a sentence, in increasing order
+    def getSentenceEnds(self, text, offsets):
+        sentenceEnds = {match.start() if (match.group()[0].isspace()) else match.end() for match in self._SENTENCE_END.finditer(text)}
+        return [n for n in range(len(offsets)) if (offsets[n][1] in sentenceEnds)]
+
+    # Split a text into chunks, returning the offset and text of each chunk
+    def splitText(self, text):
+        offsets = self._tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)['offset_mapping']
+        tokenCount = len(offsets)
+        sentenceEnds = self.getSentenceEnds(text, offsets) if (self._snapSentences) else []
+        chunks = []
+        start = 0
+        while (start < tokenCount):
+            end = min(start + self._chunkTokens, tokenCount)
+            if ((end < tokenCount) and (len(sentenceEnds) > 0)):
+                # Find the last sentence end in the second half of the chunk
+                n = bisect.bisect_right(sentenceEnds, end - 1) - 1
+                if ((n >= 0) and (sentenceEnds[n] >= start + self._chunkTokens // 2)):
+                    end = sentenceEnds[n] + 1
+            chunks.append((offsets[start][0], text[offsets[start][0]:offsets[end - 1][1]]))
+            if (end == tokenCount):
+                break
+            start = max(end - self._overlapTokens, start + 1)
+        return chunks
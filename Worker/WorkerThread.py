@@ -6,10 +6,15 @@
 # Copyright 2024 David Wootton
 
 from multiprocessing import Queue
+import os
 import sys
+import threading
+import time
 import traceback
 
 from PySide6.QtCore import QThread
+from Util.Globals import Globals
+from Util.Profiler import SamplingProfiler
 
 
 class WorkerThread(QThread):
@@ -20,6 +25,8 @@ class WorkerThread(QThread):
         self._requestQueue = Queue()
         self._shutdownRequested = False
         self._instance = None
+        self._profileCount = 0
+        self._profileDirectory = None
         
     def __new__(cls):
         if (not hasattr(cls, 'instance')):
@@ -32,6 +39,30 @@ class WorkerThread(QThread):
     def enqueue(self, request):
         self._requestQueue.put(request)
         
+    # Run a request under the sampling profiler, saving the samples as folded stacks and logging the functions with the most samples
+    def profileRequest(self, request):
+        requestName = type(request).__name__
+        profiler = SamplingProfiler(excludeThreads=[threading.main_thread().ident])
+        profiler.start()
+        try:
+            request.processRequest()
+        finally:
+            profiler.stop()
+            os.makedirs(self._profileDirectory, exist_ok=True)
+            profilePath = os.path.join(self._profileDirectory, f'{time.strftime("%Y%m%d-%H%M%S")}-{requestName}.folded')
+            profiler.writeFoldedStacks(profilePath)
+            Globals().logMessage(f'Saved {profiler.getBusySampleCount()} busy thread samples from {profiler.getSampleCount()} samples for '
+                                 f'{requestName} to {profilePath}, dropped {profiler.getIdleCount()} idle thread samples')
+            # Each thread's busy percentage is relative to the number of times the threads were sampled, so it is the fraction of the
+            # request's elapsed time the thread was busy. Function percentages are relative to the busy samples of all threads.
+            sampleCount = max(profiler.getSampleCount(), 1)
+            for threadName, threadSamples in sorted(profiler.getThreadSamples().items(), key=lambda t: t[1], reverse=True):
+                Globals().logMessage(f'Thread {threadName} busy {100.0 * threadSamples / sampleCount:5.1f}%')
+            busyCount = max(profiler.getBusySampleCount(), 1)
+            Globals().logMessage('Top functions by self time:')
+            for function, selfSamples, totalSamples in profiler.getTopFunctions():
+                Globals().logMessage(f'    self {100.0 * selfSamples / busyCount:5.1f}% total {100.0 * totalSamples / busyCount:5.1f}% {function}')
+
     def requestShutdown(self):
         self._shutdownRequested = True
             
@@ -39,7 +70,16 @@ class WorkerThread(QThread):
         while (not self._shutdownRequested):
             request = self.dequeue()
             try:
-                request.processRequest()
+                if ((self._profileCount > 0) and request.isProfilable()):
+                    self._profileCount = self._profileCount - 1
+                    self.profileRequest(request)
+                else:
+                    request.processRequest()
             except Exception as err:
                 print(f"Worker thread request handling encountered an exception with type {type(err)}, traceback is")
                 traceback.print_exc(file=sys.stdout)
+
+    # Profile the next requestCount requests, saving profile output in outputDirectory
+    def setProfiling(self, requestCount, outputDirectory):
+        self._profileDirectory = outputDirectory
+        self._profileCount = requestCount
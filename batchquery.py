@@ -0,0 +1,166 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+# Command line tool to run a file of questions against a document index and model without the GUI. The model and query profiles are
+# read from the profiles file used by the GUI. One JSON record per question, containing the answer, the docstore ids of the document
+# chunks used to answer it and the per-query timings, is written to the output file. Progress messages are written to stderr and a JSON
+# throughput summary is written to stdout.
+
+import argparse
+import json
+import os
+import sys
+import time
+from Request.LoadIndexRequest import LoadIndexRequest
+from Request.LoadModelRequest import LoadModelRequest
+from Request.QueryRequest import QueryRequest
+from Util.Embeddings import EMBEDDING_FORMATS
+from Util.Globals import Globals
+from Util.MetadataIndex import parseFilters
+
+EXIT_OK = 0
+EXIT_BAD_PROFILE = 3
+EXIT_LOAD_FAILED = 4
+EXIT_QUERY_FAILED = 5
+EXIT_BAD_FILTER = 6
+
+# Read questions from a text file with one question per line, or from a JSONL file with a question field in each record
+def readQuestions(path):
+    questions = []
+    with open(path) as questionFile:
+        for line in questionFile:
+            line = line.strip()
+            if ((len(line) == 0) or line.startswith('#')):
+                continue
+            if (path.endswith('.jsonl')):
+                questions.append(json.loads(line)['question'])
+            else:
+                questions.append(line)
+    return questions
+
+# Get the value at a percentile of a sorted list of values
+def percentile(values, fraction):
+    if (len(values) == 0):
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Run a file of questions against a document index and model')
+    parser.add_argument('-i', '--index', required=True, help='Directory containing the saved document index')
+    parser.add_argument('-q', '--questions', required=True, help='Text file with one question per line, or JSONL file with a question field')
+    parser.add_argument('-o', '--output', required=True, help='JSONL file to write answers and timings to')
+    parser.add_argument('--profiles', default=f'{os.path.expanduser("~")}/.DocAssistantProfile.json', help='Profiles file')
+    parser.add_argument('--model-profile', help='Model profile name, the profile selected in the GUI if not specified')
+    parser.add_argument('--query-profile', help='Query profile name, the profile selected in the GUI if not specified')
+    parser.add_argument('--sentence-transformer', default='', help='Sentence transformer used when the index was built')
+    parser.add_argument('--embedding-format', choices=EMBEDDING_FORMATS, default='pytorch',
+                        help='Format the sentence transformer is run in, ONNX formats are faster on a CPU')
+    parser.add_argument('--filter', default='', help='Only search document chunks matching the filter, for example "type=pdf source=manual.pdf"')
+    parser.add_argument('--max-new-tokens', type=int, default=512, help='Maximum number of new tokens per answer')
+    parser.add_argument('--matches', type=int, default=4, help='Number of document matches per question')
+    return parser.parse_args()
+
+def main():
+    args = parseArguments()
+    summary = {}
+    profiles = json.load(open(args.profiles))
+    Globals().setProfiles(profiles)
+    modelProfileName = args.model_profile if (args.model_profile is not None) else profiles.get('selectedModel')
+    queryProfileName = args.query_profile if (args.query_profile is not None) else profiles.get('selectedQueryProfile')
+    if (modelProfileName not in profiles['modelProfiles']):
+        summary['status'] = 'badProfile'
+        summary['error'] = f'Model profile {modelProfileName} not found'
+        print(json.dumps(summary))
+        return EXIT_BAD_PROFILE
+    if (queryProfileName not in profiles['queryProfiles']):
+        summary['status'] = 'badProfile'
+        summary['error'] = f'Query profile {queryProfileName} not found'
+        print(json.dumps(summary))
+        return EXIT_BAD_PROFILE
+    summary['modelProfile'] = modelProfileName
+    summary['queryProfile'] = queryProfileName
+    questions = readQuestions(args.questions)
+    try:
+        filters = parseFilters(args.filter)
+    except ValueError as err:
+        summary['status'] = 'badFilter'
+        summary['error'] = str(err)
+        print(json.dumps(summary))
+        return EXIT_BAD_FILTER
+
+    # Load the index and the model
+    summary['timings'] = {}
+    try:
+        startTime = time.time()
+        request = LoadIndexRequest()
+        request.setIndexParameters(args.index, args.sentence_transformer)
+        request.setEmbeddingFormat(args.embedding_format)
+        request.processRequest()
+        summary['timings']['loadIndex'] = time.time() - startTime
+        startTime = time.time()
+        request = LoadModelRequest()
+        request.setModelParameters(profiles['modelProfiles'][modelProfileName])
+        request.processRequest()
+        summary['timings']['loadModel'] = time.time() - startTime
+    except Exception as err:
+        summary['error'] = f'{type(err).__name__}: {err}'
+    session = Globals().getDefaultSession()
+    if ((session.getDocumentStore() is None) or (session.getModel() is None)):
+        summary['status'] = 'loadFailed'
+        print(json.dumps(summary))
+        return EXIT_LOAD_FAILED
+
+    # Run the questions in order, writing one record per question as soon as it completes
+    latencies = []
+    decodeRates = []
+    acceptanceRates = []
+    failures = 0
+    startTime = time.time()
+    with open(args.output, 'w') as outputFile:
+        for n in range(len(questions)):
+            Globals().logMessage(f'Query {n + 1} of {len(questions)}')
+            request = QueryRequest()
+            request.setQueryParameters(questions[n], profiles['queryProfiles'][queryProfileName], args.max_new_tokens, args.matches)
+            request.setFilters(filters)
+            request.setAnswerHandler(lambda text: None)
+            record = {}
+            record['index'] = n
+            record['question'] = questions[n]
+            try:
+                request.processRequest()
+                record.update(request.getResult())
+                latencies.append(record['timings']['total'])
+                if ('decodeTokensPerSecond' in record):
+                    decodeRates.append(record['decodeTokensPerSecond'])
+                if ('draftAcceptanceRate' in record):
+                    acceptanceRates.append(record['draftAcceptanceRate'])
+            except Exception as err:
+                record['error'] = f'{type(err).__name__}: {err}'
+                failures = failures + 1
+            outputFile.write(json.dumps(record) + '\n')
+            outputFile.flush()
+    elapsedTime = time.time() - startTime
+
+    latencies.sort()
+    summary['queries'] = len(questions)
+    summary['failures'] = failures
+    summary['timings']['queries'] = elapsedTime
+    summary['queriesPerSecond'] = len(latencies) / elapsedTime if (elapsedTime > 0) else 0.0
+    summary['latency'] = {}
+    summary['latency']['mean'] = sum(latencies) / len(latencies) if (len(latencies) > 0) else 0.0
+    summary['latency']['p50'] = percentile(latencies, 0.5)
+    summary['latency']['p95'] = percentile(latencies, 0.95)
+    summary['latency']['max'] = latencies[-1] if (len(latencies) > 0) else 0.0
+    summary['decodeTokensPerSecond'] = sum(decodeRates) / len(decodeRates) if (len(decodeRates) > 0) else 0.0
+    if (len(acceptanceRates) > 0):
+        summary['draftAcceptanceRate'] = sum(acceptanceRates) / len(acceptanceRates)
+    summary['status'] = 'ok' if (failures == 0) else 'queryFailed'
+    print(json.dumps(summary))
+    return EXIT_OK if (failures == 0) else EXIT_QUERY_FAILED
+
+if (__name__ == '__main__'):
+    sys.exit(main())
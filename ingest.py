@@ -0,0 +1,144 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+# Command line tool to build a FAISS document index without the GUI. Directories are crawled recursively and glob patterns are expanded,
+# keeping files with a supported document type. The index is written with save_local so it can be loaded with File->Load Document Index.
+# Progress messages are written to stderr and a JSON summary is written to stdout. Invalid arguments exit with status 2.
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from Request.LoadDocumentsRequest import LoadDocumentsRequest
+from Util.Embeddings import EMBEDDING_FORMATS
+from Util.Globals import Globals
+
+EXIT_OK = 0
+EXIT_NO_DOCUMENTS = 3
+EXIT_INGEST_FAILED = 4
+EXIT_SAVE_FAILED = 5
+
+# Expand the command line inputs into a sorted list of documents with a supported file type
+def findDocuments(inputs, extensions, recursive):
+    candidates = []
+    for item in inputs:
+        if (item.startswith('http')):
+            candidates.append(item)
+        elif (os.path.isdir(item)):
+            if (recursive):
+                for directory, subdirectories, files in os.walk(item):
+                    subdirectories.sort()
+                    for f in files:
+                        candidates.append(os.path.join(directory, f))
+            else:
+                for f in sorted(os.listdir(item)):
+                    if (os.path.isfile(os.path.join(item, f))):
+                        candidates.append(os.path.join(item, f))
+        elif (glob.has_magic(item)):
+            candidates.extend(glob.glob(item, recursive=True))
+        else:
+            candidates.append(item)
+    documents = []
+    seen = set()
+    for candidate in candidates:
+        if (candidate.startswith('http')):
+            key = candidate
+        else:
+            if (not os.path.isfile(candidate)):
+                Globals().logMessage(f'Skipping {candidate}, not a file')
+                continue
+            if (not candidate.endswith(extensions)):
+                continue
+            key = os.path.realpath(candidate)
+        if (key not in seen):
+            seen.add(key)
+            documents.append(candidate)
+    documents.sort()
+    return documents
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Build a document index without the GUI')
+    parser.add_argument('inputs', nargs='+', help='Documents, directories or glob patterns to index')
+    parser.add_argument('-o', '--output', required=True, help='Directory to write the index to')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Size of text chunks in chunk units')
+    parser.add_argument('--overlap', type=int, default=100, help='Overlap between text chunks in chunk units')
+    parser.add_argument('--chunk-units', choices=('characters', 'tokens'), default='characters',
+                        help='Count chunk size and overlap in characters or in tokens of the sentence transformer')
+    parser.add_argument('--snap-sentences', action='store_true', help='End token chunks at a sentence boundary where possible')
+    parser.add_argument('--small-to-big', type=int, default=0, metavar='CONTEXT_SIZE',
+                        help='Index chunks without overlap and expand matches to this many characters of context, 0 to index overlapping chunks')
+    parser.add_argument('--sentence-transformer', default='', help='Path or name of the sentence transformer used for embeddings')
+    parser.add_argument('--embedding-format', choices=EMBEDDING_FORMATS, default='pytorch',
+                        help='Format the sentence transformer is run in, ONNX formats are faster on a CPU')
+    parser.add_argument('--embedding-workers', type=int, default=0,
+                        help='Number of worker processes embedding chunks, each using its own share of the CPU cores, 0 to embed in this process')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Number of worker processes extracting the pages of large PDFs, 0 to extract pages in this process')
+    parser.add_argument('--csv-rows', type=int, default=0,
+                        help='Stream CSV files in chunks of this many rows with the header repeated, 0 to split them like other documents')
+    parser.add_argument('--deduplicate', action='store_true', help='Remove chunks which duplicate an earlier chunk before embedding them')
+    parser.add_argument('--near-duplicate-similarity', type=float, default=0.85,
+                        help='Jaccard similarity above which chunks are near duplicates when deduplicating, 1 to only remove exact duplicates')
+    parser.add_argument('--no-recursive', action='store_true', help='Do not crawl subdirectories')
+    parser.add_argument('--extensions', default=','.join(LoadDocumentsRequest.DOCUMENT_EXTENSIONS),
+                        help='Comma separated list of file name extensions to index')
+    return parser.parse_args()
+
+def main():
+    args = parseArguments()
+    summary = {}
+    summary['output'] = args.output
+    extensions = tuple(e.strip() for e in args.extensions.split(',') if (len(e.strip()) > 0))
+    startTime = time.time()
+    documents = findDocuments(args.inputs, extensions, not args.no_recursive)
+    summary['documents'] = len(documents)
+    summary['timings'] = {'crawl': time.time() - startTime}
+    if (len(documents) == 0):
+        summary['status'] = 'noDocuments'
+        print(json.dumps(summary))
+        return EXIT_NO_DOCUMENTS
+    Globals().logMessage(f'Found {len(documents)} documents')
+
+    request = LoadDocumentsRequest()
+    request.setDocumentList(documents, args.chunk_size, args.overlap, args.sentence_transformer)
+    request.setEmbeddingFormat(args.embedding_format)
+    request.setChunkUnits(args.chunk_units, args.snap_sentences)
+    request.setSmallToBig(args.small_to_big > 0, args.small_to_big)
+    request.setEmbeddingWorkers(args.embedding_workers)
+    request.setParseWorkers(args.parse_workers)
+    request.setCsvRows(args.csv_rows)
+    request.setDeduplication(args.deduplicate, args.near_duplicate_similarity)
+    try:
+        request.processRequest()
+    except Exception as err:
+        summary['status'] = 'ingestFailed'
+        summary['error'] = f'{type(err).__name__}: {err}'
+        summary['timings'].update(request.getTimings())
+        print(json.dumps(summary))
+        return EXIT_INGEST_FAILED
+    summary['chunks'] = request.getChunkCount()
+    summary['duplicateChunks'] = request.getDuplicateCount()
+    summary['timings'].update(request.getTimings())
+
+    saveStartTime = time.time()
+    try:
+        request.getSession().getDocumentStore().save_local(args.output)
+    except OSError as err:
+        summary['status'] = 'saveFailed'
+        summary['error'] = str(err)
+        print(json.dumps(summary))
+        return EXIT_SAVE_FAILED
+    summary['timings']['save'] = time.time() - saveStartTime
+    summary['timings']['total'] = time.time() - startTime
+    summary['status'] = 'ok'
+    print(json.dumps(summary))
+    return EXIT_OK
+
+if (__name__ == '__main__'):
+    sys.exit(main())
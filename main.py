@@ -5,17 +5,38 @@
 #
 # Copyright 2024 David Wootton
 
+import time
+startupTimes = [('start', time.perf_counter())]
+
 import os
 import sys
+import threading
 from PySide6.QtCore import QSettings
+from PySide6.QtCore import QTimer
 from PySide6.QtWidgets import QApplication
 from Request.TerminationRequest import TerminationRequest
 from UI.MainWindow import MainWindow
 from Util.Globals import Globals
+from Util.Signals import LogSignal
+from Util.Signals import ResultSignal
 from Worker.WorkerThread import WorkerThread
-import torch
 import json
 
+# Libraries which take seconds to import and are only imported when first used, so they should not be imported during startup
+HEAVY_MODULES = ('torch', 'transformers', 'accelerate', 'auto_gptq', 'langchain', 'langchain_community', 'faiss', 'llama_cpp',
+                 'sentence_transformers')
+
+# Log the names of the GPUs. This imports torch, so it is run in a background thread after the main window is shown, which also means
+# torch is usually already imported by the time it is needed.
+def logGPUs():
+    import torch
+    for n in range(torch.cuda.device_count()):
+        Globals().logMessage(f'GPU {n} is {torch.cuda.get_device_name(n)}')
+
+# Record the time a startup phase completed
+def recordStartupTime(phase):
+    startupTimes.append((phase, time.perf_counter()))
+
 def setupProfiles():
     try:
         profiles = json.load(open(f'{os.path.expanduser("~")}/.DocAssistantProfile.json'))
@@ -24,49 +45,74 @@ def setupProfiles():
         profiles['modelProfiles'] = {}
         profiles['queryProfiles'] = {}
     Globals().setProfiles(profiles)
+    # The memory budget shared by all sessions is specified in MB
+    Globals().getSessionManager().setMemoryBudget(profiles.get('memoryBudget', 0) * 1048576)
+
+# Complete startup once the event loop is running and the main window is shown. If the DOCASSISTANT_STARTUP_TIMING environment variable
+# is set, log the time taken by each startup phase and any heavy libraries imported during startup.
+def startupComplete():
+    recordStartupTime('show main window')
+    if (not os.environ.get('DOCASSISTANT_STARTUP_TIMING', '0') == '0'):
+        phases = []
+        for n in range(1, len(startupTimes)):
+            phases.append(f'{startupTimes[n][0]} {startupTimes[n][1] - startupTimes[n - 1][1]:.3f}')
+        Globals().logMessage(f'Startup completed in {startupTimes[-1][1] - startupTimes[0][1]:.3f} seconds: {", ".join(phases)}')
+        heavyModules = [m for m in HEAVY_MODULES if (m in sys.modules)]
+        if (len(heavyModules) > 0):
+            Globals().logMessage(f'Modules imported during startup which should be imported on first use: {", ".join(heavyModules)}')
+    threading.Thread(target=logGPUs, name='LogGPUs', daemon=True).start()
+
+# Run the GUI. This is only done when main.py is run as a program, since embedding worker processes import this module when they start.
+def main():
+    recordStartupTime('imports')
+
+    app = QApplication(sys.argv)
+    app.setApplicationName('AIDocAssistant')
+    app.setApplicationVersion('0.1')
+    app.setOrganizationName('HungryGhost')
+    app.setOrganizationDomain('org.oss.drw')
+    app.setApplicationDisplayName('AIDocAssistant')
+    app.setQuitOnLastWindowClosed(True)
+    recordStartupTime('create application')
+
+    setupProfiles()
+    Globals().setLogEvent(LogSignal())
+    Globals().setResultEvent(ResultSignal())
+    recordStartupTime('load profiles')
+
+    settings = QSettings()
+    haveStyle = False
+    style = 'QWidget {'
+    textColor = settings.value('ApplicationTextColor', '')
+    if (not textColor == ''):
+        style = style + f'color: {textColor.name()};'
+        haveStyle = True
+    font = settings.value('ApplicationFont', '')
+    if (not font == ''):
+        fontName, fontPoints = font.split(':')
+        style = style + f'font: {fontPoints}pt {fontName};';
+        haveStyle = True
+    style = style + '}'
+    if (haveStyle):
+        app.setStyleSheet(style)
+
+    mainWindow = MainWindow(None)
+    recordStartupTime('create main window')
+
+    workerThread = WorkerThread()
+    Globals.setWorkerThread(Globals(), workerThread)
+    workerThread.start()
+    QTimer.singleShot(0, startupComplete)
+
+    app.exec()
+
+    request = TerminationRequest()
+    workerThread.enqueue(request)
+    workerThread.wait()
+
+    json.dump(Globals().getProfiles(), open(f'{os.path.expanduser("~")}/.DocAssistantProfile.json', 'w'), indent=4)
+
+    return 0
 
-gpuCount = torch.cuda.device_count()
-for n in range(gpuCount):
-    print(f'GPU {n} is {torch.cuda.get_device_name(n)}')
-
-app = QApplication(sys.argv)
-app.setApplicationName('AIDocAssistant')
-app.setApplicationVersion('0.1')
-app.setOrganizationName('HungryGhost')
-app.setOrganizationDomain('org.oss.drw')
-app.setApplicationDisplayName('AIDocAssistant')
-app.setQuitOnLastWindowClosed(True)
-
-setupProfiles()
-
-settings = QSettings()
-haveStyle = False
-style = 'QWidget {'
-textColor = settings.value('ApplicationTextColor', '')
-if (not textColor == ''):
-    style = style + f'color: {textColor.name()};'
-    haveStyle = True
-font = settings.value('ApplicationFont', '')
-if (not font == ''):
-    fontName, fontPoints = font.split(':')
-    style = style + f'font: {fontPoints}pt {fontName};';
-    haveStyle = True
-style = style + '}'
-if (haveStyle):
-    app.setStyleSheet(style)
-
-mainWindow = MainWindow(None)
-
-workerThread = WorkerThread()
-Globals.setWorkerThread(Globals(), workerThread)
-workerThread.start()
-
-app.exec()
-
-request = TerminationRequest()
-workerThread.enqueue(request)
-workerThread.wait()
-
-json.dump(Globals().getProfiles(), open(f'{os.path.expanduser("~")}/.DocAssistantProfile.json', 'w'), indent=4)
-
-sys.exit(0)
+if (__name__ == '__main__'):
+    sys.exit(main())
@@ -0,0 +1,257 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+# Headless HTTP server allowing several clients to query loaded models and document indexes. Each request names a session, the default
+# session if not specified, so clients can share one model and index or use separate ones within the server's memory budget. Requests
+# are run by a RequestScheduler, which limits how many queries run at once and rejects requests with status 503 when its queue is full.
+# Query answers can be streamed as server-sent events. Endpoints:
+#     GET  /status        Report the sessions, what they have loaded and the scheduler queue state
+#     POST /load-index    {"session": name, "path": index directory, "sentenceTransformer": transformer used to build the index,
+#                          "embeddingFormat": pytorch|onnx|onnx-int8}
+#     POST /load-model    {"session": name, "profile": model profile name}
+#     POST /query         {"session": name, "question": text, "queryProfile": name, "maxNewTokens": n, "matches": n, "stream": true|false,
+#                          "filters": {"source": path or file name, "type": extension, "page": n, "mtime": {"min": time, "max": time}},
+#                          "requestId": id used to stop the query, generated if not specified}
+#     POST /stop          {"session": name, "requestId": id} stop a query, or all queries in the session if no request id is specified
+#     POST /close-session {"session": name} discard the session's model and index
+# Models and sentence transformers are only loaded from local paths. HuggingFace downloads are disabled unless HF_HUB_OFFLINE=0 is set in
+# the environment, so the server can be exercised fully offline against a small model saved on disk.
+
+import os
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+os.environ.setdefault('TRANSFORMERS_OFFLINE', os.environ['HF_HUB_OFFLINE'])
+
+import argparse
+import json
+import queue
+import sys
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from Request.LoadIndexRequest import LoadIndexRequest
+from Request.LoadModelRequest import LoadModelRequest
+from Request.QueryRequest import QueryRequest
+from Util.Globals import Globals
+from Util.MetadataIndex import validateFilters
+from Util.ModelCache import ModelCache
+from Util.RequestScheduler import RequestScheduler
+from Util.SessionManager import SessionManager
+
+# Handle one HTTP request from a client
+class DocAssistantHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if (self.path == '/status'):
+            sessionManager = Globals().getSessionManager()
+            status = {}
+            status['sessions'] = {}
+            for session in sessionManager.getSessions():
+                sessionStatus = {}
+                sessionStatus['modelLoaded'] = session.getModel() is not None
+                sessionStatus['indexLoaded'] = session.getDocumentStore() is not None
+                sessionStatus['memoryUsage'] = session.getMemoryUsage()
+                status['sessions'][session.getName()] = sessionStatus
+            status['memoryUsage'] = sessionManager.getMemoryUsage()
+            status['memoryBudget'] = sessionManager.getMemoryBudget()
+            status['queued'] = self.server.scheduler.getQueuedCount()
+            status['running'] = self.server.scheduler.getRunningCount()
+            status['workers'] = self.server.scheduler.getWorkerCount()
+            self.sendJson(200, status)
+        else:
+            self.sendJson(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length)) if (length > 0) else {}
+        except ValueError as err:
+            self.sendJson(400, {'error': f'Invalid request body: {err}'})
+            return
+        if (not isinstance(body, dict)):
+            self.sendJson(400, {'error': 'Invalid request body: expected a JSON object'})
+            return
+        try:
+            if (self.path == '/load-index'):
+                self.loadIndex(body)
+            elif (self.path == '/load-model'):
+                self.loadModel(body)
+            elif (self.path == '/query'):
+                self.query(body)
+            elif (self.path == '/stop'):
+                stoppedCount = self.getSession(body).stopQueries(body.get('requestId'))
+                self.sendJson(200, {'status': 'ok', 'stopped': stoppedCount})
+            elif (self.path == '/close-session'):
+                self.closeSession(body)
+            else:
+                self.sendJson(404, {'error': f'Unknown path {self.path}'})
+        except KeyError as err:
+            self.sendJson(400, {'error': f'Missing or unknown value {err}'})
+        except (ValueError, TypeError) as err:
+            self.sendJson(400, {'error': f'Invalid value: {err}'})
+        except queue.Full:
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.sendBody('application/json', json.dumps({'error': 'Server busy, too many queued requests'}))
+
+    # Discard a session once no requests are running in it
+    def closeSession(self, body):
+        session = self.getSession(body)
+        session.stopQueries()
+        lock = self.server.scheduler.getLock(session.getName())
+        lock.acquireExclusive()
+        try:
+            Globals().getSessionManager().removeSession(session.getName())
+        finally:
+            lock.releaseExclusive()
+        self.sendJson(200, {'status': 'ok'})
+
+    # Get the session named in the request body
+    def getSession(self, body):
+        return Globals().getSessionManager().getSession(body.get('session', SessionManager.DEFAULT_SESSION))
+
+    # Run a load request exclusively within its session, waiting for it to complete before replying
+    def runLoadRequest(self, request, body):
+        startTime = time.time()
+        request.setSession(self.getSession(body))
+        scheduledRequest = self.server.scheduler.submit(request, exclusive=True, lockName=request.getSession().getName())
+        scheduledRequest.wait()
+        if (scheduledRequest.getError() is not None):
+            self.sendJson(500, {'error': f'{type(scheduledRequest.getError()).__name__}: {scheduledRequest.getError()}'})
+        else:
+            self.sendJson(200, {'status': 'ok', 'seconds': time.time() - startTime})
+
+    def loadIndex(self, body):
+        request = LoadIndexRequest()
+        request.setIndexParameters(body['path'], body.get('sentenceTransformer', ''))
+        request.setEmbeddingFormat(body.get('embeddingFormat', 'pytorch'))
+        self.runLoadRequest(request, body)
+
+    def loadModel(self, body):
+        request = LoadModelRequest()
+        request.setModelParameters(Globals().getProfiles()['modelProfiles'][body['profile']])
+        self.runLoadRequest(request, body)
+
+    # Run a query, either streaming answer text as server-sent events or replying with the complete answer. The query is registered with its
+    # session while it is queued and running, so it can be stopped by its request id, which is sent in the first event of a streamed answer
+    # and in the reply to other queries.
+    def query(self, body):
+        try:
+            validateFilters(body.get('filters'))
+        except ValueError as err:
+            self.sendJson(400, {'error': f'Invalid filters: {err}'})
+            return
+        profileName = body.get('queryProfile', Globals().getProfiles().get('selectedQueryProfile'))
+        session = self.getSession(body)
+        request = QueryRequest()
+        request.setSession(session)
+        request.setQueryParameters(body['question'], Globals().getProfiles()['queryProfiles'][profileName],
+                                   int(body.get('maxNewTokens', self.server.maxNewTokens)), int(body.get('matches', self.server.matches)))
+        request.setFilters(body.get('filters'))
+        if ('requestId' in body):
+            request.setRequestId(str(body['requestId']))
+        session.addQuery(request)
+        try:
+            if (body.get('stream', False)):
+                self.streamQuery(session, request)
+            else:
+                request.setAnswerHandler(lambda text: None)
+                scheduledRequest = self.server.scheduler.submit(request, lockName=session.getName())
+                scheduledRequest.wait()
+                if (scheduledRequest.getError() is not None):
+                    self.sendJson(500, {'error': f'{type(scheduledRequest.getError()).__name__}: {scheduledRequest.getError()}'})
+                else:
+                    result = request.getResult()
+                    result['requestId'] = request.getRequestId()
+                    self.sendJson(200, result)
+        finally:
+            session.removeQuery(request)
+
+    def sendBody(self, contentType, text):
+        data = text.encode('utf-8')
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendEvent(self, event, data):
+        self.wfile.write(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def sendJson(self, status, data):
+        self.send_response(status)
+        self.sendBody('application/json', json.dumps(data))
+
+    # Stream a query's answer text as server-sent events. Answer text is passed from the scheduler thread to this thread through a queue,
+    # with None marking the end of the answer.
+    def streamQuery(self, session, request):
+        textQueue = queue.Queue()
+        request.setAnswerHandler(textQueue.put)
+        scheduledRequest = self.server.scheduler.submit(request, completionHandler=lambda: textQueue.put(None), lockName=session.getName())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.sendEvent('start', {'requestId': request.getRequestId()})
+            while (True):
+                text = textQueue.get()
+                if (text is None):
+                    break
+                self.sendEvent('token', {'text': text})
+            if (scheduledRequest.getError() is not None):
+                self.sendEvent('error', {'error': f'{type(scheduledRequest.getError()).__name__}: {scheduledRequest.getError()}'})
+            else:
+                result = request.getResult()
+                result.pop('answer')
+                self.sendEvent('done', result)
+        except (BrokenPipeError, ConnectionResetError):
+            # Stop generating an answer nobody will read
+            Globals().logMessage(f'Client disconnected while streaming answer, stopping query {request.getRequestId()} in session '
+                                 f'{session.getName()}')
+            request.stop()
+
+    def log_message(self, format, *args):
+        Globals().logMessage(f'{self.address_string()} {format % args}')
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description='Serve document queries over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on, 0.0.0.0 to accept connections from the LAN')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--profiles', default=f'{os.path.expanduser("~")}/.DocAssistantProfile.json', help='Profiles file')
+    parser.add_argument('--max-concurrent', type=int, default=1, help='Maximum number of queries run at the same time')
+    parser.add_argument('--queue-depth', type=int, default=16, help='Maximum number of requests waiting to run')
+    parser.add_argument('--max-new-tokens', type=int, default=512, help='Default maximum number of new tokens per answer')
+    parser.add_argument('--matches', type=int, default=4, help='Default number of document matches per question')
+    parser.add_argument('--resident-models', type=int, default=ModelCache.DEFAULT_MAX_MODELS, help='Number of loaded models kept in memory for fast switching')
+    parser.add_argument('--memory-budget', type=int, help='Memory in MB shared by the models and indexes of all sessions, 0 for no limit')
+    return parser.parse_args()
+
+def main():
+    args = parseArguments()
+    profiles = json.load(open(args.profiles))
+    Globals().setProfiles(profiles)
+    memoryBudget = args.memory_budget if (args.memory_budget is not None) else profiles.get('memoryBudget', 0)
+    Globals().getSessionManager().setMemoryBudget(memoryBudget * 1048576)
+    Globals().getSessionManager().getModelCache().setMaxModels(args.resident_models)
+    server = ThreadingHTTPServer((args.host, args.port), DocAssistantHandler)
+    server.daemon_threads = True
+    server.scheduler = RequestScheduler(args.max_concurrent, args.queue_depth)
+    server.maxNewTokens = args.max_new_tokens
+    server.matches = args.matches
+    Globals().logMessage(f'Serving on {args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if (__name__ == '__main__'):
+    sys.exit(main())
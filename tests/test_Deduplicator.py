@@ -0,0 +1,49 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_TEXT = ('The embedding model converts each chunk of a document into a vector, and the vectors are stored in a FAISS index so the chunks '
+         'most similar to a query can be found quickly when the user asks a question about the documents that were loaded')
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        from Util.Deduplicator import Deduplicator
+        self._deduplicator = Deduplicator(0.8)
+
+    def testExactDuplicate(self):
+        self.assertIsNone(self._deduplicator.findDuplicate('a', _TEXT, {'source': 'a.txt'}))
+        self.assertEqual(self._deduplicator.findDuplicate('b', '  ' + _TEXT.upper() + '\n', {'source': 'b.txt'}), 'a')
+        self.assertEqual(self._deduplicator.getExactCount(), 1)
+        self.assertEqual(self._deduplicator.getDuplicateLocations(), {'a': [{'source': 'b.txt'}]})
+
+    # An exact copy of a near duplicate must map to the kept chunk, since the near duplicate is not indexed
+    def testExactCopyOfNearDuplicate(self):
+        nearText = _TEXT.replace('loaded', 'loaded earlier')
+        self.assertIsNone(self._deduplicator.findDuplicate('a', _TEXT, {'source': 'a.txt'}))
+        self.assertEqual(self._deduplicator.findDuplicate('b', nearText, {'source': 'b.txt'}), 'a')
+        self.assertEqual(self._deduplicator.findDuplicate('c', nearText, {'source': 'c.txt'}), 'a')
+        self.assertEqual(self._deduplicator.getNearCount(), 1)
+        self.assertEqual(self._deduplicator.getExactCount(), 1)
+        self.assertEqual(self._deduplicator.getDuplicateLocations(), {'a': [{'source': 'b.txt'}, {'source': 'c.txt'}]})
+
+    def testDistinctChunks(self):
+        self.assertIsNone(self._deduplicator.findDuplicate('a', _TEXT, {'source': 'a.txt'}))
+        self.assertIsNone(self._deduplicator.findDuplicate('b', 'An entirely different paragraph about loading models onto the GPU',
+                                                           {'source': 'b.txt'}))
+        self.assertEqual(self._deduplicator.getDuplicateLocations(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import os
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import numpy
+    import onnx
+    import onnxruntime
+    import langchain_core
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers import models
+    from transformers import BertConfig
+    from transformers import BertModel
+    from transformers import BertTokenizerFast
+except ImportError:
+    SentenceTransformer = None
+
+# Words in the vocabulary of the test tokenizer, which covers the sample texts and the test texts
+_WORDS = ['the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', 'install', 'packages', 'how', 'do', 'i', 'reset', 'my',
+          'password', 'table', 'memory', 'model', 'query', '.', '?', ':', ',']
+
+@unittest.skipIf(SentenceTransformer is None, 'PyTorch, sentence-transformers, ONNX Runtime or LangChain is not installed')
+class OnnxEmbeddingsTest(unittest.TestCase):
+    # Save a tiny randomly initialized BERT sentence transformer, whose tokenizer returns token_type_ids before attention_mask
+    def createSentenceTransformer(self, directory):
+        bertDirectory = os.path.join(directory, 'bert')
+        os.makedirs(bertDirectory)
+        vocabFile = os.path.join(bertDirectory, 'vocab.txt')
+        with open(vocabFile, 'w') as vocab:
+            vocab.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + _WORDS) + '\n')
+        tokenizer = BertTokenizerFast(vocabFile)
+        tokenizer.save_pretrained(bertDirectory)
+        torch.manual_seed(1)
+        config = BertConfig(vocab_size=len(_WORDS) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+                            max_position_embeddings=128, type_vocab_size=2)
+        BertModel(config).save_pretrained(bertDirectory)
+        transformer = models.Transformer(bertDirectory, max_seq_length=64)
+        pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode='mean')
+        path = os.path.join(directory, 'sentenceTransformer')
+        SentenceTransformer(modules=[transformer, pooling], device='cpu').save(path)
+        self.assertIn('token_type_ids', list(tokenizer('the dog').keys()))
+        return path
+
+    def testExportMatchesPyTorch(self):
+        from Util.OnnxEmbeddings import OnnxEmbeddings
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.createSentenceTransformer(directory)
+            embeddings = OnnxEmbeddings(path, False)
+            texts = ['the quick brown fox', 'how do i reset my password ?', 'the lazy dog jumps over the fox .']
+            expected = SentenceTransformer(path, device='cpu').encode(texts, convert_to_numpy=True)
+            actual = numpy.array(embeddings.embed_documents(texts))
+            cosine = numpy.sum(expected * actual, axis=1) / (numpy.linalg.norm(expected, axis=1) * numpy.linalg.norm(actual, axis=1))
+            self.assertGreater(float(numpy.min(cosine)), OnnxEmbeddings.COSINE_TOLERANCE['fp32'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# This software is licensed with the Apache 2.0 license
+#
+# See the LICENSE file in the top level directory of this repository for
+# license terms.
+#
+# Copyright 2024 David Wootton
+
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http.server import ThreadingHTTPServer
+from Request.LoadIndexRequest import LoadIndexRequest
+from Request.QueryRequest import QueryRequest
+from Util.Globals import Globals
+from Util.RequestScheduler import RequestScheduler
+import server
+
+_QUERY_PROFILE = {'tempurature': 0.0, 'topP': 1.0, 'topK': 0, 'typicalP': 1.0, 'repetitionPenalty': 1.0, 'encoderRepetitionPenalty': 1.0,
+                  'noRepeatNGramSize': 0, 'minimumLength': 0, 'penaltyAlpha': 0.0, 'beamCount': 1, 'lengthPenalty': 1.0, 'earlyStop': False,
+                  'doSample': False}
+
+# Tiny stand in for a FAISS vector store, with the index attributes used to report memory usage
+class StubIndex():
+    ntotal = 2
+    d = 4
+
+class StubStore():
+    index = StubIndex()
+
+# Load the stub index instead of a FAISS index
+def loadIndex(self):
+    self.getSession().setDocumentStore(StubStore())
+
+# Answer a query without a model. The question 'block' waits until the query is stopped.
+def runQuery(self):
+    if (self._query == 'block'):
+        stopTime = time.time() + 10.0
+        while ((not self.isStopped()) and (time.time() < stopTime)):
+            time.sleep(0.01)
+        self.postAnswer('stopped' if (self.isStopped()) else 'timed out')
+        return
+    self._matchIds = ['chunk-1']
+    self._matchSources = [{'source': 'manual.pdf', 'page': 0}]
+    for text in ('The ', 'answer'):
+        self.postAnswer(text)
+    self._timings['total'] = 0.0
+
+# Test the HTTP server's endpoints against a server on an ephemeral port, with stub index loading and query processing so no model or
+# sentence transformer is needed. The scheduler runs one request at a time with one waiting, so a third concurrent query is rejected.
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        Globals().setProfiles({'queryProfiles': {'Default': _QUERY_PROFILE}, 'selectedQueryProfile': 'Default', 'modelProfiles': {}})
+        for target, function in ((LoadIndexRequest, loadIndex), (QueryRequest, runQuery)):
+            patcher = mock.patch.object(target, 'processRequest', function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), server.DocAssistantHandler)
+        self._server.daemon_threads = True
+        self._server.scheduler = RequestScheduler(1, 1)
+        self._server.maxNewTokens = 16
+        self._server.matches = 2
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self._server.server_close)
+        self.addCleanup(self._server.shutdown)
+
+    # Send a request, returning the response status, headers and body
+    def send(self, method, path, body=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self._server.server_address[1], timeout=30)
+        try:
+            connection.request(method, path, json.dumps(body) if (body is not None) else None, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read().decode('utf-8')
+        finally:
+            connection.close()
+
+    # Wait until a condition is true, failing the test if it takes too long
+    def waitFor(self, condition):
+        stopTime = time.time() + 10.0
+        while (not condition()):
+            self.assertLess(time.time(), stopTime)
+            time.sleep(0.01)
+
+    def testLoadIndex(self):
+        status, headers, data = self.send('POST', '/load-index', {'session': 'load', 'path': '/tmp/index'})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(data)['status'], 'ok')
+        status, headers, data = self.send('GET', '/status')
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(data)['sessions']['load']['indexLoaded'])
+
+    def testQuery(self):
+        status, headers, data = self.send('POST', '/query', {'session': 'query', 'question': 'What?', 'requestId': 'query-1'})
+        self.assertEqual(status, 200)
+        result = json.loads(data)
+        self.assertEqual(result['answer'], 'The answer')
+        self.assertEqual(result['chunkIds'], ['chunk-1'])
+        self.assertEqual(result['requestId'], 'query-1')
+
+    def testInvalidFilters(self):
+        status, headers, data = self.send('POST', '/query', {'question': 'What?', 'filters': {'page': {'min': 'one'}}})
+        self.assertEqual(status, 400)
+        self.assertIn('page', json.loads(data)['error'])
+
+    def testInvalidBody(self):
+        status, headers, data = self.send('POST', '/query', {'question': 'What?', 'maxNewTokens': 'many'})
+        self.assertEqual(status, 400)
+        self.assertIn('many', json.loads(data)['error'])
+        status, headers, data = self.send('POST', '/query', ['What?'])
+        self.assertEqual(status, 400)
+        self.assertIn('JSON object', json.loads(data)['error'])
+
+    def testStreamedQuery(self):
+        status, headers, data = self.send('POST', '/query', {'session': 'stream', 'question': 'What?', 'stream': True})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'text/event-stream')
+        events = []
+        for block in data.strip().split('\n\n'):
+            event, eventData = block.split('\n')
+            events.append((event[len('event: '):], json.loads(eventData[len('data: '):])))
+        self.assertEqual([event for event, eventData in events], ['start', 'token', 'token', 'done'])
+        self.assertEqual(''.join(eventData['text'] for event, eventData in events if (event == 'token')), 'The answer')
+        self.assertEqual(events[-1][1]['chunkIds'], ['chunk-1'])
+        self.assertNotIn('answer', events[-1][1])
+
+    # Fill the scheduler with a running query and a queued query, check a third query is rejected, then stop the running query
+    def testQueueFull(self):
+        results = {}
+        def query(name, body):
+            results[name] = self.send('POST', '/query', body)
+        running = threading.Thread(target=query, args=('running', {'session': 'full', 'question': 'block', 'requestId': 'blocked'}))
+        running.start()
+        self.waitFor(lambda: self._server.scheduler.getRunningCount() == 1)
+        queued = threading.Thread(target=query, args=('queued', {'session': 'full', 'question': 'What?'}))
+        queued.start()
+        self.waitFor(lambda: self._server.scheduler.getQueuedCount() == 1)
+        status, headers, data = self.send('POST', '/query', {'session': 'full', 'question': 'What?'})
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], '1')
+        status, headers, data = self.send('POST', '/stop', {'session': 'full', 'requestId': 'blocked'})
+        self.assertEqual(json.loads(data)['stopped'], 1)
+        running.join()
+        queued.join()
+        self.assertEqual(results['running'][0], 200)
+        self.assertEqual(json.loads(results['running'][2])['answer'], 'stopped')
+        self.assertEqual(results['queued'][0], 200)
+        self.assertEqual(json.loads(results['queued'][2])['answer'], 'The answer')
+
+if __name__ == '__main__':
+    unittest.main()